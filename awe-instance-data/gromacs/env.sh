@@ -3,18 +3,26 @@ set -o errexit
 set -o verbose
 
 CONF_IN=structure.pdb
+PAYLOAD=walker.bin
+TOPOLOGY=topology.pdb
 CONF_OUT=structure2.pdb
 ASSIGNMENT=cell2.dat
+### cell definitions, preferring the binary format (see awe-convert-cells)
+CELLS=cells.dat
+if [ -f cells.npy ]; then CELLS=cells.npy; fi
+### optional pivot index of the cells (see awe-index-cells)
+INDEX=
+if [ -f cells.idx ]; then INDEX=cells.idx; fi
 DESIRED_FILES="$CONF_OUT $ASSIGNMENT"
-RESULTFILE=results.tar
 CLEANUP="traj* *.tpr"
 
 ### disable gmx automatic backups.
 export GMX_MAXBACKUP=-1
 ### access the topologies sent to the worker
 export GMXLIB=$PWD/gmxtopologies
-### assume each worker is allocated one processor
-NPROCS=1
+### use the cores allocated to the task (set by the worker), default to one
+NPROCS=${CORES:-1}
+export OMP_NUM_THREADS=$NPROCS
 
 puts() {
 	echo "================================================================================"
@@ -32,9 +40,10 @@ prelude() {
 }
 
 prepare-filenames() {
-	structure=`ls $CONF_IN.*`
-	id="${structure##*.}"
-	mv -f "$CONF_IN.$id" $CONF_IN
+	payload=`ls $PAYLOAD.*`
+	id="${payload##*.}"
+	python3 awe-payload decode "$PAYLOAD.$id" $TOPOLOGY $CONF_IN
+	rm -f "$PAYLOAD.$id"
 	#mv -f "$WALKER.$id" $WALKER
 }
 
@@ -55,7 +64,12 @@ run-md() {
 
 assign() {
 	puts "Assigning trajectory"
-	./awe-assign cells.dat CellIndices.dat traj.xtc StructureIndices.dat $ASSIGNMENT
+	### prefer the daemon kept by awe-assignd, when it is sent to the worker
+	if [ -f awe-assignd ] && python3 awe-assignd assign $CELLS CellIndices.dat StructureIndices.dat traj.xtc $ASSIGNMENT; then
+		:
+	else
+		./awe-assign $CELLS CellIndices.dat traj.xtc StructureIndices.dat $ASSIGNMENT $INDEX
+	fi
 	echo
 }
 
@@ -69,8 +83,8 @@ check-result() {
 
 package() {
 	puts "Packaging results"
-	tar cvf "$RESULTFILE.$id" $CONF_OUT $ASSIGNMENT $WALKER
-	ls "$RESULTFILE.$id"
+	### the result is returned on the output of the task (see awe/payload.py)
+	python3 awe-payload emit $CONF_OUT $ASSIGNMENT
 	echo
 }
 
@@ -13,9 +13,15 @@ from sys import stdout
 import numpy as np
 import argparse
 import mdtraj
+import os
+import sys
 import time
 
-np.set_printoptions(threshold=np.nan)
+np.set_printoptions(threshold=sys.maxsize)
+
+# Cells are only ruled out by the cell index when their RMSD bound exceeds the
+# best RMSD by more than this (in nm), as mdtraj computes in single precision
+INDEX_MARGIN = 1e-4
 
 def parse_args(args):
     parser = argparse.ArgumentParser()
@@ -57,7 +63,7 @@ def parse_args(args):
                        )
 
     parser.add_argument("--cell-defs",
-                        help="path to the cell definition file",
+                        help="path to the cell definition file, as text or .npy",
                         type=str,
                         default="cells.dat",
                        )
@@ -68,6 +74,24 @@ def parse_args(args):
                         default="cell2.dat"
                        )
 
+    parser.add_argument("--centers",
+                        help="path to cell centers precomputed with --prepare-centers",
+                        type=str,
+                        default=None
+                       )
+
+    parser.add_argument("--cell-index",
+                        help="path to a pivot index of the cells written by awe-index-cells",
+                        type=str,
+                        default=None
+                       )
+
+    parser.add_argument("--prepare-centers",
+                        help="write the selected atoms of the cell centers, centered, to this .npy file and exit",
+                        type=str,
+                        default=None
+                       )
+
     return parser.parse_args()
 
 
@@ -90,64 +114,173 @@ def read_cells(infile):
     The x, y, and z coordinates are listed in order of atom index, and the cells
     are listed in the order determined by the AWE preprocessing stage.
 
+    A .npy file written by awe-convert-cells is mapped into memory instead,
+    so that it is not parsed by every task.
+
     Arguments:
     infile -- (str) the file containing the cell definitions
 
     """
-    cells = []
-    ncells = 0
-    natoms = 0
-    ndims = 0
+    with open(infile, 'rb') as f:
+        magic = f.read(6)
+    if magic == b'\x93NUMPY':
+        cells = np.load(infile, mmap_mode='r')
+        print(*cells.shape)
+        return cells
+
+    header = {}
+    body = []
     with open(infile, 'r') as f:
         for line in f:
-            try:
-                if "ncells:" in line or "ncoords:" in line or "ndims:" in line:
-                    entries = line.strip().split()
-                    if entries[0] == "ncells:":
-                        ncells = int(entries[1])
-                    elif entries[0] == "ncoords:":
-                        natoms = int(entries[1])
-                    else:
-                        ndims = int(entries[1])
-                else:
-                    cells.append(float(line))
-            except ValueError:
-                continue
+            entries = line.split()
+            if entries and entries[0] in ("ncells:", "ncoords:", "ndims:"):
+                header[entries[0]] = int(entries[1])
+            else:
+                body.append(line)
+    ncells = header.get("ncells:", 0)
+    natoms = header.get("ncoords:", 0)
+    ndims = header.get("ndims:", 0)
     print(ncells, natoms, ndims)
-    return np.reshape(np.array(cells), (ncells, natoms, ndims))
+    cells = np.fromstring(''.join(body), sep=' ')
+    return np.reshape(cells, (ncells, natoms, ndims))
+
+
+def read_cell_index(infile):
+    """Read a pivot index of the cells written by awe-index-cells.
+
+    The index holds the RMSD of every cell to a few pivot cells, computed over
+    the atoms used for assignment.
+
+    Arguments:
+    infile -- (str) the file containing the index
+
+    Returns:
+    The number of cells, the number of atoms, the pivot cells and the
+    (ncells, npivots) RMSDs of the cells to the pivots
+
+    """
+    header = {}
+    with open(infile, 'r') as f:
+        for _ in range(4):
+            entries = f.readline().split()
+            header[entries[0]] = entries[1:]
+        pivot_rmsds = np.loadtxt(f, ndmin=2)
+    pivots = np.array(header["pivots:"], dtype=int)
+    return int(header["ncells:"][0]), int(header["ncoords:"][0]), pivots, pivot_rmsds
+
+
+def indexed_rmsds(cell_traj, traj, index_file):
+    """Compute the RMSDs to the cells that a pivot index cannot rule out.
+
+    The RMSD to a cell is at least the difference of the RMSDs of the
+    structure and of the cell to any pivot. Cells whose bound exceeds the
+    smallest RMSD to a pivot are not compared, so the nearest cell is the
+    same as with a full scan.
+
+    Arguments:
+    cell_traj -- (mdtraj.Trajectory) the centered cells, one per frame
+    traj -- (mdtraj.Trajectory) the centered structure
+    index_file -- (str) the index written by awe-index-cells
 
+    Returns:
+    The RMSD to each cell, NaN for the cells that were not compared
 
-def determine_assignment(pdb_file, cell_file, atom_select, assignment_out):
+    """
+    ncells, natoms, pivots, pivot_rmsds = read_cell_index(index_file)
+    if ncells != cell_traj.n_frames or natoms != cell_traj.n_atoms:
+        print("Ignoring index", index_file, "of", ncells, "cells of", natoms, "atoms")
+        return mdtraj.rmsd(cell_traj, traj, frame=0, precentered=True)
+
+    rmsds = np.full(ncells, np.nan)
+    rmsds[pivots] = mdtraj.rmsd(cell_traj[pivots], traj, frame=0, precentered=True)
+
+    # Compare the cell with the smallest bound first to tighten the best RMSD
+    lower = np.abs(rmsds[pivots] - pivot_rmsds).max(axis=1)
+    first = np.argmin(np.where(np.isnan(rmsds), lower, np.inf))
+    if np.isnan(rmsds[first]):
+        rmsds[first] = mdtraj.rmsd(cell_traj[first:first+1], traj, frame=0, precentered=True)[0]
+
+    candidates = np.flatnonzero(np.isnan(rmsds) & (lower <= np.nanmin(rmsds) + INDEX_MARGIN))
+    if len(candidates) > 0:
+        rmsds[candidates] = mdtraj.rmsd(cell_traj[candidates], traj, frame=0, precentered=True)
+
+    print("Compared", np.count_nonzero(~np.isnan(rmsds)), "of", ncells, "cells")
+    return rmsds
+
+
+def center_cells(cells, atom_indices):
+    """Select the RMSD atoms of the cell centers and center them at the origin.
+
+    Arguments:
+    cells -- (ndarray) the (ncells, natoms, ndims) cell centers
+    atom_indices -- (ndarray) the atoms used to compute the RMSD
+
+    """
+    centers = np.asarray(cells, dtype=np.float32)[:, atom_indices, :]
+    centers -= centers.mean(axis=1, keepdims=True)
+    return centers
+
+
+def prepare_centers(pdb_file, cell_file, atom_select, centers_out):
+    """Precompute the centers used by determine_assignment.
+
+    Arguments:
+    pdb_file -- (str) a structure with the topology of the cells
+    cell_file -- (str) the file containing cell center definitions
+    atom_select -- (str) the MDTraj atom selection string
+    centers_out -- (str) the .npy file to write the centers to
+
+    """
+    topology = mdtraj.load(pdb_file).topology
+    rmsd_atoms = topology.select(atom_select)
+    np.save(centers_out, center_cells(read_cells(cell_file), rmsd_atoms))
+
+
+def determine_assignment(pdb_file, cell_file, atom_select, assignment_out, centers_file=None, cell_index=None):
     """Assign the resultant trajectory to an AWE cell.
 
-    Assignment is determined by the minimum RMSD to a cell center.
+    Assignment is determined by the minimum RMSD to a cell center. All cell
+    centers are held in a single trajectory of ncells frames so that the
+    RMSDs to every center are computed by one call to mdtraj.rmsd.
 
     Arguments:
     pdb_file -- (str) the file containing the trajectory/frame to assign
     cell_file -- (str) the file containing cell center definitions
     atom_select -- (str) the OpenMM atom selection string
     assignment_out -- (str) the file to write the assignment to
+    centers_file -- (str) optional centers written by prepare_centers,
+                    used instead of cell_file
+    cell_index -- (str) optional pivot index written by awe-index-cells
+                  over the selected atoms, to skip the cells it rules out
 
     """
-    cells = read_cells(cell_file)
-    min_rmsd = float('inf')
     assignment = -1
     traj = mdtraj.load(pdb_file)
-    cell_traj = mdtraj.load(pdb_file)
     rmsd_atoms = traj.topology.select(atom_select)
-    for i in range(0, len(cells)):
-        try:
-            cell_traj.xyz = cells[i]
-            rmsd = mdtraj.rmsd(traj,
-                               cell_traj,
-                               atom_indices=rmsd_atoms,
-                              )
-            print(rmsd)
-            if rmsd < min_rmsd:
-                min_rmsd = rmsd
-                assignment = i
-        except ValueError:
-            continue
+
+    # Only the RMSD atoms are needed; centering them once here lets mdtraj
+    # skip centering each of the cell frames
+    traj = traj.atom_slice(rmsd_atoms)
+    if centers_file is not None and os.path.exists(centers_file):
+        centers = np.load(centers_file)
+    else:
+        centers = center_cells(read_cells(cell_file), rmsd_atoms)
+
+    try:
+        cell_traj = mdtraj.Trajectory(centers, traj.topology)
+        cell_traj.center_coordinates()
+        traj.center_coordinates()
+        if cell_index is not None and os.path.exists(cell_index):
+            rmsds = indexed_rmsds(cell_traj, traj, cell_index)
+        else:
+            rmsds = mdtraj.rmsd(cell_traj, traj, frame=0, precentered=True)
+        if not np.isnan(rmsds).all():
+            assignment = int(np.nanargmin(rmsds))
+            print("Minimum RMSD", rmsds[assignment], "to cell", assignment)
+    except ValueError as e:
+        # The cell centers do not match the structure
+        print("Error: could not compute the RMSD to the cells:", e)
+
     with open(assignment_out, 'w') as f:
         f.write(str(assignment))
     
@@ -156,6 +289,10 @@ def determine_assignment(pdb_file, cell_file, atom_select, assignment_out):
 if  __name__ == "__main__":
     args = parse_args(None)
     print(args) 
+    if args.prepare_centers:
+        prepare_centers(args.input_pdb, args.cell_defs, args.atom_select, args.prepare_centers)
+        sys.exit(0)
+
     print("Loading pdb...")
     pdb = app.PDBFile(args.input_pdb)
     print(pdb.positions)
@@ -205,6 +342,7 @@ if  __name__ == "__main__":
     print("Determining cell assignment...")
     
     time.sleep(5)
-    determine_assignment(args.output, args.cell_defs, args.atom_select, args.assignment_out)
+    determine_assignment(args.output, args.cell_defs, args.atom_select, args.assignment_out, args.centers,
+                         args.cell_index)
 
     print("Done!")
@@ -10,13 +10,19 @@ from .io_tools import trace, log
 from .util import typecheck, typecheckfn
 
 from . import stats
+from . import metrics
+from . import monitor
+from . import profiler
 from . import aweclasses
+from . import executor
 from . import workqueue
 from . import io_tools
 from . import resample
 from . import structures
+from . import payload
+from . import checkpoint
 
-from .aweclasses import Walker, AWE, Cell, System, SinkStates
+from .aweclasses import Walker, WalkerTable, AWE, Cell, System, SinkStates
 from .workqueue import Config
 from .stats import time
 from .structures import PDB
@@ -6,7 +6,9 @@ This software is distributed under the GNU General Public License.
 See the file COPYING for details.
 """
 
-from . import io_tools, stats, workqueue
+from . import io_tools, stats, workqueue, payload
+from .metrics import MetricsLogger
+from . import profiler as awe_profiler
 from .util import typecheck, returns
 from . import structures, util
 
@@ -16,6 +18,9 @@ import numpy as np
 import pickle
 
 import os, time, shutil, random
+import threading
+import asyncio
+from concurrent import futures
 import tempfile
 from collections import defaultdict
 import ctypes
@@ -31,6 +36,11 @@ class Walker(object):
     """
     Container for information about a single walker.
 
+    A Walker either holds its own data (a detached walker, e.g. one that was
+    just created or restarted) or is a lightweight view into a row of the
+    WalkerTable of the System it belongs to. Views read and write the table
+    directly, so changes made through a view are seen by the System.
+
     Fields:
         id         - the id of the walker
         cellid     - the id of the cell that the walker is currently in
@@ -69,6 +79,10 @@ class Walker(object):
         assert not (start is None and end is None), 'start = %s, end = %s' % \
          (start, end)
 
+        # Detached walkers are not backed by a WalkerTable
+        self._table      = None
+        self._row        = None
+
         self._start      = start
         self._end        = end
         self._assignment = assignment
@@ -87,16 +101,68 @@ class Walker(object):
 
         self._initid    = initid or self._id
 
+    @classmethod
+    def _view(cls, table, row):
+        """
+        Create a Walker that is a view into a row of a WalkerTable.
+
+        Parameters:
+            table - the WalkerTable holding the walker data
+            row   - the row of the walker in the table
+
+        Returns:
+            A new Walker instance backed by the table
+        """
+
+        walker        = cls.__new__(cls)
+        walker._table = table
+        walker._row   = row
+        return walker
+
+    def __getstate__(self):
+        """
+        See Python docs on the pickle module for more info on __getstate__
+        Views are pickled as detached walkers so that pickling a single
+        walker does not pickle the whole WalkerTable.
+        """
+
+        if self._table is None:
+            return self.__dict__.copy()
+
+        start = self.start
+        end   = self.end
+        return {'_table'      : None,
+                '_row'        : None,
+                '_start'      : None if start is None else start.copy(),
+                '_end'        : None if end   is None else end.copy(),
+                '_assignment' : self.assignment,
+                '_color'      : self.color,
+                '_weight'     : self.weight,
+                '_cellid'     : self.cellid,
+                '_valid'      : self.valid,
+                '_id'         : self.id,
+                '_initid'     : self.initid}
+
+    def __setstate__(self, odict):
+        """
+        See Python docs on the pickle module for more info on __setstate__
+        Walkers pickled before the WalkerTable existed have no table fields.
+        """
+
+        self.__dict__.update(odict)
+        self.__dict__.setdefault('_table', None)
+        self.__dict__.setdefault('_row', None)
+
     def __eq__(self, other):
 
         if not type(self) is type(other):
             return False
 
         return \
-            (self._start     == other._start).all() and \
-            self._assignment == other._assignment   and \
-            self._color      == other._color        and \
-            self._weight     == other._weight
+            (self.start     == other.start).all() and \
+            self.assignment == other.assignment   and \
+            self.color      == other.color        and \
+            self.weight     == other.weight
 
 
     def restart(self, weight=None, cellid=None):
@@ -113,9 +179,9 @@ class Walker(object):
         """
 
         # The walker must have been processed to be reset
-        assert self._start is not None
-        assert self._end   is not None
-        assert weight      is not None
+        assert self.start is not None
+        assert self.end   is not None
+        assert weight     is not None
 
         # Assign the walker a new id
         global _WALKER_ID
@@ -123,51 +189,73 @@ class Walker(object):
         _WALKER_ID += 1
 
         # Tell the walker which cell it is in
-        cid = cellid or self._cellid
+        cid = cellid or self.cellid
 
         # Initialize a new walker with the reset settings
-        return Walker(start      = self._end,
+        return Walker(start      = self.end,
                       end        = None,
-                      assignment = self._assignment,
-                      color      = self._color,
+                      assignment = self.assignment,
+                      color      = self.color,
                       weight     = weight,
                       wid        = wid,
                       cellid     = cid,
-                      initid     = self._initid)
+                      initid     = self.initid)
 
 
     @property
-    def id(self):         return self._id
+    def id(self):
+        if self._table is None: return self._id
+        return int(self._table.ids[self._row])
 
     @property
-    def cellid(self):     return self._cellid
+    def cellid(self):
+        if self._table is None: return self._cellid
+        return self._table.cellid(self._row)
 
     @property
-    def initid(self):    return self._initid
+    def initid(self):
+        if self._table is None: return self._initid
+        return int(self._table.initids[self._row])
 
     @property
-    def start(self):      return self._start
+    def start(self):
+        if self._table is None: return self._start
+        return self._table.start(self._row)
 
     @property
-    def end(self):        return self._end
+    def end(self):
+        if self._table is None: return self._end
+        return self._table.end(self._row)
 
     @end.setter
-    def end(self, crds):  self._end = crds
+    def end(self, crds):
+        if self._table is None: self._end = crds
+        else: self._table.set_end(self._row, crds)
 
     @property
-    def assignment(self): return self._assignment
+    def assignment(self):
+        if self._table is None: return self._assignment
+        return self._table.assignment(self._row)
 
     @assignment.setter
-    def assignment(self, asn):   self._assignment = asn
+    def assignment(self, asn):
+        if self._table is None: self._assignment = asn
+        else: self._table.set_assignment(self._row, asn)
 
     @property
-    def color(self):      return self._color
+    def color(self):
+        if self._table is None: return self._color
+        return int(self._table.colors[self._row])
 
     @color.setter
-    def color(self, c):   self._color = c
+    def color(self, c):
+        if self._table is None: self._color = c
+        else: self._table.set_color(self._row, c)
 
     @property
-    def weight(self):     return self._weight
+    def weight(self):
+        if self._table is None: return self._weight
+        return self._table.weight(self._row)
 
     @property
     def natoms(self):     return len(self._coords)
@@ -176,10 +264,13 @@ class Walker(object):
     def ndim(self):       return self._coords.shape[-1]
 
     @property
-    def valid(self):      return self._valid;
+    def valid(self):
+        if self._table is None: return self._valid
+        return bool(self._table.valid[self._row])
 
     def mark_invalid(self):
-        self._valid = False
+        if self._table is None: self._valid = False
+        else: self._table.set_valid(self._row, False)
 
     @property
     def _coords(self):
@@ -220,22 +311,34 @@ class AWE(object):
         stats          -
         traxlogger     -
         checkpointfreq -
+        pipeline       - write checkpoints while the next iteration runs
+        threads        - the number of threads decoding results and logging
+                         walkers while tasks are received
+        metrics        - whether statistics are written as binary metrics
+                         logs (see the metrics module)
+        monitor        - the monitor.Monitor serving live metrics, or None
+        profiler       - the profiler.Profiler timing the phases of each
+                         iteration
 
     Methods:
         checkpoint               -
+        flush_logs               -
         logwalker                -
         recover                  -
         run                      -
         encode_task_tag          -
         decode_from_task_tag     -
+        task_record              -
         marshal_to_task          -
-        specify_task_output_file -
+        unpack_task              -
         marshal_from_task        -
     """
 
     # @typecheck(wqconfig=workqueue.Config, system=System, iterations=int)
     def __init__(self, wqconfig=None, system=None, iterations=-1, resample=None,
-                 traxlogger = None, checkpointfreq=1, verbose=False, log_it=False):
+                 traxlogger = None, checkpointfreq=1, verbose=False, log_it=False,
+                 pipeline=False, threads=4, metrics=False, monitor=None,
+                 profiler=None):
         """
         Initialize a new instance of AWE.
 
@@ -244,8 +347,23 @@ class AWE(object):
             system         - the aweclasses.System instance to run
             iterations     - the number of iterations to run
             resample       - the resampler (typically resample.MultiColor)
-            traxlogger     - trax logging utility (see trax module)
+            traxlogger     - trax logging utility (see trax module and
+                             checkpoint.incremental)
             checkpointfreq - how often a restart checkpoint should be recorded
+            pipeline       - if True, submit the tasks of the next iteration
+                             before checkpointing and write the checkpoint
+                             in the background while the tasks run
+            threads        - the number of threads decoding results and
+                             logging walkers while tasks are received
+            metrics        - if True, write the task statistics, the cell
+                             transitions (as the numeric fields of the
+                             TRANSITION component, see Metrics.table) and
+                             the task output as binary metrics logs
+                             (debug/*.metrics) instead of gzip text logs
+            monitor        - a monitor.Monitor to serve live metrics while
+                             running, or None
+            profiler       - a profiler.Profiler to time the phases of each
+                             iteration, or None to not profile
 
         Returns:
             None
@@ -253,12 +371,25 @@ class AWE(object):
         self._verbose = verbose
         self._print_start_screen()
 
-        self.statslogger = stats.StatsLogger('debug/task_stats.log.gz')
-        self.transitionslogger = stats.StatsLogger(
-            'debug/cell-transitions.log.gz')
+        # Statistics are compressed and written on separate threads
+        if metrics:
+            self.statslogger = MetricsLogger(
+                'debug/task_stats.metrics', background=True)
+            self.transitionslogger = MetricsLogger(
+                'debug/cell-transitions.metrics', background=True)
+            taskoutputlogger = MetricsLogger(
+                'debug/task_output.metrics', buffersize=42, background=True)
+        else:
+            self.statslogger = stats.StatsLogger('debug/task_stats.log.gz',
+                                                 buffersize=1024, background=True)
+            self.transitionslogger = stats.StatsLogger(
+                'debug/cell-transitions.log.gz', buffersize=1024, background=True)
+            taskoutputlogger = None
+        self.metrics = metrics
 
         #self.tmpdir = tempfile.mkdtemp(prefix="awe-tmp.")
-        self.wq = workqueue.WorkQueue(wqconfig, statslogger=self.statslogger, log_it=log_it)
+        self.wq = workqueue.WorkQueue(wqconfig, statslogger=self.statslogger,
+                                      taskoutputlogger=taskoutputlogger, log_it=log_it)
         #self.wq.tmpdir = self.tmpdir
         self.system = system
         self.iterations = iterations
@@ -268,13 +399,27 @@ class AWE(object):
 
         self.currenttask = 0
 
-        self.stats = stats.AWEStats(logger=self.statslogger)
+        self.stats = stats.AWEStats(logger=self.statslogger, log_it=log_it)
 
         self.traxlogger = traxlogger or trax.SimpleTransactional(
                                             checkpoint='debug/trax.cpt',
                                             log='debug/trax.log')
 
         self.checkpointfreq = checkpointfreq
+        self.pipeline       = pipeline
+        self.threads        = threads
+        self.monitor        = monitor
+        self.profiler       = profiler or awe_profiler.DISABLED
+        self.wq.profiler    = self.profiler
+        self._pool          = None
+
+        # The topology is sent to each worker once (see _cache_topology)
+        self._topologypath  = None
+
+        # The background checkpoint, if any, and the lock serializing
+        # access to the traxlogger
+        self._cptthread = None
+        self._traxlock  = threading.Lock()
 
         self._firstrun  = True
         self._log = log_it
@@ -311,31 +456,127 @@ class AWE(object):
 
             print(start_str)
 
-    def checkpoint(self):
+    def checkpoint(self, background=False):
         """
         Create a checkpoint from which to restart. Replacement for pickling.
 
         Parameters:
-            None
+            background - if True, checkpoint a copy of the System on a
+                         separate thread and return immediately
 
         Returns:
             None
         """
 
-        cpt = self.traxlogger.cpt_path
+        chk = self._checkpoint_state(copy=background)
+        if background:
+            self._start_checkpoint(chk)
+        else:
+            self._wait_checkpoint()
+            self._write_checkpoint(chk)
 
-        if os.path.exists(cpt):
-            shutil.move(cpt, cpt + '.last')
+    def _checkpoint_state(self, copy=False):
+        """
+        Get the values to checkpoint.
+
+        Parameters:
+            copy - if True, copy the System so that the checkpoint is not
+                   affected by later changes to it
+
+        Returns:
+            A dictionary of the values to checkpoint
+        """
 
-        chk = dict(system         = self.system,
+        chk = dict(system         = self.system.copy() if copy else self.system,
                    iterations     = self.iterations,
                    iteration      = self.iteration,
                    resample       = self.resample,
-                   checkpointfreq = self.checkpointfreq
+                   checkpointfreq = self.checkpointfreq,
+                   wqstats        = self.wq.stats.state()
                    )
 
         chk['_firstrun'] = self._firstrun
-        self.traxlogger.checkpoint(chk)
+        return chk
+
+    def _start_checkpoint(self, chk):
+        """
+        Write a checkpoint on a separate thread.
+
+        Parameters:
+            chk - the dictionary of values to checkpoint
+
+        Returns:
+            None
+        """
+
+        self._wait_checkpoint()
+        started = threading.Event()
+        self._cptthread = threading.Thread(target=self._write_checkpoint,
+                                           args=(chk, started))
+        self._cptthread.daemon = True
+        self._cptthread.start()
+
+        # Walkers must not be logged before the checkpoint they belong after
+        started.wait()
+
+    def _write_checkpoint(self, chk, started=None):
+        """
+        Write a checkpoint with the traxlogger.
+
+        Parameters:
+            chk     - the dictionary of values to checkpoint
+            started - a threading.Event to set once the traxlogger is held
+
+        Returns:
+            None
+        """
+
+        cpt = self.traxlogger.cpt_path
+
+        with self._traxlock:
+            if started is not None:
+                started.set()
+
+            # Incremental checkpoints append to the previous one
+            if os.path.exists(cpt) and not self.traxlogger.incremental:
+                shutil.move(cpt, cpt + '.last')
+
+            with self.profiler.span('checkpoint'):
+                self.traxlogger.checkpoint(chk)
+
+        # The statistics are complete up to the checkpoint
+        with self.profiler.span('flush_logs'):
+            self.flush_logs()
+
+    def flush_logs(self):
+        """
+        Write the queued statistics and task output to their log files.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        for logger in (self.statslogger, self.transitionslogger,
+                       self.wq.statslogger, self.wq.taskoutputlogger):
+            logger.flush()
+
+    def _wait_checkpoint(self):
+        """
+        Wait for a background checkpoint to finish.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        if self._cptthread is not None:
+            self._cptthread.join()
+            self._cptthread = None
 
 
     def logwalker(self, walker):
@@ -349,7 +590,8 @@ class AWE(object):
             None
         """
 
-        self.traxlogger.log(walker)
+        with self.profiler.span('logwalker'), self._traxlock:
+            self.traxlogger.log(walker)
 
     def _trax_log_recover(self, obj, value):
         """
@@ -389,6 +631,11 @@ class AWE(object):
             # Get all attributes from the checkpoint
             parms = self.traxlogger.recover(self._trax_log_recover)
 
+            # The task statistics belong to the WorkQueue
+            wqstats = parms.pop('wqstats', None)
+            if wqstats is not None:
+                self.wq.stats.restore(wqstats)
+
             # Reset all AWE parameters
             for a in parms.keys():
                 setattr(self, a, parms[a])
@@ -405,19 +652,44 @@ class AWE(object):
             None
         """
 
-        for walker in self.system.walkers:
-            if walker.end is None:
-                task = self._new_task(walker)
-                self.wq.submit(task)
+        self._cache_topology()
+
+        with self.profiler.span('submit'):
+            for walker in self.system.walkers:
+                if walker.end is None:
+                    task = self._new_task(walker)
+                    self.wq.submit(task)
+
+    def _cache_topology(self):
+        """
+        Write the topology to a PDB file once and add it to the files cached
+        on the workers, so that tasks only need to carry coordinates.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        if self._topologypath is not None:
+            return
+
+        path = os.path.join(self.wq.tmpdir, workqueue.WORKER_TOPOLOGY_NAME)
+        with open(path, 'w') as fd:
+            fd.write(str(self.system.topology))
+
+        self.wq.cfg.cache(path, remotepath=workqueue.WORKER_TOPOLOGY_NAME)
+        self._topologypath = path
 
     @typecheck(Walker)
-    @returns(workqueue.WQ.Task)
-    def _new_task(self, walker):
+    def _new_task(self, walker, tag=None):
         """
         Create a new WorkQueue Task and give it the correct files to run.
 
         Parameters:
             walker - the walker to assign to the task
+            tag    - the tag of the task to duplicate, or None for a new task
 
         Returns:
             A WorkQueue Task instance for running the walker
@@ -425,19 +697,23 @@ class AWE(object):
 
         self.currenttask += 1
 
-        # Give the task an identity
-        task = self.wq.new_task()
-        tag  = self.encode_task_tag(walker)
-        task.specify_tag(tag)
+        with self.profiler.span('new_task'):
+            # Give the task an identity, shared by its duplicates
+            task = self.wq.new_task()
+            if tag is None:
+                tag = self.encode_task_tag(walker)
+            task.specify_tag(tag)
 
         # Give the task the information it needs
-        self.marshal_to_task(walker, task)
+        with self.profiler.span('marshal_to_task'):
+            self.marshal_to_task(walker, task)
         return task
 
     def _try_duplicate_tasks(self):
         """
-        Attempt to duplicate tasks to see if they can be run on idle workers.
-        Useful in the event that some workers are faster.
+        Duplicate the tasks expected to finish latest on idle workers, so
+        that stragglers do not hold up the iteration. See
+        workqueue.ReplicationPolicy.
 
         Parameters:
             None
@@ -446,23 +722,13 @@ class AWE(object):
             None
         """
 
-        i = 0
-        # Duplicate tasks until no more can be duplicated
-        while self.wq.can_duplicate_tasks():
-            i += 1
-            if i > 20: break
+        with self.profiler.span('duplicate_tasks'):
+            if not self.wq.can_duplicate_tasks():
+                return
 
-            # Get a task that can be duplicated if one exists
-            tag = self.wq.select_tag()
-
-            # Return if no tasks can be duplicated
-            if tag is None: break
-
-            # Get walker info, create a new task for it, ans submit the task
-            wid    = self.decode_from_task_tag(tag)['walkerid']
-            walker = self.system.walker(wid)
-            task   = self._new_task(walker)
-            self.wq.submit(task)
+            for tag in self.wq.stragglers():
+                walker = self.system.walker(self.task_record(tag).walkerid)
+                self.wq.duplicate(self._new_task(walker, tag=tag))
 
     def _resubmit(self):
         invalid = self.system.filter_by_valid()
@@ -495,27 +761,71 @@ class AWE(object):
         system = self.system
 
         # Start recording AWE statistics for the receive phase
-        if self._log:
-            self.stats.time_barrier('start')
-
-        # Receive tasks until there are none left to receive
-        while not self.wq.empty:
-            # Get the walker results and store/save them
-            walker = self.wq.recv(self.marshal_from_task, self.mark_invalid_task)
+        self.stats.time_barrier('start')
+
+        # Receive tasks until there are none left to receive. Results are
+        # decoded and walkers logged on the pool, the System is only
+        # changed on this thread.
+        logged = []
+        def decode(task):
+            with self.profiler.span('unpack_task'):
+                return self.unpack_task(task)
+
+        def accept(task, result):
+            with self.profiler.span('marshal_from_task'):
+                walker = self.marshal_from_task(task, result)
             system.set_walker(walker)
-            self.logwalker(walker)
+            logged.append(self.pool.submit(self.logwalker, walker))
 
-            # Attempt to duplicate any slow walkers
+        def idle():
             self._try_duplicate_tasks()
+            self._update_monitor(force=False)
+
+        with self.profiler.span('recv'):
+            asyncio.run(self.wq.receive(decode, accept, self.mark_invalid_task,
+                                        idle = idle,
+                                        pool = self.pool))
+
+            # The walkers must be logged before the next checkpoint
+            for job in logged:
+                job.result()
+
+        report = self.wq.replication_report()
+        if self._verbose:
+            print(time.asctime(), 'Iteration', self.iteration, 'duplicated', report['duplicates'], \
+                  'tasks,', report['wins'], 'returned first, saving about %.1f s' % report['savings'])
+        if self._log:
+            t = stats.time.time()
+            for name in ('duplicates', 'wins', 'savings'):
+                self.statslogger.update(t, 'AWE', 'replication_' + name, report[name])
 
         # Stop recording stats
+        self.stats.time_barrier('stop')
         if self._log:
-            self.stats.time_barrier('stop')
+            self.wq.stats.log_iteration()
         self.wq.clear()
         if self._verbose:
             print(system)
 
 
+    def _update_monitor(self, force=True):
+        """
+        Take a snapshot for the monitor, if any (see monitor.Monitor.update).
+        """
+
+        if self.monitor is not None:
+            self.monitor.update(self, force=force)
+
+    @property
+    def pool(self):
+        """
+        The thread pool used while receiving tasks, started on first use.
+        """
+
+        if self._pool is None:
+            self._pool = futures.ThreadPoolExecutor(max_workers=self.threads)
+        return self._pool
+
     def _resample(self):
         """
         Perform resampling on the System.
@@ -528,15 +838,67 @@ class AWE(object):
         """
         #print("in AWE._resample()")
         # Keep track of how long it takes to resample
-        if self._log:
-            self.stats.time_resample('start')
+        self.stats.time_resample('start')
 
-        self.system = self.resample(self.system)
+        with self.profiler.span('resample'):
+            self.system = self.resample(self.system)
 
-        if self._log:
-            self.stats.time_resample('stop')
+        self.stats.time_resample('stop')
+        self._update_monitor()
         #print("done resampling")
 
+    def _begin_iteration(self):
+        """
+        Checkpoint if needed, increment the iteration and submit the walkers
+        of the new iteration.
+
+        In pipeline mode the walkers are submitted first and a copy of the
+        System is checkpointed in the background while their tasks run. The
+        checkpoint is identical to the one written before submitting, since
+        submitting does not change the System. Resampling still waits for
+        every walker to return: walkers may move to any cell, so the walkers
+        of a cell are only known at the barrier.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        # Update the checkpoint
+        chk = None
+        if self.iteration % self.checkpointfreq == 0:
+            if self._verbose:
+                print(time.asctime(), 'Checkpointing to', self.traxlogger.cpt_path)
+            if self.pipeline:
+                with self.profiler.span('checkpoint_copy'):
+                    chk = self._checkpoint_state(copy=True)
+            else:
+                self.checkpoint()
+
+        # Increment the iteration
+        self.iteration += 1
+        self.profiler.iteration(self.iteration)
+
+        # Log statistics to file
+        if self._verbose:
+            print(time.asctime(), 'Iteration', self.iteration, 'with', len(self.system), 'walkers')
+        if self._log:
+            runtime = stats.time.time()
+            self.statslogger.update(runtime, 'AWE', 'iteration', self.iteration)
+            self.statslogger.update(runtime, 'AWE', 'walkers', len(self.system))
+
+        self.stats.time_iter('start')
+
+        self._submit()
+        self._update_monitor()
+
+        # Write the checkpoint of the state from before the iteration while
+        # its tasks run
+        if chk is not None:
+            self._start_checkpoint(chk)
+
     def run(self):
         """
         Run the AWE-WQ program.
@@ -558,13 +920,17 @@ class AWE(object):
 
         # Ensure that the system actually has data to run
         assert len(self.system.cells) > 0
-        assert len(self.system.walkers) > 0
+        assert len(self.system) > 0
 
         # Begin recording log information
         if self._log:
             t = time.time()
             self.statslogger.update(t, 'AWE', 'start_unix_time', t)
 
+        if self.monitor is not None:
+            self.monitor.start()
+            self._update_monitor()
+
         # Run hte specified iterations number of iterations and exit on ctrl+c
         try:
             while self.iteration < self.iterations:
@@ -574,51 +940,42 @@ class AWE(object):
                 #print("MaxRSS Memory: %s" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
                 #m = input("Press enter")
 
-                # Update the checkpoint
-                if self.iteration % self.checkpointfreq == 0:
-                    if self._verbose:
-                        print(time.asctime(), 'Checkpointing to', self.traxlogger.cpt_path)
-                    self.checkpoint()
-
-                # Increment the iteration
-                self.iteration += 1
+                # Start the iteration: checkpoint and submit the walkers
+                self._begin_iteration()
 
-                # Log statistics to file
-                if self._verbose:
-                    print(time.asctime(), 'Iteration', self.iteration, 'with', len(self.system.walkers), 'walkers')
-                if self._log:
-                    runtime = stats.time.time()
-                    self.statslogger.update(runtime, 'AWE', 'iteration', self.iteration)
-                    self.statslogger.update(runtime, 'AWE', 'walkers', len(self.system.walkers))
-
-                    self.stats.time_iter('start')
-
-                # Send, receive, and resample (a.k.a. the actual work)
-                self._submit()
+                # Receive and resample (a.k.a. the actual work)
                 self._recv()     ## barrier
+                self._wait_checkpoint()
                 self._resample()
 
-                if self._log:
-                    self.stats.time_iter('stop')
+                self.stats.time_iter('stop')
 
 
         except KeyboardInterrupt:
             pass
 
+        finally:
+            self._wait_checkpoint()
+            self.flush_logs()
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+            self.resample.shutdown()
+            if self.monitor is not None:
+                self.monitor.stop()
+            self.profiler.dump()
+
         # except Exception, e:
         #     print 'Failed:', e
         #     import sys
         #     sys.exit(1)
 
 
-    # @typecheck(int, int)
-    # @returns(str)
     def encode_task_tag(self, walker):
         """
-        Encode a walker as the identifier for a task. The tag contains relevant
-        information from the task to determine which walker was processed
-        independent of the walker object itself (which is included as a .pkl
-        file in the task).
+        Register a new task for a walker and get its tag. The tag is a short
+        opaque id; what the task runs is kept in the task registry of the
+        WorkQueue (see workqueue.TaskRegistry and task_record).
 
         Parameters:
             walker - the walker to be encoded for a task
@@ -627,14 +984,8 @@ class AWE(object):
             The tag for a task
         """
 
-        tag = '%(outfile)s+%(cellid)d+%(weight)f+%(walkerid)d' % {
-            'outfile' : os.path.join(self.wq.tmpdir, workqueue.RESULT_NAME),
-            'cellid'  : walker.assignment,
-            'weight'  : walker.weight,
-            'walkerid' : walker.id
-        }
-
-        return tag
+        return self.wq.tasks.new(walker.id, self.iteration,
+                                 walker.assignment, walker.weight)
 
     @typecheck(str)
     @returns(dict)
@@ -648,17 +999,26 @@ class AWE(object):
         Returns:
             A dictionary containing sufficient information to identify a walker
         """
-        # print(tag)
-        split = tag.split('+')
-        outfile, cellid, weight, walkerid = tag.split('+')
-        return {'cellid'   : int(cellid)   ,
-                'weight'   : float(weight) ,
-                'walkerid' : int(walkerid) ,
-                'outfile'  : outfile       }
 
+        record = self.task_record(tag)
+        return {'cellid'    : record.cellid    ,
+                'weight'    : record.weight    ,
+                'walkerid'  : record.walkerid  ,
+                'iteration' : record.iteration }
+
+    def task_record(self, tag):
+        """
+        Get the record of a task from its tag.
+
+        Parameters:
+            tag - the tag of the task
 
+        Returns:
+            The workqueue.TaskRecord of the task
+        """
+
+        return self.wq.tasks[tag]
 
-    @typecheck(int, workqueue.WQ.Task)
     def marshal_to_task(self, walker, task):
         """
         Prepare all of the necessary files to send with a task to a worker.
@@ -671,99 +1031,55 @@ class AWE(object):
             None
         """
 
-        # Convert the topology to a PDB format
-        top        = self.system.topology
-        top.coords = walker.start
-        pdbdat     = str(top)
-
-        # Serialize the walker
-        #wdat = pickle.dumps(walker).decode('raw_unicode_escape')
-        #pkl_name = os.path.join(workqueue.PICKLE_BASE, "walker"+int.__str__(walker.id)+".pkl")
-        #pkl_file = open(pkl_name, 'wb')
-        #pickle.dump(walker, pkl_file)
-        #pkl_file.close()
-
-        # Send the the topology and walker to the worker
+        # Send the walker coordinates to the worker, which combines them
+        # with its cached copy of the topology
         # See cctools work_queue.Task for more information
         task.specify_buffer(
-            pdbdat,
-            #"structure.pdb",
-            #sys.getsizeof(pdbdat),
-            workqueue.WORKER_POSITIONS_NAME+"."+int.__str__(self.currenttask),
+            payload.pack_walker(walker.id, walker.start),
+            workqueue.WORKER_PAYLOAD_NAME+"."+int.__str__(self.currenttask),
             cache=False
         )
 
-        #task.specify_file(
-        #    pkl_name,
-        #    #sys.getsizeof(wdat),
-        #    workqueue.WORKER_WALKER_NAME+"."+int.__str__(self.currenttask),
-        #    0, # WORK_QUEUE_INPUT
-        #    cache=False)
+        # The task prints its result on its output instead of returning a
+        # file (see payload.find_result)
 
-        self.specify_task_output_file(task)
-
-    def specify_task_output_file(self, task):
+    def unpack_task(self, result):
         """
-        Tell the task where to place its output.
+        Decode the result printed on the output of a task. Does not change
+        the state of the AWE instance, so it may run on any thread.
 
         Parameters:
-            task - the task for which to set an output dir
+            result - a completed task containing output
 
         Returns:
-            None
+            The cell id and the ending coordinates (see payload.unpack_result)
         """
 
-        output = os.path.join(self.wq.tmpdir, task.tag)
-        task.specify_output_file(output, remote_name = workqueue.WORKER_RESULTS_NAME+"."+int.__str__(self.currenttask), cache=False)
+        return payload.unpack_result(payload.find_result(result.output))
 
-    @typecheck(workqueue.WQ.Task)
     @returns(Walker)
-    def marshal_from_task(self, result):
+    def marshal_from_task(self, result, unpacked=None):
         """
-        Get files returned from a task.
+        Get files returned from a task. May run while Work Queue is waited
+        on (see workqueue.WorkQueue.receive), so it must not use self.wq.wq.
 
         Parameters:
-            result - a completed task containing output
+            result   - a completed task containing output
+            unpacked - the result of unpack_task for the task, if already
+                       decoded
 
         Returns:
             The walker that was sent along with the task updated to include
             result information
         """
 
-        # The output file is compressed, so untar it and get the relevant info
-        import tarfile
-        #if tarfile.is_tarfile(result.tag):
-        #    print("%s is a valid tarfile" % result.tag)
-        #else:
-        #    print("Invalid tarfile: %s" % result.tag)
-        tag_info = self.decode_from_task_tag(result.tag)
-        print(tag_info)
-        tar = tarfile.open(result.tag)
-        try:
-            #walkerstr         = tar.extractfile(workqueue.WORKER_WALKER_NAME).read()
-            #print(walkerstr)
-
-            pdbstring         = tar.extractfile(workqueue.RESULT_POSITIONS).read()
-            # print(pdbstring)
-
-            cellstring        = tar.extractfile(workqueue.RESULT_CELL).read()
-            # print(cellstring)
-        finally:
-            tar.close()
-
-        # Get the coordinates from the ending configuration of the walker
-        pdb               = structures.PDB(pdbstring.decode("utf-8"))
-        # print("Got the pdb")
-        coords            = pdb.coords
-        # print("Got the coordinates")
+        # The output of the task holds the ending coordinates and the cell id
+        record = self.task_record(result.tag)
+        if unpacked is None:
+            unpacked = self.unpack_task(result)
+        cellid, coords = unpacked
 
-        # Get the cell id for the ending coordinates
-        cellid            = int(cellstring.decode("utf-8"))
-        # print("Got the cell id")
-
-        # Load the walker object from the .pkl file
-        # print(tag_info["walkerid"])
-        walker            = self.system.walker(tag_info["walkerid"])#pickle.loads(walkerstr)
+        walker            = self.system.walker(record.walkerid)
         # print("Got the walker from system")
 
         # Determine whether or not the walker changed states
@@ -774,11 +1090,19 @@ class AWE(object):
                 print(time.asctime(), 'Iteration', self.iteration, '/', self.iterations, \
                       'Walker', walker.id, \
                       'transition', walker.assignment, '->', cellid, \
-                      self.wq.tasks_in_queue(), 'tasks remaining')
+                      self.wq.queued, 'tasks remaining')
             #pkl_name = "walker"+int.__str__(walker.id)+".pkl"
             #os.remove(workqueue.PICKLE_BASE+pkl_name)
             # Log the walker
-            if self._log:
+            if self._log and self.metrics:
+                self.transitionslogger.record(time.time(), 'TRANSITION',
+                                              [('iteration' , self.iteration),
+                                               ('walker'    , walker.id),
+                                               ('from_cell' , walker.assignment),
+                                               ('to_cell'   , cellid),
+                                               ('transition', int(transition))],
+                                              task=result.tag, host=result.host)
+            elif self._log:
                 self.transitionslogger.update(time.time(), 'AWE', 'cell_transition',
                                       'iteration %s from %s to %s %s' % \
                                           (self.iteration, walker.assignment, cellid, transition))
@@ -787,13 +1111,10 @@ class AWE(object):
             walker.end        = coords
             walker.assignment = cellid
 
-        os.unlink(result.tag)
         return walker
 
-    @typecheck(workqueue.WQ.Task)
     def mark_invalid_task(self, task):
-        tag_info = self.decode_from_task_tag(task.tag)
-        walker = self.system.walker(tag_info["walkerid"])
+        walker = self.system.walker(self.task_record(task.tag).walkerid)
         walker.mark_invalid()
 
 
@@ -855,9 +1176,560 @@ class Cell(object):
 
 
 
+class WalkerTable(object):
+    """
+    Columnar storage for the walkers of a System.
+
+    Each walker occupies one row. The scalar properties of the walkers are
+    kept in contiguous numpy columns and the atomic coordinates in
+    preallocated (capacity, natoms, ndim) float32 blocks, so that per-walker
+    data can be read for all walkers at once without visiting Walker objects.
+    Rows are never removed; Walker instances handed out by the table are
+    views into a row (see Walker._view).
+
+    The table also maintains secondary indexes from cell assignment and from
+    color to the set of rows holding walkers with that assignment or color.
+    They are kept up to date by every mutator, so looking up the walkers of
+    a cell or color does not require scanning the table.
+
+    Fields:
+        ids         - the id of the walker in each row
+        initids     - the id of each walker at initialization
+        parents     - the id of the walker each walker was restarted from
+                      (-1 if unknown)
+        assignments - the cell assignment of each walker (-1 if unassigned)
+        cellids     - the id of the cell each walker is in (-1 if unknown)
+        colors      - the color of each walker
+        weights     - the weight of each walker (nan if unknown)
+        valid       - whether or not each walker is valid
+        starts      - the starting coordinates of each walker
+        ends        - the ending coordinates of each walker
+        hasstart    - whether or not each walker has starting coordinates
+        hasend      - whether or not each walker has ending coordinates
+
+    Methods:
+        row        - get the row of a walker by id
+        view       - get a Walker view of a row
+        views      - get Walker views of all rows
+        set        - add or update a walker
+        extend     - add or update all walkers from another WalkerTable
+        column     - get a copy of a column for all walkers
+        cellrows   - get the rows of the walkers assigned to a cell
+        colorrows  - get the rows of the walkers of a color
+        take       - make a new table from a subset of rows
+        restart    - restart the walkers in a subset of rows
+        set_colors - set the color of the walkers in a subset of rows
+        copy       - make a copy of the table
+    """
+
+    _NULL = -1
+
+    _COLUMNS = (('ids'         , np.int64  , 0),
+                ('initids'     , np.int64  , 0),
+                ('parents'     , np.int64  , _NULL),
+                ('assignments' , np.int64  , _NULL),
+                ('cellids'     , np.int64  , _NULL),
+                ('colors'      , np.int64  , _DEFAULT_COLOR),
+                ('weights'     , np.float64, np.nan),
+                ('valid'       , np.bool_  , True),
+                ('hasstart'    , np.bool_  , False),
+                ('hasend'      , np.bool_  , False))
+
+    def __init__(self, capacity=64):
+        """
+        Initialize a new, empty instance of WalkerTable.
+
+        Parameters:
+            capacity - the initial number of rows to allocate
+
+        Returns:
+            None
+        """
+
+        self._size     = 0
+        self._capacity = max(1, capacity)
+        self._rows     = dict()    # walker id -> row
+
+        for name, dtype, fill in self._COLUMNS:
+            setattr(self, name, np.full(self._capacity, fill, dtype=dtype))
+
+        # Allocated once the shape of the coordinates is known
+        self.starts    = None
+        self.ends      = None
+
+        # Secondary indexes: assignment -> rows, color -> rows
+        self._bycell   = dict()
+        self._bycolor  = dict()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, wid):
+        return wid in self._rows
+
+    def __getstate__(self):
+        """
+        See Python docs on the pickle module for more info on __getstate__
+        Only the rows in use are pickled.
+        """
+
+        n     = self._size
+        odict = dict(_size=n)
+        for name, _, _ in self._COLUMNS:
+            odict[name] = getattr(self, name)[:n].copy()
+        for name in ('starts', 'ends'):
+            block = getattr(self, name)
+            odict[name] = None if block is None else block[:n].copy()
+        return odict
+
+    def __setstate__(self, odict):
+        """
+        See Python docs on the pickle module for more info on __setstate__
+        """
+
+        self.__dict__.update(odict)
+
+        # Tables pickled before a column was added get its default value
+        for name, dtype, fill in self._COLUMNS:
+            if name not in odict:
+                setattr(self, name, np.full(self._size, fill, dtype=dtype))
+
+        self._capacity = self._size
+        self._rows     = dict((wid, row) for row, wid in enumerate(self.ids[:self._size].tolist()))
+        self._reindex()
+        self._grow(1)
+
+    def _reindex(self):
+        """
+        Rebuild the secondary indexes from the assignment and color columns.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        self._bycell  = dict()
+        self._bycolor = dict()
+        self._index_rows(range(self._size))
+
+    def _index_rows(self, rows):
+        """
+        Add rows that are not yet indexed to the secondary indexes.
+
+        Parameters:
+            rows - an iterable of row indices
+
+        Returns:
+            None
+        """
+
+        for row in rows:
+            self._bycell.setdefault(int(self.assignments[row]), set()).add(row)
+            self._bycolor.setdefault(int(self.colors[row]), set()).add(row)
+
+    @staticmethod
+    def _move(index, row, old, new):
+        """
+        Move a row from one key of a secondary index to another, dropping
+        keys that no longer have any rows.
+        """
+
+        rows = index.get(old)
+        if rows is not None:
+            rows.discard(row)
+            if not rows:
+                del index[old]
+        index.setdefault(new, set()).add(row)
+
+    @property
+    def natoms(self):
+        return None if self.starts is None else self.starts.shape[1]
+
+    def _grow(self, n):
+        """
+        Ensure that there is room for at least *n* more rows by doubling the
+        capacity of every column as needed.
+
+        Parameters:
+            n - the number of rows that are about to be added
+
+        Returns:
+            None
+        """
+
+        needed = self._size + n
+        if needed <= self._capacity:
+            return
+
+        capacity = max(1, self._capacity)
+        while capacity < needed:
+            capacity *= 2
+
+        for name, dtype, fill in self._COLUMNS:
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+        for name in ('starts', 'ends'):
+            old = getattr(self, name)
+            if old is not None:
+                new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:self._size] = old[:self._size]
+                setattr(self, name, new)
+
+        self._capacity = capacity
+
+    def _ensure_coords(self, crds):
+        """
+        Allocate the coordinate blocks from the shape of the first set of
+        coordinates seen and check that later coordinates match it.
+
+        Parameters:
+            crds - a (natoms, ndim) array of coordinates
+
+        Returns:
+            None
+        """
+
+        shape = np.shape(crds)
+        if self.starts is None:
+            self.starts = np.zeros((self._capacity,) + shape, dtype=np.float32)
+            self.ends   = np.zeros((self._capacity,) + shape, dtype=np.float32)
+        elif shape != self.starts.shape[1:]:
+            raise ValueError('Walker coordinates have shape %s, expected %s' % \
+                                 (shape, self.starts.shape[1:]))
+
+    def row(self, wid):
+        """
+        Get the row of a walker.
+
+        Parameters:
+            wid - the id of the walker
+
+        Returns:
+            The row index of the walker
+
+        Raises:
+            KeyError if the walker is not in the table
+        """
+
+        return self._rows[wid]
+
+    def view(self, row):
+        return Walker._view(self, row)
+
+    def views(self):
+        return [Walker._view(self, row) for row in range(self._size)]
+
+    def column(self, name, rows=None):
+        """
+        Get a copy of a column for all walkers in the table.
+
+        Parameters:
+            name - the name of the column (e.g. 'weights')
+            rows - if given, only get the entries of these rows
+
+        Returns:
+            A numpy.array with one entry per walker
+        """
+
+        if rows is None:
+            return getattr(self, name)[:self._size].copy()
+        return getattr(self, name)[rows]
+
+    def cellrows(self, cid):
+        """
+        Get the rows of all walkers assigned to a cell.
+
+        Parameters:
+            cid - the id of the cell
+
+        Returns:
+            A sorted numpy.array of row indices
+        """
+
+        return np.array(sorted(self._bycell.get(cid, ())), dtype=np.int64)
+
+    def colorrows(self, color):
+        """
+        Get the rows of all walkers of a color.
+
+        Parameters:
+            color - the color
+
+        Returns:
+            A sorted numpy.array of row indices
+        """
+
+        return np.array(sorted(self._bycolor.get(color, ())), dtype=np.int64)
+
+    @property
+    def indexed_cells(self):
+        return list(self._bycell.keys())
+
+    @property
+    def indexed_colors(self):
+        return list(self._bycolor.keys())
+
+    ### scalar accessors translating the null sentinels back to None
+
+    def assignment(self, row):
+        a = int(self.assignments[row])
+        return None if a == self._NULL else a
+
+    def cellid(self, row):
+        c = int(self.cellids[row])
+        return None if c == self._NULL else c
+
+    def weight(self, row):
+        w = float(self.weights[row])
+        return None if w != w else w
+
+    def start(self, row):
+        return self.starts[row] if self.hasstart[row] else None
+
+    def end(self, row):
+        return self.ends[row] if self.hasend[row] else None
+
+    ### mutators
+
+    def set_assignment(self, row, asn):
+        asn = self._NULL if asn is None else int(asn)
+        self._move(self._bycell, row, int(self.assignments[row]), asn)
+        self.assignments[row] = asn
+
+    def set_color(self, row, color):
+        color = int(color)
+        self._move(self._bycolor, row, int(self.colors[row]), color)
+        self.colors[row] = color
+
+    def set_valid(self, row, valid):
+        self.valid[row] = valid
+
+    def set_start(self, row, crds):
+        if crds is None:
+            self.hasstart[row] = False
+        else:
+            self._ensure_coords(crds)
+            self.starts[row]   = crds
+            self.hasstart[row] = True
+
+    def set_end(self, row, crds):
+        if crds is None:
+            self.hasend[row] = False
+        else:
+            self._ensure_coords(crds)
+            self.ends[row]   = crds
+            self.hasend[row] = True
+
+    def _write(self, row, walker):
+        """
+        Copy the state of a walker into a row.
+
+        Parameters:
+            row    - the row to write
+            walker - a Walker (detached or a view into any table)
+
+        Returns:
+            None
+        """
+
+        weight = walker.weight
+        cellid = walker.cellid
+
+        self.ids[row]     = walker.id
+        self.initids[row] = walker.initid
+        self.cellids[row] = self._NULL if cellid is None else cellid
+        self.weights[row] = np.nan if weight is None else weight
+        self.set_assignment(row, walker.assignment)
+        self.set_color(row, walker.color)
+        self.set_valid(row, walker.valid)
+        self.set_start(row, walker.start)
+        self.set_end(row, walker.end)
+
+    def set(self, walker):
+        """
+        Add a walker to the table or update the row of a walker already in
+        it. A view into this table is already up to date.
+
+        Parameters:
+            walker - the walker to store
+
+        Returns:
+            The row of the walker
+        """
+
+        if walker._table is self:
+            return walker._row
+
+        wid = walker.id
+        if wid in self._rows:
+            row = self._rows[wid]
+        else:
+            self._grow(1)
+            row = self._size
+            self._size += 1
+            self._rows[wid] = row
+            self._index_rows((row,))
+
+        self._write(row, walker)
+        return row
+
+    def extend(self, other):
+        """
+        Add or update every walker of another table. Walkers that are not
+        yet in this table are copied in bulk.
+
+        Parameters:
+            other - a WalkerTable
+
+        Returns:
+            None
+        """
+
+        n = len(other)
+        if n == 0:
+            return
+
+        ids   = other.ids[:n].tolist()
+        isnew = np.array([wid not in self._rows for wid in ids], dtype=bool)
+
+        # Update the walkers that are already present one at a time
+        for row in np.flatnonzero(~isnew):
+            self.set(other.view(row))
+
+        src = np.flatnonzero(isnew)
+        if len(src) == 0:
+            return
+
+        self._grow(len(src))
+        dst = np.arange(self._size, self._size + len(src))
+
+        for name, _, _ in self._COLUMNS:
+            getattr(self, name)[dst] = getattr(other, name)[src]
+
+        if other.starts is not None:
+            self._ensure_coords(other.starts[0])
+            self.starts[dst] = other.starts[src]
+            self.ends[dst]   = other.ends[src]
+
+        for row, i in zip(dst.tolist(), src.tolist()):
+            self._rows[ids[i]] = row
+        self._size += len(src)
+        self._index_rows(dst.tolist())
+
+    def take(self, rows):
+        """
+        Make a new table containing copies of a subset of rows.
+
+        Parameters:
+            rows - a sequence of row indices
+
+        Returns:
+            A new WalkerTable
+        """
+
+        rows  = np.asarray(rows, dtype=np.int64)
+        table = WalkerTable.__new__(WalkerTable)
+        odict = dict(_size=len(rows))
+        for name, _, _ in self._COLUMNS:
+            odict[name] = getattr(self, name)[rows]
+        for name in ('starts', 'ends'):
+            block = getattr(self, name)
+            odict[name] = None if block is None else block[rows]
+        table.__setstate__(odict)
+        return table
+
+    def restart(self, rows, weights):
+        """
+        Restart many walkers at once. This is the bulk equivalent of calling
+        Walker.restart on the walker in each row.
+
+        Parameters:
+            rows    - a sequence of row indices, which may repeat
+            weights - the weight of each new walker
+
+        Returns:
+            A new WalkerTable containing the restarted walkers, which start
+            from the ending coordinates of the walkers in *rows*
+        """
+
+        global _WALKER_ID
+
+        rows = np.asarray(rows, dtype=np.int64)
+        n    = len(rows)
+        assert self.hasstart[rows].all() and self.hasend[rows].all()
+
+        odict = dict(_size=n)
+        for name, _, _ in self._COLUMNS:
+            odict[name] = getattr(self, name)[rows]
+
+        # Assign the walkers new ids
+        odict['parents']  = self.ids[rows]
+        odict['ids']      = np.arange(_WALKER_ID, _WALKER_ID + n, dtype=np.int64)
+        _WALKER_ID       += n
+
+        odict['weights']  = np.asarray(weights, dtype=np.float64).copy()
+        odict['valid']    = np.ones(n, dtype=np.bool_)
+        odict['hasend']   = np.zeros(n, dtype=np.bool_)
+        if self.ends is None:
+            odict['starts'] = odict['ends'] = None
+        else:
+            odict['starts'] = self.ends[rows]
+            odict['ends']   = np.zeros_like(odict['starts'])
+
+        table = WalkerTable.__new__(WalkerTable)
+        table.__setstate__(odict)
+        return table
+
+    def set_colors(self, rows, colors):
+        """
+        Set the color of the walkers in several rows.
+
+        Parameters:
+            rows   - a sequence of row indices
+            colors - the new color of each walker
+
+        Returns:
+            None
+        """
+
+        for row, color in zip(np.asarray(rows).tolist(), np.asarray(colors).tolist()):
+            self.set_color(row, color)
+
+    def copy(self):
+        """
+        Make a copy of the table.
+
+        Parameters:
+            None
+
+        Returns:
+            A new WalkerTable with copies of all rows
+        """
+
+        table = WalkerTable.__new__(WalkerTable)
+        table.__setstate__(self.__getstate__())
+        return table
+
+
+
 class System(object):
     """
-    Contains all information for a working Weighted Ensemble system.
+    Contains all information for a working Weighted Ensemble system. Walkers
+    are stored in a columnar WalkerTable; the Walker instances returned by
+    the System are views into it.
+
+    The filter_* methods return lightweight Systems that share the
+    WalkerTable of the System they were filtered from and only select a
+    subset of its rows, found through the secondary indexes of the table.
+    Updating a walker through such a view updates the parent System; adding
+    a walker or another System to a view first copies the selected rows so
+    that the parent is left untouched. The selection of a view is fixed when
+    it is created.
 
     Fields:
         topology - the topology of the molecule represented by walkers
@@ -872,10 +1744,15 @@ class System(object):
         set_walker      - set the state of a walker in the system
         cell            - get a particular cell from the system
         has_cell        - determine if a cell is in the system
+        column          - get a column of the walker table for this system
+        restart         - restart many walkers at once
+        set_colors      - set the color of many walkers at once
         filter_by_cell  - filter the walker list by walker cell id
         filter_by_color - filter the walker list by walker color
         filter_by_core  - filter the cell list by cell core
-        clone           - make a copy of the system
+        filter_by_valid - find the invalid walkers of each cell
+        clone           - make a copy of the system without its walkers
+        copy            - make a copy of the system with its walkers
     """
 
     def __init__(self, topology=None, cells=None):
@@ -890,24 +1767,135 @@ class System(object):
             None
         """
 
-        self._topology = topology
-        self._cells    = cells or dict()
-        self._walkers  = dict()
+        self._topology  = topology
+        self._cells     = cells or dict()
+        self._walkers   = WalkerTable()
+
+        # Rows of the walker table selected by a filtered view (None for
+        # all rows) and the (cell ids, color) filter that selected them
+        self._selection = None
+        self._where     = (None, None)
 
+        # Secondary index: cell core -> cell ids
+        self._reindex_cores()
+
+    def __getstate__(self):
+        """
+        See Python docs on the pickle module for more info on __getstate__
+        Filtered views are pickled as standalone Systems.
+        """
+
+        odict = self.__dict__.copy()
+        del odict['_bycore']
+        if self._selection is not None:
+            odict['_walkers']   = self._walkers.take(self._selection)
+            odict['_selection'] = None
+            odict['_where']     = (None, None)
+        return odict
+
+    def __setstate__(self, odict):
+        """
+        See Python docs on the pickle module for more info on __setstate__
+        """
+
+        self.__dict__.update(odict)
+        self.__dict__.setdefault('_selection', None)
+        self.__dict__.setdefault('_where', (None, None))
+        self._reindex_cores()
 
     def __str__(self):
         return '<System: topology=%s, ncells=%s, nwalkers=%s>' % \
-            (type(self.topology), len(self._cells), len(self._walkers))
+            (type(self._topology), len(self._cells), len(self))
 
     def __repr__(self):
         return 'System(topology=%r, cells=%r)' % (self._topology, self._cells)
 
+    def __len__(self):
+        if self._selection is None:
+            return len(self._walkers)
+        return len(self._selection)
+
     def __iadd__(self, other):
-        self._cells.update(other._cells)
-        self._walkers.update(other._walkers)
+        if self._selection is not None:
+            self._materialize()
+
+        for cell in other.cells:
+            self.set_cell(cell)
+
+        if other._selection is None:
+            self._walkers.extend(other._walkers)
+        else:
+            self._walkers.extend(other._walkers.take(other._selection))
 
         return self
 
+    def _reindex_cores(self):
+        """
+        Rebuild the core -> cell ids index from the cell dictionary.
+        """
+
+        self._bycore = dict()
+        for cid, cell in self._cells.items():
+            self._bycore.setdefault(cell.core, set()).add(cid)
+
+    def _materialize(self):
+        """
+        Turn a filtered view into a standalone System by copying the
+        selected rows into a new WalkerTable.
+        """
+
+        self._walkers   = self._walkers.take(self._selection)
+        self._selection = None
+        self._where     = (None, None)
+
+    def _view(self, cells, cellids=None, color=None):
+        """
+        Create a filtered view sharing this System's walker table.
+
+        Parameters:
+            cells   - the cell dictionary of the view
+            cellids - a set of cell ids the walkers must be assigned to, or
+                      None to not filter by cell
+            color   - the color the walkers must have, or None to not
+                      filter by color
+
+        Returns:
+            A new System instance
+        """
+
+        # Combine with the filter that created this view, if any
+        oldcells, oldcolor = self._where
+        if oldcells is not None:
+            cellids = oldcells if cellids is None else cellids & oldcells
+        if oldcolor is not None and color is not None and oldcolor != color:
+            cellids = frozenset()
+        elif oldcolor is not None:
+            color = oldcolor
+
+        # Start from the smallest index and check the remaining filter
+        table = self._walkers
+        if cellids is not None:
+            parts = [table.cellrows(cid) for cid in cellids]
+            if len(parts) == 1:
+                rows = parts[0]
+            else:
+                rows = np.sort(np.concatenate(parts + [np.zeros(0, dtype=np.int64)]))
+            if color is not None:
+                rows = rows[table.colors[rows] == color]
+        elif color is not None:
+            rows = table.colorrows(color)
+        else:
+            rows = None
+
+        view            = System.__new__(System)
+        view._topology  = self._topology
+        view._cells     = cells
+        view._walkers   = table
+        view._selection = rows
+        view._where     = (cellids, color)
+        view._reindex_cores()
+        return view
+
 
     @property
     def topology(self): return self._topology.copy()
@@ -920,7 +1908,9 @@ class System(object):
     @property
     @returns(list)
     def walkers(self):
-        return list(self._walkers.values())
+        if self._selection is None:
+            return self._walkers.views()
+        return [self._walkers.view(row) for row in self._selection.tolist()]
 
     @property
     # @returns(np.array)
@@ -929,7 +1919,7 @@ class System(object):
         Get the weights of all walkers in the System.
         """
 
-        return np.array(list(map(lambda w: w.weight, self.walkers)))
+        return self.column('weights')
 
     @property
     @returns(set)
@@ -938,7 +1928,66 @@ class System(object):
         Get the colors of all walkers in the System.
         """
 
-        return set([w.color for w in self.walkers])#set(map(lambda w: w.color, self.walkers))
+        return set(np.unique(self.column('colors')).tolist())
+
+    def column(self, name):
+        """
+        Get a copy of a column of the walker table for the walkers in the
+        System.
+
+        Parameters:
+            name - the name of the column (see WalkerTable)
+
+        Returns:
+            A numpy.array with one entry per walker
+        """
+
+        return self._walkers.column(name, rows=self._selection)
+
+    def _rows(self, positions):
+        """
+        Translate positions in the columns of this System into rows of the
+        walker table.
+        """
+
+        positions = np.asarray(positions, dtype=np.int64)
+        if self._selection is None:
+            return positions
+        return self._selection[positions]
+
+    def restart(self, positions, weights):
+        """
+        Restart many walkers of the System at once.
+
+        Parameters:
+            positions - the positions of the walkers to restart in the
+                        columns of this System (see column); a walker
+                        restarted several times is split
+            weights   - the weight of each restarted walker
+
+        Returns:
+            A new System instance, without cells, containing the restarted
+            walkers
+        """
+
+        system = System(topology=self._topology)
+        system._walkers = self._walkers.restart(self._rows(positions), weights)
+        return system
+
+    def set_colors(self, positions, colors):
+        """
+        Set the color of several walkers of the System.
+
+        Parameters:
+            positions - the positions of the walkers in the columns of this
+                        System (see column)
+            colors    - the new color of each walker
+
+        Returns:
+            None
+        """
+
+        self._walkers.set_colors(self._rows(positions), colors)
 
     @typecheck(Cell)
     def add_cell(self, cell):
@@ -968,7 +2017,15 @@ class System(object):
             None
         """
 
+        old = self._cells.get(cell.id)
+        if old is not None:
+            cids = self._bycore[old.core]
+            cids.discard(cell.id)
+            if not cids:
+                del self._bycore[old.core]
+
         self._cells[cell.id] = cell
+        self._bycore.setdefault(cell.core, set()).add(cell.id)
 
     @returns(Walker)
     def walker(self, wid):
@@ -982,7 +2039,7 @@ class System(object):
             The walker with the supplied id or None if it is not in the System
         """
 
-        return self._walkers[wid]
+        return self._walkers.view(self._walkers.row(wid))
 
     @typecheck(Walker)
     def add_walker(self, walker):
@@ -1011,7 +2068,9 @@ class System(object):
             None
         """
 
-        self._walkers[walker.id] = walker
+        if self._selection is not None and walker._table is not self._walkers:
+            self._materialize()
+        self._walkers.set(walker)
 
     @returns(Cell)
     def cell(self, i):
@@ -1051,14 +2110,12 @@ class System(object):
             cell - the cell by which to filter
 
         Returns:
-            A new System instance containing only walkers that are in the
-            supplied cell
+            A System view containing only walkers that are in the supplied
+            cell
         """
 
-        ws     = list([w for w in self.walkers if w.assignment == cell.id])#filter(lambda w: w.assignment == cell.id, self.walkers)
-        newsys = self.clone(cells={cell.id:self.cell(cell.id)})
-        for w in ws: newsys.add_walker(w)
-        return newsys
+        return self._view({cell.id : self.cell(cell.id)},
+                          cellids=frozenset((cell.id,)))
 
     # @returns(System)
     def filter_by_color(self, color):
@@ -1069,20 +2126,11 @@ class System(object):
             color - the color by which to filter
 
         Returns:
-            A new System instance containing only walkers that are of the
-            supplied color
+            A System view containing only walkers that are of the supplied
+            color
         """
 
-        ws     = [w for w in self.walkers if w.color == color]#filter(lambda w: w.color == color, self.walkers)
-        newsys = self.clone()
-
-        for w in ws:
-            newsys.add_walker(w)
-
-            cell = self.cell(w.assignment)
-            newsys.set_cell(cell)
-
-        return newsys
+        return self._view(dict(self._cells), color=color)
 
 
     # @returns(System)
@@ -1094,33 +2142,51 @@ class System(object):
             core - the core by which to filter
 
         Returns:
-            A new System instance containing only cells that are of the
-            supplied core
+            A System view containing only cells that are of the supplied
+            core and the walkers assigned to them
         """
 
-        cells  = [c for c in self.cells if c.core == core]#filter(lambda c: c.core == core, self.cells)
-        cs     = {}
-        for c in cells: cs[c.id] = c
+        cids = frozenset(self._bycore.get(core, ()))
+        return self._view(dict((cid, self._cells[cid]) for cid in cids),
+                          cellids=cids)
 
-        newsys = self.clone(cells=cs)
-        for w in self.walkers:
-            if w.assignment in cs:
-                newsys.add_walker(w)
+    def filter_by_valid(self):
+        """
+        Find the walkers that have been marked invalid.
 
-        return newsys
+        Parameters:
+            None
 
-    def filter_by_valid(self):
-        invalid = {}
-        for c in self.cells:
-            walkers = self.filter_by_cell(c)
-            if len(walkers) > 0:
-                invalid[c.id] = [w for w in walkers if not w.valid]
-        return invalid
+        Returns:
+            A dictionary mapping the id of each cell containing invalid
+            walkers to the list of those walkers
+        """
+
+        rows    = self._selection
+        if rows is None:
+            rows = np.arange(len(self._walkers))
+        rows    = rows[~self._walkers.valid[rows]]
+
+        invalid = defaultdict(list)
+        for row in rows.tolist():
+            walker = self._walkers.view(row)
+            invalid[walker.assignment].append(walker)
+        return dict(invalid)
 
     def get_valid_walker(self, cid):
+        """
+        Choose a random valid walker from a cell.
+
+        Parameters:
+            cid - the id of the cell
+
+        Returns:
+            A valid walker in the cell or None if there are none
+        """
+
         c = self.cell(cid)
-        walkers = [w for w in self.filter_by_cell(c) if w.valid]
-        return walkers[random.randint(0,len(walkers))] if len(walkers) > 0 else None
+        walkers = [w for w in self.filter_by_cell(c).walkers if w.valid]
+        return random.choice(walkers) if len(walkers) > 0 else None
 
     def clone(self, cells=True):
         """
@@ -1128,7 +2194,8 @@ class System(object):
 
         Parameters:
             cells - True to copy the current cell dictionary, False to start
-                    with an empty cell dictionary
+                    with an empty cell dictionary, or a dictionary of cells
+                    to use instead
 
         Returns:
             A new instance of System with the same topology as the caller and
@@ -1136,9 +2203,31 @@ class System(object):
             depending on the supplied flag
         """
 
-        _cells = self._cells if cells else dict()
+        if isinstance(cells, dict):
+            _cells = dict(cells)
+        else:
+            _cells = dict(self._cells) if cells else dict()
         return System(topology=self.topology, cells=_cells)
 
+    def copy(self):
+        """
+        Make a copy of the System including its walkers. The topology is
+        shared with the copy.
+
+        Parameters:
+            None
+
+        Returns:
+            A new instance of System
+        """
+
+        system = System(topology=self._topology, cells=dict(self._cells))
+        if self._selection is None:
+            system._walkers = self._walkers.copy()
+        else:
+            system._walkers = self._walkers.take(self._selection)
+        return system
+
 
 class SinkStates(object):
     """
@@ -0,0 +1,223 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+###############################################################################
+# Incremental checkpoints of AWE.
+#
+# A checkpoint is the dictionary built by AWE._checkpoint_state. With the
+# trax IncrementalTransactional backend only the first checkpoint (and one
+# every few iterations, when the journal is compacted) is a full snapshot.
+# The others are deltas computed by CheckpointDiffer:
+#
+#   - the scalar columns of the walker table are stored whole as raw arrays
+#   - coordinates already known to the recovered state are not stored:
+#     the start of a walker that was checkpointed before, the start of a
+#     walker restarted from a walker whose end is known (its parent), and
+#     the end of a walker whose end was checkpointed or logged
+#   - all other coordinates are stored as raw float32 blocks
+#   - the topology is only stored in snapshots
+#
+# Resampling restarts every walker from the end of its parent, which was
+# logged when its task returned, so a delta normally holds no coordinates.
+###############################################################################
+
+from . import aweclasses
+
+from trax.incremental import Differ, IncrementalTransactional
+
+import numpy as np
+
+
+_NULL = aweclasses.WalkerTable._NULL
+
+
+def _table(system):
+    """
+    Get the WalkerTable holding exactly the walkers of a System.
+    """
+
+    if system._selection is None:
+        return system._walkers
+    return system._walkers.take(system._selection)
+
+def _lookup(table, ids):
+    """
+    Find the rows of walkers in a table.
+
+    Parameters:
+        table - a WalkerTable
+        ids   - an array of walker ids that are all in the table
+
+    Returns:
+        An array with the row of each walker
+    """
+
+    n     = len(table)
+    known = table.ids[:n]
+    order = np.argsort(known, kind='stable')
+    pos   = np.searchsorted(known[order], ids)
+    rows  = order[np.minimum(pos, max(n - 1, 0))]
+    if len(ids) > 0 and not (n > 0 and (known[rows] == ids).all()):
+        raise KeyError('Checkpoint delta refers to walkers that were not recovered')
+    return rows
+
+
+class CheckpointDiffer(Differ):
+    """
+    Computes the deltas between AWE checkpoints for
+    trax.IncrementalTransactional.
+
+    Fields:
+        _startids - the ids of the walkers whose start the recovered state has
+        _endids   - the ids of the walkers whose end the recovered state has
+        _logged   - (id, has start, has end) of the walkers logged since the
+                    last checkpoint
+
+    Methods:
+        reset  - set the state the next delta is computed against
+        logged - note a walker logged after the last checkpoint
+        diff   - compute the delta from the last checkpoint
+        patch  - apply a delta to a recovered checkpoint
+    """
+
+    def __init__(self):
+        self._startids = np.zeros(0, dtype=np.int64)
+        self._endids   = np.zeros(0, dtype=np.int64)
+        self._logged   = []
+
+    def reset(self, value):
+        table = _table(value['system'])
+        n     = len(table)
+        self._startids = table.ids[:n][table.hasstart[:n]].copy()
+        self._endids   = table.ids[:n][table.hasend[:n]].copy()
+        self._logged   = []
+
+    def logged(self, walker):
+        self._logged.append((walker.id, walker.start is not None, walker.end is not None))
+
+    def _known(self):
+        """
+        Get the ids of the walkers whose start and whose end the recovered
+        state has.
+        """
+
+        startids, endids = self._startids, self._endids
+        if self._logged:
+            logged   = np.array(self._logged, dtype=np.int64).reshape(-1, 3)
+            startids = np.concatenate((startids, logged[logged[:,1] != 0, 0]))
+            endids   = np.concatenate((endids,   logged[logged[:,2] != 0, 0]))
+        return startids, endids
+
+    def diff(self, value):
+        """
+        Compute the delta from the last checkpoint to a new checkpoint.
+
+        Parameters:
+            value - the dictionary to checkpoint (see AWE._checkpoint_state)
+
+        Returns:
+            The delta as a dictionary of arrays and the other checkpoint
+            values
+        """
+
+        system = value['system']
+        table  = _table(system)
+        n      = len(table)
+
+        columns = dict((name, getattr(table, name)[:n].copy())
+                       for name, _, _ in aweclasses.WalkerTable._COLUMNS)
+        ids, parents = columns['ids'], columns['parents']
+        hasstart, hasend = columns['hasstart'], columns['hasend']
+
+        startids, endids = self._known()
+        ownstart   = hasstart & np.isin(ids, startids)
+        fromparent = hasstart & ~ownstart & (parents != _NULL) & np.isin(parents, endids)
+        newstart   = hasstart & ~ownstart & ~fromparent
+        ownend     = hasend & np.isin(ids, endids)
+        newend     = hasend & ~ownend
+
+        delta = dict(columns    = columns,
+                     shape      = None if table.starts is None else table.starts.shape[1:],
+                     ownstart   = ownstart,
+                     fromparent = fromparent,
+                     ownend     = ownend,
+                     starts     = None if table.starts is None else table.starts[:n][newstart],
+                     ends       = None if table.ends   is None else table.ends[:n][newend],
+                     cells      = system._cells,
+                     values     = dict((k, v) for k, v in value.items() if k != 'system'))
+
+        self.reset(value)
+        return delta
+
+    def patch(self, value, delta):
+        """
+        Rebuild a checkpoint from the previous recovered checkpoint and a
+        delta.
+
+        Parameters:
+            value - the recovered previous checkpoint
+            delta - the delta returned by diff
+
+        Returns:
+            The recovered checkpoint dictionary
+        """
+
+        old     = value['system']
+        oldtbl  = _table(old)
+        columns = delta['columns']
+        n       = len(columns['ids'])
+
+        odict = dict(columns, _size=n, starts=None, ends=None)
+        if delta['shape'] is not None:
+            starts = np.zeros((n,) + tuple(delta['shape']), dtype=np.float32)
+            ends   = np.zeros_like(starts)
+
+            ownstart, fromparent, ownend = delta['ownstart'], delta['fromparent'], delta['ownend']
+            newstart = columns['hasstart'] & ~ownstart & ~fromparent
+            newend   = columns['hasend'] & ~ownend
+
+            starts[ownstart]   = oldtbl.starts[_lookup(oldtbl, columns['ids'][ownstart])]
+            starts[fromparent] = oldtbl.ends[_lookup(oldtbl, columns['parents'][fromparent])]
+            starts[newstart]   = delta['starts']
+            ends[ownend]       = oldtbl.ends[_lookup(oldtbl, columns['ids'][ownend])]
+            ends[newend]       = delta['ends']
+
+            odict['starts'], odict['ends'] = starts, ends
+
+        table = aweclasses.WalkerTable.__new__(aweclasses.WalkerTable)
+        table.__setstate__(odict)
+
+        system = aweclasses.System.__new__(aweclasses.System)
+        system.__setstate__(dict(_topology  = old._topology,
+                                 _cells     = delta['cells'],
+                                 _walkers   = table,
+                                 _selection = None,
+                                 _where     = (None, None)))
+
+        value = dict(delta['values'])
+        value['system'] = system
+        return value
+
+
+def incremental(checkpoint='debug/trax.cpt', log='debug/trax.log', compact=10):
+    """
+    Create a trax logger writing incremental AWE checkpoints.
+
+    Parameters:
+        checkpoint - the path of the snapshot
+        log        - the path of the journal of deltas and walkers
+        compact    - write a new snapshot after this many deltas
+
+    Returns:
+        A trax.IncrementalTransactional instance
+    """
+
+    return IncrementalTransactional(differ     = CheckpointDiffer(),
+                                    compact    = compact,
+                                    checkpoint = checkpoint,
+                                    log        = log)
@@ -0,0 +1,497 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+###############################################################################
+# Task execution backends for workqueue.WorkQueue.
+#
+# WorkQueueExecutor runs tasks on cctools Work Queue workers. LocalExecutor
+# runs them on this machine in a process pool, each in its own sandbox
+# directory, and does not need cctools. Both hand out task objects with the
+# interface of cctools work_queue.Task that AWE uses.
+###############################################################################
+
+from concurrent import futures
+import contextlib
+import io
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+try:
+    import work_queue as WQ
+except ImportError:
+    WQ = None
+
+
+### File types of specify_file, as in cctools work_queue
+WORK_QUEUE_INPUT  = 0
+WORK_QUEUE_OUTPUT = 1
+
+
+### Task result codes, as in cctools work_queue
+RESULT_SUCCESS        = 0
+RESULT_INPUT_MISSING  = 1
+RESULT_OUTPUT_MISSING = 2
+RESULT_SIGNAL         = 1 << 3
+RESULT_UNKNOWN        = 4 << 3
+
+
+class ExecutorException(Exception): pass
+
+
+class ExecutorStats(object):
+    """
+    The subset of cctools work_queue stats used by AWE.
+
+    Fields:
+        tasks_running - the number of tasks executing
+        tasks_waiting - the number of tasks waiting to execute
+        workers_busy  - the number of workers executing a task
+        workers_ready - the number of idle workers
+    """
+
+    def __init__(self, tasks_running=0, tasks_waiting=0, workers_busy=0, workers_ready=0):
+        self.tasks_running = tasks_running
+        self.tasks_waiting = tasks_waiting
+        self.workers_busy  = workers_busy
+        self.workers_ready = workers_ready
+
+
+class Executor(object):
+    """
+    Interface that all task execution backends should implement.
+
+    Fields:
+        stats - an ExecutorStats-like object describing the queue
+        port  - the port the backend listens on, if any
+        name  - the project name of the backend, if any
+
+    Methods:
+        new_task          - create a task that runs a command
+        submit            - submit a task for execution
+        wait              - wait for a task to complete
+        cancel_by_tasktag - cancel a task with a given tag
+        empty             - determine if there are no outstanding tasks
+        clear             - forget about completed tasks
+        specify_log       - write backend statistics to a file
+        shutdown          - stop the backend
+    """
+
+    port = None
+    name = None
+
+    @property
+    def stats(self):
+        raise NotImplementedError
+
+    def new_task(self, command):
+        raise NotImplementedError
+
+    def submit(self, task):
+        raise NotImplementedError
+
+    def wait(self, timeout=None):
+        raise NotImplementedError
+
+    def cancel_by_tasktag(self, tag):
+        raise NotImplementedError
+
+    def empty(self):
+        raise NotImplementedError
+
+    def clear(self):
+        pass
+
+    def specify_log(self, path):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class WorkQueueExecutor(Executor):
+    """
+    Runs tasks on cctools Work Queue workers.
+
+    Fields:
+        wq - the cctools work_queue.WorkQueue object
+
+    Methods:
+        See Executor
+    """
+
+    def __init__(self, wq):
+        """
+        Initialize a new instance of WorkQueueExecutor.
+
+        Parameters:
+            wq - a cctools work_queue.WorkQueue object
+
+        Returns:
+            None
+        """
+
+        self.wq = wq
+
+    port  = property(lambda self: self.wq.port)
+    name  = property(lambda self: self.wq.name)
+    stats = property(lambda self: self.wq.stats)
+
+    def new_task(self, command):
+        return WQ.Task(command)
+
+    def submit(self, task):
+        return self.wq.submit(task)
+
+    def wait(self, timeout=None):
+        return self.wq.wait(timeout)
+
+    def cancel_by_tasktag(self, tag):
+        return self.wq.cancel_by_tasktag(tag)
+
+    def empty(self):
+        return self.wq.empty()
+
+    def clear(self):
+        # force clearing to allow GC, otherwise linear memory growth
+        self.wq._task_table.clear()
+
+    def specify_log(self, path):
+        self.wq.specify_log(path)
+
+
+class LocalTask(object):
+    """
+    A task for the LocalExecutor with the interface of cctools
+    work_queue.Task.
+
+    The command is either a shell command, run in the sandbox directory of
+    the task, or a picklable Python callable, called with the path of the
+    sandbox as the working directory and returning the exit status.
+
+    Fields:
+        command       - the command to run
+        tag           - the tag of the task
+        id            - the id of the task, set when submitted
+        cores         - the number of cores requested
+        output        - the combined stdout and stderr of the task
+        result        - one of the RESULT_* codes
+        return_status - the exit status of the command
+        host          - always 'localhost'
+        (and the timing fields of cctools work_queue.Task, in microseconds)
+
+    Methods:
+        specify_tag         - set the tag
+        specify_cores       - set the number of cores
+        specify_file        - add an input or output file
+        specify_buffer      - add an input file from a string or bytes
+        specify_input_file  - add an input file
+        specify_output_file - add an output file
+    """
+
+    def __init__(self, command):
+        self.command       = command
+        self.tag           = None
+        self.id            = None
+        self.cores         = 1
+        self._inputs       = []    # (kind, source, remote name, cache)
+        self._outputs      = []    # (local path, remote name)
+        self._reset()
+
+    def _reset(self):
+        self.output                  = ''
+        self.result                  = RESULT_UNKNOWN
+        self.return_status           = -1
+        self.host                    = 'localhost'
+        self.submit_time             = 0
+        self.finish_time             = 0
+        self.send_input_start        = 0
+        self.send_input_finish       = 0
+        self.receive_output_start    = 0
+        self.receive_output_finish   = 0
+        self.cmd_execution_time      = 0
+        self.total_transfer_time     = 0
+        self.total_bytes_transferred = 0
+
+    def specify_tag(self, tag):
+        self.tag = tag
+
+    def specify_cores(self, cores):
+        self.cores = cores
+
+    def specify_file(self, local_name, remote_name=None, type=WORK_QUEUE_INPUT, flags=None, cache=True):
+        remote_name = remote_name or os.path.basename(local_name)
+        if type == WORK_QUEUE_OUTPUT:
+            self.specify_output_file(local_name, remote_name)
+        elif type == WORK_QUEUE_INPUT:
+            self.specify_input_file(local_name, remote_name, cache=cache)
+        else:
+            raise ExecutorException('Unknown file type %r for %s' % (type, local_name))
+
+    def specify_input_file(self, local_name, remote_name=None, flags=None, cache=True):
+        remote_name = remote_name or os.path.basename(local_name)
+        self._inputs.append(('file', local_name, remote_name, cache))
+
+    def specify_buffer(self, buffer, remote_name, flags=None, cache=True):
+        if isinstance(buffer, str):
+            buffer = buffer.encode('utf-8')
+        self._inputs.append(('buffer', bytes(buffer), remote_name, cache))
+
+    def specify_output_file(self, local_name, remote_name=None, flags=None, cache=False):
+        remote_name = remote_name or os.path.basename(local_name)
+        self._outputs.append((local_name, remote_name))
+
+
+def _expand(path):
+    """
+    Substitute $OS and $ARCH in a local path the way Work Queue does.
+    """
+
+    return path.replace('$OS', platform.system()).replace('$ARCH', platform.machine())
+
+def _usec():
+    return int(time.time() * 10**6)
+
+def _run_local_task(command, sandbox, inputs, outputs, cores=1):
+    """
+    Run a task in a sandbox directory. Executed in a LocalExecutor worker
+    process.
+
+    Parameters:
+        command - a shell command or a Python callable
+        sandbox - the directory to run in, created here and removed after
+        inputs  - a list of (kind, source, remote name, cache)
+        outputs - a list of (local path, remote name)
+        cores   - the number of cores of the task, exported to shell
+                  commands as CORES like Work Queue workers do
+
+    Returns:
+        A dictionary of the task result fields
+    """
+
+    res = dict(result=RESULT_SUCCESS, return_status=-1, output='',
+               total_bytes_transferred=0)
+    os.makedirs(sandbox)
+    try:
+        ### stage the inputs
+        res['send_input_start'] = _usec()
+        for kind, source, remote, cache in inputs:
+            target = os.path.join(sandbox, remote)
+            if os.path.lexists(target):
+                # Work Queue also tolerates a file being specified twice
+                continue
+            if kind == 'buffer':
+                with open(target, 'wb') as fd:
+                    fd.write(source)
+                res['total_bytes_transferred'] += len(source)
+                continue
+
+            source = os.path.abspath(_expand(source))
+            if not os.path.exists(source):
+                res['result'] = RESULT_INPUT_MISSING
+                res['output'] = 'Missing input file: %s\n' % source
+                return res
+            if cache:
+                # Cached files are shared between tasks, as on a worker
+                os.symlink(source, target)
+            elif os.path.isdir(source):
+                shutil.copytree(source, target)
+            else:
+                shutil.copy(source, target)
+        res['send_input_finish'] = _usec()
+
+        ### run the command
+        start = _usec()
+        if callable(command):
+            out = io.StringIO()
+            cwd = os.getcwd()
+            os.chdir(sandbox)
+            try:
+                with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                    status = command(sandbox)
+            except Exception as ex:
+                out.write('%s: %s\n' % (ex.__class__.__name__, ex))
+                status = 1
+            finally:
+                os.chdir(cwd)
+            res['return_status'] = status or 0
+            res['output']        = out.getvalue()
+        else:
+            env  = dict(os.environ, CORES=str(cores))
+            proc = subprocess.run(command, shell=True, cwd=sandbox, env=env,
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            res['output'] = proc.stdout.decode('utf-8', 'replace')
+            if proc.returncode < 0:
+                res['result'] = RESULT_SIGNAL
+            res['return_status'] = proc.returncode
+        res['cmd_execution_time'] = _usec() - start
+
+        ### collect the outputs
+        res['receive_output_start'] = _usec()
+        for local, remote in outputs:
+            source = os.path.join(sandbox, remote)
+            if not os.path.exists(source):
+                res['result'] = res['result'] or RESULT_OUTPUT_MISSING
+                continue
+            res['total_bytes_transferred'] += os.path.getsize(source)
+            shutil.move(source, local)
+        res['receive_output_finish'] = _usec()
+        return res
+
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+
+class LocalExecutor(Executor):
+    """
+    Runs tasks on this machine in a pool of processes, each task in a fresh
+    sandbox directory. Input files marked as cached are symlinked into the
+    sandbox, other inputs and buffers are copied, and output files are moved
+    to their local names when the task finishes.
+
+    Fields:
+        workers - the number of processes
+        sandbox - the directory under which task sandboxes are created
+
+    Methods:
+        See Executor
+    """
+
+    def __init__(self, workers=None, sandbox=None):
+        """
+        Initialize a new instance of LocalExecutor.
+
+        Parameters:
+            workers - the number of processes, defaults to the number of CPUs
+            sandbox - the directory in which to create task sandboxes,
+                      defaults to a new temporary directory
+
+        Returns:
+            None
+        """
+
+        self.workers  = workers or os.cpu_count() or 1
+        self.sandbox  = sandbox or tempfile.mkdtemp(prefix='awe-local.')
+        self._pool    = futures.ProcessPoolExecutor(max_workers=self.workers)
+        self._nextid  = 1
+        self._pending = dict()   # future -> task
+        self._ignored = set()    # futures of cancelled tasks that still run
+
+    name = 'local'
+
+    @property
+    def stats(self):
+        running = sum(1 for f in self._pending if f.running())
+        waiting = len(self._pending) - running
+        busy    = running + len(self._ignored)
+        return ExecutorStats(tasks_running = running,
+                             tasks_waiting = waiting,
+                             workers_busy  = min(busy, self.workers),
+                             workers_ready = max(0, self.workers - busy))
+
+    def new_task(self, command):
+        return LocalTask(command)
+
+    def submit(self, task):
+        """
+        Submit a task to the process pool.
+
+        Parameters:
+            task - a LocalTask
+
+        Returns:
+            The id of the task
+        """
+
+        task._reset()
+        task.id          = self._nextid
+        task.submit_time = _usec()
+        self._nextid    += 1
+
+        sandbox = os.path.join(self.sandbox, 't.%d' % task.id)
+        future  = self._pool.submit(_run_local_task, task.command, sandbox,
+                                    task._inputs, task._outputs, task.cores)
+        self._pending[future] = task
+        return task.id
+
+    def wait(self, timeout=None):
+        """
+        Wait for a task to complete.
+
+        Parameters:
+            timeout - the maximum number of seconds to wait
+
+        Returns:
+            The completed LocalTask or None if none completed in time
+        """
+
+        self._reap()
+        if not self._pending:
+            return None
+
+        done, _ = futures.wait(list(self._pending), timeout=timeout,
+                               return_when=futures.FIRST_COMPLETED)
+        if not done:
+            return None
+
+        future = next(iter(done))
+        task   = self._pending.pop(future)
+        try:
+            res = future.result()
+        except Exception as ex:
+            res = dict(result=RESULT_UNKNOWN, output='%s: %s\n' % (ex.__class__.__name__, ex))
+
+        for key, value in res.items():
+            setattr(task, key, value)
+        task.finish_time         = _usec()
+        task.total_transfer_time = (task.send_input_finish - task.send_input_start) + \
+                                   (task.receive_output_finish - task.receive_output_start)
+        return task
+
+    def cancel_by_tasktag(self, tag):
+        """
+        Cancel one outstanding task with the given tag. A task that already
+        started keeps running but its result is discarded.
+
+        Parameters:
+            tag - the tag of the task to cancel
+
+        Returns:
+            The cancelled task or None if there is no task with the tag
+        """
+
+        for future, task in list(self._pending.items()):
+            if task.tag == tag:
+                del self._pending[future]
+                if not future.cancel():
+                    self._ignored.add(future)
+                return task
+        return None
+
+    def _reap(self):
+        self._ignored = set(f for f in self._ignored if not f.done())
+
+    def empty(self):
+        return len(self._pending) == 0
+
+    def shutdown(self):
+        """
+        Stop the process pool and remove the sandbox directory.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        self._pool.shutdown(cancel_futures=True)
+        shutil.rmtree(self.sandbox, ignore_errors=True)
@@ -0,0 +1,408 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+###############################################################################
+# Columnar binary metrics logs.
+#
+# A metrics log is a directory holding two append-only files:
+#
+#   records.bin  fixed size little-endian records of RECORD_DTYPE:
+#                  time       float64  the timestamp (see stats.time)
+#                  component  uint32   string id of the component, e.g. TASK
+#                  metric     uint32   string id of the metric name
+#                  value      float64  the value, NaN if it is not a number
+#                  task       uint32   string id of the task tag, 0 if none
+#                  host       uint32   string id of the host, 0 if none
+#                  text       uint32   string id of a value that is not a
+#                                      number, 0 otherwise
+#   strings.txt  the string dictionary: string i, JSON encoded, on line i.
+#                String 0 is the empty string and stands for "none".
+#
+# Strings are written before the records that use them, and a record or a
+# line cut short by a crash is dropped when the log is opened again, so a
+# log is always readable, even while it is being written.
+###############################################################################
+
+from . import stats
+from .stats import StatsLogger
+
+import numpy as np
+
+import json
+import numbers
+import os
+
+
+RECORD_DTYPE = np.dtype([('time'     , '<f8'),
+                         ('component', '<u4'),
+                         ('metric'   , '<u4'),
+                         ('value'    , '<f8'),
+                         ('task'     , '<u4'),
+                         ('host'     , '<u4'),
+                         ('text'     , '<u4')])
+
+RECORDS_NAME = 'records.bin'
+STRINGS_NAME = 'strings.txt'
+
+
+def _truncate_partial(path, size):
+    """
+    Cut a file down to the given size if it is longer.
+    """
+
+    if os.path.getsize(path) > size:
+        with open(path, 'r+b') as fd:
+            fd.truncate(size)
+
+
+class MetricsStore(object):
+    """
+    Appends records to a metrics log (see the top of this module).
+
+    Fields:
+        path      - the directory of the log
+        _ids      - the id of each string in the dictionary
+        _strings  - the File object of the string dictionary
+        _records  - the File object of the records
+
+    Methods:
+        string_id - get the id of a string, adding it to the dictionary
+        append    - append records
+        flush     - flush the files
+        close     - close the files
+    """
+
+    def __init__(self, path):
+        """
+        Open a metrics log for appending, creating it if needed.
+
+        Parameters:
+            path - the directory of the log
+
+        Returns:
+            None
+        """
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.path = path
+        self._ids = dict()
+
+        strings = os.path.join(path, STRINGS_NAME)
+        records = os.path.join(path, RECORDS_NAME)
+
+        if os.path.exists(strings):
+            with open(strings, 'rb') as fd:
+                data = fd.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            _truncate_partial(strings, len(complete))
+            for line in complete.decode('utf-8').splitlines():
+                self._ids.setdefault(json.loads(line), len(self._ids))
+
+        if os.path.exists(records):
+            size = os.path.getsize(records)
+            _truncate_partial(records, size - size % RECORD_DTYPE.itemsize)
+
+        self._strings = open(strings, 'a', encoding='utf-8')
+        self._records = open(records, 'ab')
+        self.string_id('')
+
+    def string_id(self, string):
+        """
+        Get the id of a string, adding it to the dictionary if needed.
+
+        Parameters:
+            string - the string, or None for the empty string
+
+        Returns:
+            The id of the string
+        """
+
+        if string is None:
+            string = ''
+        elif not isinstance(string, str):
+            string = str(string)
+
+        i = self._ids.get(string)
+        if i is None:
+            i = len(self._ids)
+            self._ids[string] = i
+            self._strings.write(json.dumps(string) + '\n')
+        return i
+
+    def append(self, rows):
+        """
+        Append records.
+
+        Parameters:
+            rows - a sequence of (time, component, metric, value, task, host)
+                   tuples; values that are not numbers are stored as strings
+
+        Returns:
+            None
+        """
+
+        records = np.zeros(len(rows), dtype=RECORD_DTYPE)
+        sid     = self.string_id
+        for i, (t, component, metric, value, task, host) in enumerate(rows):
+            if isinstance(value, numbers.Real):
+                number, text = value, 0
+            else:
+                number, text = np.nan, sid(value)
+            records[i] = (t, sid(component), sid(metric), number,
+                          sid(task), sid(host), text)
+
+        # Records must never refer to strings not written yet
+        self._strings.flush()
+        self._records.write(records.tobytes())
+
+    def flush(self):
+        """
+        Flush the files of the log.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        self._strings.flush()
+        self._records.flush()
+
+    def close(self):
+        """
+        Close the files of the log.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        self._strings.close()
+        self._records.close()
+
+
+class MetricsLogger(StatsLogger):
+    """
+    A StatsLogger that writes its records to a metrics log instead of a
+    gzip text file. Arbitrary output is stored as text values of the
+    metric OUTPUT output, with the task and host it came from.
+
+    Fields:
+        See StatsLogger
+
+    Methods:
+        record - write several values sharing a timestamp, task and host
+        See StatsLogger for the others
+    """
+
+    def __init__(self, path='debug/stats.metrics', buffersize=1024, background=False,
+                 flushinterval=1.0):
+        """
+        Initialize a new MetricsLogger writing to a metrics log.
+
+        Parameters:
+            path          - the directory of the metrics log
+            See StatsLogger for the others
+        """
+
+        StatsLogger.__init__(self, path=path, buffersize=buffersize, background=background,
+                             flushinterval=flushinterval)
+
+    def update(self, t, component, name, val, task=None, host=None):
+        """
+        Write a value to the metrics log. See StatsLogger.update.
+        """
+
+        self._queue((t, component, name, val, task, host))
+
+    def record(self, t, component, values, task=None, host=None):
+        """
+        Write several values of one event, e.g. the fields of a cell
+        transition, as records sharing a timestamp, task and host. They are
+        written in a row, so they can be read back as the columns of a
+        table (see Metrics.table).
+
+        Parameters:
+            t         - the timestamp
+            component - the component
+            values    - a sequence of (metric name, value) pairs
+            task      - the tag of the task the values are about, if any
+            host      - the host the values are about, if any
+
+        Returns:
+            None
+        """
+
+        for name, val in values:
+            self._queue((t, component, name, val, task, host))
+
+    def output(self, val, task=None, host=None):
+        self._queue((stats.time.time(), 'OUTPUT', 'output', str(val), task, host))
+
+    def _open_file(self):
+        return MetricsStore(self._path)
+
+    def _write_records(self, records):
+        self._fd.append(records)
+
+
+class Metrics(object):
+    """
+    The metrics of a run, loaded from a metrics log.
+
+    Fields:
+        records - the records (numpy structured array of RECORD_DTYPE)
+        strings - the string dictionary (numpy object array)
+
+    Methods:
+        string_id - get the id of a string
+        names     - the distinct strings of a column
+        select    - get the records matching some strings
+        series    - get the times and values of one metric
+        table     - get the values of the events of a component
+        text      - decode a column of string ids
+    """
+
+    def __init__(self, records, strings):
+        self.records  = records
+        self.strings  = strings
+        self._ids     = dict((s, i) for i, s in enumerate(strings))
+
+    def __len__(self):
+        return len(self.records)
+
+    def string_id(self, string):
+        """
+        Get the id of a string, or -1 if the log does not contain it.
+        """
+
+        return self._ids.get(string, -1)
+
+    def names(self, column):
+        """
+        The distinct strings of a column.
+
+        Parameters:
+            column - component, metric, task, host or text
+
+        Returns:
+            A sorted list of strings
+        """
+
+        return sorted(self.strings[np.unique(self.records[column])].tolist())
+
+    def select(self, component=None, metric=None, task=None, host=None):
+        """
+        Get the records matching the given strings.
+
+        Parameters:
+            component - the component, or None for any
+            metric    - the metric name, or None for any
+            task      - the task tag, or None for any
+            host      - the host, or None for any
+
+        Returns:
+            The matching records (numpy structured array)
+        """
+
+        mask = np.ones(len(self.records), dtype=bool)
+        for column, string in (('component', component), ('metric', metric),
+                               ('task', task), ('host', host)):
+            if string is not None:
+                mask &= self.records[column] == self.string_id(string)
+        return self.records[mask]
+
+    def series(self, component, metric):
+        """
+        Get the times and values of one metric.
+
+        Parameters:
+            component - the component
+            metric    - the metric name
+
+        Returns:
+            The times and the values (numpy.array)
+        """
+
+        records = self.select(component=component, metric=metric)
+        return records['time'], records['value']
+
+    def table(self, component, names):
+        """
+        Get the values of the events of a component written with
+        MetricsLogger.record, one column per metric.
+
+        Parameters:
+            component - the component
+            names     - the metric names of the columns
+
+        Returns:
+            A dict of metric name -> values (numpy.array), with 'time' and
+            'task' (string ids) for the timestamps and tasks of the events.
+            An event still being written is left out.
+        """
+
+        selected = [self.select(component=component, metric=name) for name in names]
+        count    = min(len(records) for records in selected) if selected else 0
+
+        columns = dict((name, records['value'][:count])
+                       for name, records in zip(names, selected))
+        if selected:
+            columns['time'] = selected[0]['time'][:count]
+            columns['task'] = selected[0]['task'][:count]
+        return columns
+
+    def text(self, ids):
+        """
+        Decode a column of string ids.
+
+        Parameters:
+            ids - the string ids, e.g. records['host']
+
+        Returns:
+            A numpy object array of strings
+        """
+
+        return self.strings[ids]
+
+
+def load(path):
+    """
+    Load a metrics log. The log may still be being written.
+
+    Parameters:
+        path - the directory of the log
+
+    Returns:
+        A Metrics instance
+    """
+
+    with open(os.path.join(path, STRINGS_NAME), 'rb') as fd:
+        data = fd.read()
+    lines   = data[:data.rfind(b'\n') + 1].decode('utf-8').splitlines()
+    strings = np.empty(len(lines), dtype=object)
+    strings[:] = [json.loads(line) for line in lines]
+
+    path    = os.path.join(path, RECORDS_NAME)
+    count   = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    records = np.fromfile(path, dtype=RECORD_DTYPE, count=count)
+
+    # Drop records written after the strings were read
+    if len(records):
+        unknown = np.zeros(len(records), dtype=bool)
+        for column in ('component', 'metric', 'task', 'host', 'text'):
+            unknown |= records[column] >= len(strings)
+        if unknown.any():
+            records = records[:np.argmax(unknown)]
+
+    return Metrics(records, strings)
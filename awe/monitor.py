@@ -0,0 +1,405 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+###############################################################################
+# Live metrics of a running AWE master.
+#
+# A Monitor serves the state of the master in the Prometheus text format
+# (version 0.0.4) at /metrics, over HTTP on a TCP port or on a Unix socket.
+# The server runs on its own threads and never touches the AWE instance:
+# the master thread renders a snapshot at safe points (each phase of an
+# iteration, and after every wait for tasks) and the server returns the
+# latest one. A scrape never blocks the master, and the master only pays
+# for rendering at most once per interval while it waits for tasks.
+#
+# Addresses are written as:
+#   host:port      TCP, e.g. localhost:9100; port 0 picks a free port
+#   :port or port  TCP on all interfaces
+#   unix:path      a Unix socket, also any address containing a '/'
+###############################################################################
+
+import numpy as np
+
+from http import client
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import socket
+import socketserver
+import threading
+import time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def parse_address(address):
+    """
+    Parse a monitor address (see the top of this module).
+
+    Parameters:
+        address - the address, a string, a port number or a (host, port)
+                  tuple
+
+    Returns:
+        A (host, port) tuple for TCP, or the path of a Unix socket
+    """
+
+    if isinstance(address, tuple):
+        return address
+    if isinstance(address, int):
+        return ('', address)
+    if address.startswith('unix:'):
+        return address[len('unix:'):]
+    if '/' in address:
+        return address
+    host, _, port = address.rpartition(':')
+    return (host, int(port))
+
+
+def resident_memory():
+    """
+    The resident set size of this process.
+
+    Parameters:
+        None
+
+    Returns:
+        The size in bytes, or None if it cannot be read
+    """
+
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serves the latest snapshot of the monitor of the server.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.monitor.text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Monitor(object):
+    """
+    Serves live metrics of an AWE master (see the top of this module).
+
+    Fields:
+        address  - the address served, as given (see parse_address)
+        interval - the minimum time between two snapshots taken while
+                   waiting for tasks, in seconds
+        text     - the latest snapshot, in the Prometheus text format
+
+    Methods:
+        start   - start serving
+        stop    - stop serving
+        bound   - the address actually served
+        update  - take a snapshot of an AWE instance
+        metrics - the samples of a snapshot
+    """
+
+    def __init__(self, address='localhost:9100', interval=1.0):
+        """
+        Initialize a new Monitor. Nothing is served until start() is called.
+
+        Parameters:
+            address  - where to serve the metrics (see parse_address)
+            interval - the minimum time between two snapshots taken while
+                       waiting for tasks, in seconds
+
+        Returns:
+            None
+        """
+
+        self.address  = address
+        self.interval = interval
+        self.text     = ''
+        self._server  = None
+        self._thread  = None
+        self._updated = None
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        odict['_server'] = None
+        odict['_thread'] = None
+        return odict
+
+    def start(self):
+        """
+        Start serving on a separate thread. Does nothing if already serving.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        if self._server is not None:
+            return
+
+        address = parse_address(self.address)
+        if isinstance(address, tuple):
+            server = _TCPServer(address, _Handler)
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            server = _UnixServer(address, _Handler)
+        server.monitor = self
+
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever,
+                                        name='awe-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if isinstance(self._server, _UnixServer) and os.path.exists(self.bound):
+            os.unlink(self.bound)
+        self._server = None
+        self._thread = None
+
+    @property
+    def bound(self):
+        """
+        The address actually served: a (host, port) tuple, with the port
+        chosen if 0 was asked for, or the path of the Unix socket.
+        """
+
+        if self._server is None:
+            return None
+        return self._server.server_address
+
+    def update(self, awe, force=True):
+        """
+        Take a snapshot of an AWE instance to serve. Must be called from
+        the thread running AWE.
+
+        Parameters:
+            awe   - the aweclasses.AWE instance
+            force - if False, do nothing if the last snapshot is less than
+                    interval seconds old
+
+        Returns:
+            None
+        """
+
+        now = time.time()
+        if not force and self._updated is not None and now - self._updated < self.interval:
+            return
+        self._updated = now
+
+        lines  = []
+        helped = set()
+        for name, kind, doc, labels, value in self.metrics(awe):
+            if value is None:
+                continue
+            family = name
+            if kind == 'summary' and name.endswith(('_sum', '_count')):
+                family = name[:name.rindex('_')]
+            if family not in helped:
+                helped.add(family)
+                lines.append('# HELP %s %s' % (family, doc))
+                lines.append('# TYPE %s %s' % (family, kind))
+            if labels:
+                labels = ','.join('%s="%s"' % kv for kv in labels)
+                lines.append('%s{%s} %s' % (name, labels, _number(value)))
+            else:
+                lines.append('%s %s' % (name, _number(value)))
+        lines.append('')
+
+        # Replacing the string is atomic, the server threads see either
+        # snapshot whole
+        self.text = '\n'.join(lines)
+
+    def metrics(self, awe):
+        """
+        The samples of a snapshot of an AWE instance.
+
+        Parameters:
+            awe - the aweclasses.AWE instance
+
+        Returns:
+            A list of (name, type, help, labels, value) tuples, where labels
+            is a tuple of (label, value) pairs; samples whose value is None
+            are not served
+        """
+
+        wq    = awe.wq
+        queue = wq.wq.stats
+        rep   = wq.replication
+
+        samples = [
+            ('awe_iteration', 'gauge', 'The current iteration.', (), awe.iteration),
+            ('awe_walkers', 'gauge', 'The number of walkers.', (),
+             None if awe.system is None else len(awe.system)),
+            ('awe_cells', 'gauge', 'The number of cells.', (),
+             None if awe.system is None else len(awe.system.cells)),
+            ('awe_tasks', 'gauge', 'The number of tasks in the queue.',
+             (('state', 'waiting'),), queue.tasks_waiting),
+            ('awe_tasks', 'gauge', 'The number of tasks in the queue.',
+             (('state', 'running'),), queue.tasks_running),
+            ('awe_workers', 'gauge', 'The number of workers connected.',
+             (('state', 'busy'),), queue.workers_busy),
+            ('awe_workers', 'gauge', 'The number of workers connected.',
+             (('state', 'ready'),), queue.workers_ready),
+            ('awe_replication_duplicates', 'gauge',
+             'The number of duplicate tasks submitted this iteration.', (), rep.duplicates),
+            ('awe_replication_wins', 'gauge',
+             'The number of results of this iteration returned by a duplicate.', (), rep.wins),
+            ]
+
+        for name, elapsed in sorted(awe.stats.last.items()):
+            phase = name[:-len(' time')] if name.endswith(' time') else name
+            samples.append(('awe_phase_seconds', 'gauge',
+                            'The duration of the last run of each phase of an iteration.',
+                            (('phase', phase),), elapsed))
+
+        # The quantiles are over the recent tasks, the count and sum over
+        # every task of the run
+        quantiles = rep.quantiles(QUANTILES)
+        if quantiles is not None:
+            for q, value in zip(QUANTILES, quantiles):
+                samples.append(('awe_task_turnaround_seconds', 'summary',
+                                'The turnaround time of recent tasks, from submission to result.',
+                                (('quantile', str(q)),), value))
+            samples.append(('awe_task_turnaround_seconds_sum', 'summary', '', (), rep.total))
+            samples.append(('awe_task_turnaround_seconds_count', 'summary', '', (), rep.count))
+
+        samples.append(('process_resident_memory_bytes', 'gauge',
+                        'Resident memory size in bytes.', (), resident_memory()))
+        samples.append(('awe_snapshot_timestamp_seconds', 'gauge',
+                        'When this snapshot was taken, in seconds since the epoch.', (),
+                        self._updated))
+        return samples
+
+
+def _number(value):
+    value = float(value)
+    if np.isnan(value):
+        return 'NaN'
+    if np.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value) if value != int(value) else str(int(value))
+
+
+class _UnixHTTPConnection(client.HTTPConnection):
+    """
+    An HTTPConnection over a Unix socket.
+    """
+
+    def __init__(self, path, timeout=10):
+        client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+def fetch(address, timeout=10):
+    """
+    Get the metrics served by a Monitor.
+
+    Parameters:
+        address - the address of the monitor (see parse_address)
+        timeout - the timeout in seconds
+
+    Returns:
+        The metrics, in the Prometheus text format
+    """
+
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        host, port = address
+        conn = client.HTTPConnection(host or 'localhost', port, timeout=timeout)
+    else:
+        conn = _UnixHTTPConnection(address, timeout=timeout)
+
+    try:
+        conn.request('GET', '/metrics')
+        response = conn.getresponse()
+        body = response.read().decode('utf-8')
+        if response.status != 200:
+            raise IOError('%s: HTTP %d %s' % (address, response.status, response.reason))
+        return body
+    finally:
+        conn.close()
+
+
+def parse(text):
+    """
+    Parse metrics in the Prometheus text format, as served by a Monitor.
+
+    Parameters:
+        text - the metrics
+
+    Returns:
+        A dictionary mapping (name, labels) to the value, where labels is a
+        sorted tuple of (label, value) pairs
+    """
+
+    samples = dict()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        series, _, value = line.rpartition(' ')
+        labels = ()
+        if '{' in series:
+            series, _, rest = series.partition('{')
+            pairs  = (pair.split('=', 1) for pair in rest.rstrip('}').split(',') if pair)
+            labels = tuple(sorted((k, v.strip('"')) for k, v in pairs))
+        samples[(series, labels)] = float(value)
+    return samples
@@ -0,0 +1,154 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+###############################################################################
+# Binary walker transport between the master and the workers.
+#
+# A payload is a fixed header followed by the raw coordinates:
+#
+#   magic   4 bytes   b'AWEW' (walker, master -> worker) or
+#                     b'AWER' (result, worker -> master)
+#   version uint32
+#   ident   int64     the walker id (walker) or the assigned cell id (result)
+#   natoms  uint32
+#   ndim    uint32
+#   coords  natoms * ndim float32, in atom order
+#
+# All fields are little-endian. The worker side of this format is
+# implemented without numpy in awe-instance-data/awe-payload; the two must
+# be kept in sync.
+#
+# A worker does not return its result as a file. It prints it on the
+# output of the task, which the master receives in memory, as one line:
+#
+#   AWE-RESULT <base64 encoded result payload>
+###############################################################################
+
+import numpy as np
+
+import base64
+import struct
+
+MAGIC_WALKER = b'AWEW'
+MAGIC_RESULT = b'AWER'
+VERSION      = 1
+
+HEADER = struct.Struct('<4sIqII')
+
+RESULT_MARKER = 'AWE-RESULT '
+
+
+class PayloadException(Exception): pass
+
+
+def pack(magic, ident, coords):
+    """
+    Encode coordinates as a binary payload.
+
+    Parameters:
+        magic  - MAGIC_WALKER or MAGIC_RESULT
+        ident  - the walker or cell id to put in the header
+        coords - a (natoms, ndim) array of coordinates
+
+    Returns:
+        The payload as bytes
+    """
+
+    coords = np.ascontiguousarray(coords, dtype='<f4')
+    natoms, ndim = coords.shape
+    return HEADER.pack(magic, VERSION, ident, natoms, ndim) + coords.tobytes()
+
+def unpack(data, magic):
+    """
+    Decode a binary payload.
+
+    Parameters:
+        data  - the payload (bytes)
+        magic - the expected magic number
+
+    Returns:
+        A tuple of the id from the header and a (natoms, ndim) float32 array
+        of coordinates
+
+    Raises:
+        PayloadException if the payload is malformed
+    """
+
+    if len(data) < HEADER.size:
+        raise PayloadException('Payload too short: %d bytes' % len(data))
+
+    got, version, ident, natoms, ndim = HEADER.unpack_from(data)
+    if got != magic:
+        raise PayloadException('Bad payload magic %r, expected %r' % (got, magic))
+    if version != VERSION:
+        raise PayloadException('Unsupported payload version %d' % version)
+
+    size = natoms * ndim
+    if len(data) != HEADER.size + 4 * size:
+        raise PayloadException('Payload has %d bytes, expected %d' % \
+                                   (len(data), HEADER.size + 4 * size))
+
+    coords = np.frombuffer(data, dtype='<f4', count=size, offset=HEADER.size)
+    return ident, coords.reshape((natoms, ndim))
+
+def pack_walker(walkerid, coords):
+    return pack(MAGIC_WALKER, walkerid, coords)
+
+def unpack_walker(data):
+    return unpack(data, MAGIC_WALKER)
+
+def pack_result(cellid, coords):
+    return pack(MAGIC_RESULT, cellid, coords)
+
+def unpack_result(data):
+    return unpack(data, MAGIC_RESULT)
+
+def format_result(cellid, coords):
+    """
+    Encode a result as the line a worker prints on the output of its task.
+
+    Parameters:
+        cellid - the cell the walker was assigned to
+        coords - a (natoms, ndim) array of the final coordinates
+
+    Returns:
+        The line as a string
+    """
+
+    return RESULT_MARKER + base64.b64encode(pack_result(cellid, coords)).decode('ascii') + '\n'
+
+def find_result(output):
+    """
+    Find the result payload on the output of a task. If the output has
+    several result lines the last one is used.
+
+    Parameters:
+        output - the output of the task (str)
+
+    Returns:
+        The result payload (bytes), to decode with unpack_result
+
+    Raises:
+        PayloadException if the output has no well formed result line
+    """
+
+    # The last result line wins; the prepended newline lets the first line
+    # match and puts the position found on the marker itself
+    start = ('\n' + output).rfind('\n' + RESULT_MARKER)
+    if start < 0:
+        raise PayloadException('No result in the task output')
+    start += len(RESULT_MARKER)
+
+    end = output.find('\n', start)
+    if end < 0:
+        end = len(output)
+
+    try:
+        return base64.b64decode(output[start:end].strip(), validate=True)
+    except ValueError as ex:
+        raise PayloadException('Malformed result in the task output: %s' % ex)
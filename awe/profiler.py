@@ -0,0 +1,301 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+###############################################################################
+# Hot path profiling of the AWE master.
+#
+# The master wraps each phase of an iteration in a named span:
+#
+#     with self.profiler.span('marshal_to_task'):
+#         ...
+#
+# and counts events with self.profiler.count('tasks_submitted'). A Profiler
+# sums the calls and time of each span and the counters per iteration, and
+# can keep every span as an event for a Chrome trace (chrome://tracing or
+# https://ui.perfetto.dev). Spans may be entered on any thread.
+#
+# The default profiler, DISABLED, does nothing: span() returns a shared
+# context manager that does nothing, so a disabled span costs one method
+# call.
+###############################################################################
+
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan(object):
+    """
+    The span of a disabled profiler.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """
+    A span being timed.
+    """
+
+    __slots__ = ('_profiler', '_name', '_start')
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name     = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._profiler._record(self._name, self._start, time.perf_counter())
+        return False
+
+
+class Profiler(object):
+    """
+    Sums the time spent in named spans and counts events, per iteration
+    (see the top of this module).
+
+    Fields:
+        enabled   - whether spans and counters are recorded
+        trace     - whether every span is kept for a Chrome trace
+        path      - where dump() writes the per-iteration breakdown, or None
+        tracepath - where dump() writes the Chrome trace, or None
+
+    Methods:
+        span         - a context manager timing a named span
+        count        - add to a counter
+        iteration    - start recording a new iteration
+        breakdown    - the time of each span and the counters of each
+                       iteration
+        report       - the breakdown as text
+        chrome_trace - the spans and counters as Chrome trace events
+        dump         - write the breakdown and the trace to their paths
+    """
+
+    def __init__(self, enabled=True, path=None, tracepath=None, trace=None):
+        """
+        Initialize a new Profiler.
+
+        Parameters:
+            enabled   - if False, record nothing
+            path      - where dump() writes the per-iteration breakdown
+            tracepath - where dump() writes the Chrome trace
+            trace     - whether to keep every span for a Chrome trace,
+                        defaults to whether tracepath is given
+
+        Returns:
+            None
+        """
+
+        self.enabled   = enabled
+        self.path      = path
+        self.tracepath = tracepath
+        self.trace     = tracepath is not None if trace is None else trace
+
+        self._lock      = threading.Lock()
+        self._origin    = time.perf_counter()
+        self._iteration = 0
+        self._spans     = dict()    # iteration -> name -> [calls, seconds]
+        self._counters  = dict()    # iteration -> name -> count
+        self._totals    = dict()    # name -> count over the run
+        self._events    = []        # (name, start, end, thread id)
+        self._marks     = []        # (time, name, count over the run)
+        self._threads   = dict()    # thread id -> name
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        del odict['_lock']
+        return odict
+
+    def __setstate__(self, odict):
+        self.__dict__.update(odict)
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        """
+        A context manager timing a named span.
+
+        Parameters:
+            name - the name of the span
+
+        Returns:
+            The context manager
+        """
+
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def _record(self, name, start, end):
+        ident = threading.get_ident()
+        with self._lock:
+            spans = self._spans.setdefault(self._iteration, dict())
+            stats = spans.get(name)
+            if stats is None:
+                stats = spans[name] = [0, 0.]
+            stats[0] += 1
+            stats[1] += end - start
+            if self.trace:
+                self._events.append((name, start, end, ident))
+                if ident not in self._threads:
+                    self._threads[ident] = threading.current_thread().name
+
+    def count(self, name, n=1):
+        """
+        Add to a counter.
+
+        Parameters:
+            name - the name of the counter
+            n    - the amount to add
+
+        Returns:
+            None
+        """
+
+        if not self.enabled:
+            return
+        with self._lock:
+            counters = self._counters.setdefault(self._iteration, dict())
+            counters[name]     = counters.get(name, 0) + n
+            self._totals[name] = self._totals.get(name, 0) + n
+            if self.trace:
+                self._marks.append((time.perf_counter(), name, self._totals[name]))
+
+    def iteration(self, iteration):
+        """
+        Record the following spans and counts as part of an iteration.
+
+        Parameters:
+            iteration - the iteration
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            self._iteration = iteration
+
+    def breakdown(self):
+        """
+        The time of each span and the counters of each iteration.
+
+        Parameters:
+            None
+
+        Returns:
+            A list of (iteration, spans, counters) sorted by iteration, where
+            spans maps the name of each span to its (calls, seconds) and
+            counters maps the name of each counter to its count
+        """
+
+        with self._lock:
+            iterations = sorted(set(self._spans) | set(self._counters))
+            return [(i,
+                     dict((name, tuple(stats)) for name, stats in self._spans.get(i, {}).items()),
+                     dict(self._counters.get(i, {})))
+                    for i in iterations]
+
+    def report(self):
+        """
+        The per-iteration breakdown as text: the calls, total and mean time
+        of each span, slowest first, then the counters.
+
+        Parameters:
+            None
+
+        Returns:
+            A string
+        """
+
+        lines = []
+        for i, spans, counters in self.breakdown():
+            lines.append('iteration %d' % i)
+            lines.append('  %-24s %10s %12s %12s' % ('span', 'calls', 'total(s)', 'mean(ms)'))
+            for name, (calls, seconds) in sorted(spans.items(), key=lambda kv: -kv[1][1]):
+                lines.append('  %-24s %10d %12.4f %12.4f' % (name, calls, seconds,
+                                                            1000. * seconds / calls))
+            for name, n in sorted(counters.items()):
+                lines.append('  %-24s %10d' % (name, n))
+        return '\n'.join(lines) + '\n'
+
+    def chrome_trace(self):
+        """
+        The spans and counters as Chrome trace events (the JSON object
+        format of the Trace Event Format), with times in microseconds
+        since the profiler was created.
+
+        Parameters:
+            None
+
+        Returns:
+            A dictionary to be written as JSON
+        """
+
+        pid = os.getpid()
+        us  = lambda t: round((t - self._origin) * 1e6, 3)
+
+        with self._lock:
+            tids   = dict((ident, i + 1) for i, ident in enumerate(self._threads))
+            events = [dict(name='thread_name', ph='M', pid=pid, tid=tids[ident],
+                           args=dict(name=name))
+                      for ident, name in self._threads.items()]
+            events.extend(dict(name=name, cat='awe', ph='X', pid=pid, tid=tids[ident],
+                               ts=us(start), dur=us(end) - us(start))
+                          for name, start, end, ident in self._events)
+            events.extend(dict(name=name, cat='awe', ph='C', pid=pid, tid=0,
+                               ts=us(t), args={name: n})
+                          for t, name, n in self._marks)
+
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def dump(self):
+        """
+        Write the per-iteration breakdown to path and the Chrome trace to
+        tracepath, each if set.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        if not self.enabled:
+            return
+
+        for path, write in ((self.path, self._write_report),
+                            (self.tracepath, self._write_trace)):
+            if path is None:
+                continue
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            write(path)
+
+    def _write_report(self, path):
+        with open(path, 'w') as fd:
+            fd.write(self.report())
+
+    def _write_trace(self, path):
+        with open(path, 'w') as fd:
+            json.dump(self.chrome_trace(), fd)
+
+
+### the profiler of masters that are not profiled
+DISABLED = Profiler(enabled=False)
@@ -31,6 +31,8 @@ import numpy as np
 import itertools
 import time, os
 import textwrap
+from collections import defaultdict
+from concurrent import futures
 
 OUTPUT_DIR = os.getcwd()
 
@@ -45,6 +47,7 @@ class IResampler(object):
     Methods:
         resample - divide and kill off walkers until weights are equal to
                    the group's mean weight
+        shutdown - release the resources of the resampler, e.g. workers
     """
 
     def resample(self, walkers):
@@ -60,6 +63,20 @@ class IResampler(object):
 
         raise NotImplementedError
 
+    def shutdown(self):
+        """
+        Release the resources of the resampler. Resamplers holding none do
+        nothing.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        pass
+
     @typecheck(aweclasses.System)
     @returns(aweclasses.System)
     def __call__(self, s1):
@@ -92,6 +109,171 @@ class Identity(IResampler):
         return walkers
 
 
+def _cellcumsum(w, starts, sizes):
+    """
+    Cumulative sum of *w* restarting at the first walker of each cell. The
+    sums of a cell only depend on the weights in that cell, so the result
+    is the same however the cells are sharded.
+    """
+
+    n      = len(w)
+    ncells = len(starts)
+    width  = sizes.max()
+
+    if ncells * width > 4 * n + 1024:
+        # Too skewed to pad, sum each cell separately
+        C = np.empty(n)
+        for a, m in zip(starts.tolist(), sizes.tolist()):
+            C[a:a+m] = np.cumsum(w[a:a+m])
+        return C
+
+    cell = np.repeat(np.arange(ncells), sizes)
+    pos  = np.arange(n) - np.repeat(starts, sizes)
+    pad  = np.zeros((ncells, width))
+    pad[cell, pos] = w
+    return np.cumsum(pad, axis=1)[cell, pos]
+
+def _cellsearch(C, w, first, last, point):
+    """
+    For each (first, last, point) find the first walker j in first..last
+    with C[j] > point, where C is the cumulative weight within each cell.
+    """
+
+    # Guess from the cumulative weight over all cells, then correct the
+    # guess using only the weights of the cell
+    G     = np.cumsum(w)
+    base  = np.where(first > 0, G[np.maximum(first - 1, 0)], 0.)
+    j     = np.searchsorted(G, base + point, side='right')
+    j     = np.clip(j, first, last)
+
+    while True:
+        up   = (j < last)  & (C[j] <= point)
+        down = (j > first) & (C[np.maximum(j - 1, 0)] > point)
+        if not (up.any() or down.any()):
+            return j
+        j = j + up - down
+
+def split_merge(cellids, weights, targetwalkers, uniforms):
+    """
+    Vectorized split/merge step of the OneColor algorithm for the walkers of
+    any number of cells at once.
+
+    Within each cell the walkers are visited in ascending order of weight,
+    as in OneColor.resample_reference. With C the running total of the
+    weight visited so far and tw the target weight of the cell, the number
+    of new walkers created once a walker has been visited is
+    k = min(floor(C / tw), targetwalkers), and all targetwalkers have been
+    created after the last walker. Each walker that increases k is split
+    k - k_prev times from a survivor chosen in proportion to weight among the
+    walkers merged since the previous split, where the weight carried over
+    from that split belongs to its survivor. This gives the same outcome
+    distribution as the sequential algorithm.
+
+    Parameters:
+        cellids       - the cell of each walker (numpy.array)
+        weights       - the weight of each walker (numpy.array)
+        targetwalkers - the number of walkers to create in each cell
+        uniforms      - one uniform [0, 1) random number per walker
+
+    Returns:
+        parents - the position of the walker each new walker is restarted
+                  from, grouped by cell
+        weights - the weight of each new walker
+    """
+
+    cellids  = np.asarray(cellids)
+    weights  = np.asarray(weights, dtype=np.float64)
+    uniforms = np.asarray(uniforms, dtype=np.float64)
+    if len(weights) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    ### group by cell and sort by ascending weight within each cell
+    order  = np.lexsort((weights, cellids))
+    c      = cellids[order]
+    w      = weights[order]
+    u      = uniforms[order]
+    n      = len(w)
+
+    starts = np.flatnonzero(np.r_[True, c[1:] != c[:-1]])
+    ends   = np.r_[starts[1:], n]
+    sizes  = ends - starts
+
+    ### running weight within each cell
+    C      = _cellcumsum(w, starts, sizes)
+    W      = np.repeat(C[ends - 1], sizes)
+
+    # Cells without weight have nothing to resample
+    live   = W > 0
+    tw     = np.where(live, W / targetwalkers, 1.)
+
+    ### number of walkers created so far, and by each walker
+    k      = np.minimum(np.floor(C / tw), targetwalkers).astype(np.int64)
+    k[ends - 1] = targetwalkers
+    k[~live]    = 0
+    kprev  = np.r_[0, k[:-1]]
+    kprev[starts] = 0
+    r      = k - kprev
+
+    ### choose the survivor of each split
+    split  = np.flatnonzero(r > 0)
+    if len(split) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    first  = np.repeat(starts, sizes)[split]
+    lo     = kprev[split] * tw[split]
+    point  = lo + u[split] * (C[split] - lo)
+    owner  = _cellsearch(C, w, first, split, point)
+
+    # Points in the weight carried over from the previous split of the same
+    # cell belong to the survivor of that split
+    prev   = np.r_[-1, split[:-1]]
+    carry  = (prev >= first) & (owner <= prev)
+    fill   = np.maximum.accumulate(np.where(carry, 0, np.arange(len(split))))
+    owner  = owner[fill]
+
+    copies = r[split]
+    return np.repeat(order[owner], copies), np.repeat(tw[split], copies)
+
+
+def split_merge_sharded(cellids, weights, targetwalkers, uniforms, pool, nshards):
+    """
+    Run split_merge on shards of cells in parallel. Each shard holds a
+    contiguous range of cell ids and only the arrays of its walkers are sent
+    to the pool, so the concatenated result is identical to calling
+    split_merge on all walkers.
+
+    Parameters:
+        cellids       - the cell of each walker (numpy.array)
+        weights       - the weight of each walker (numpy.array)
+        targetwalkers - the number of walkers to create in each cell
+        uniforms      - one uniform [0, 1) random number per walker
+        pool          - a concurrent.futures.Executor
+        nshards       - the number of shards to split the cells into
+
+    Returns:
+        The same as split_merge
+    """
+
+    cellids = np.asarray(cellids)
+    cells   = np.unique(cellids)
+    nshards = max(1, min(nshards, len(cells)))
+    bounds  = [shard[0] for shard in np.array_split(cells, nshards)[1:]]
+    shardof = np.searchsorted(bounds, cellids, side='right')
+
+    positions = [np.flatnonzero(shardof == i) for i in range(nshards)]
+    jobs      = [pool.submit(split_merge, cellids[pos], weights[pos],
+                             targetwalkers, uniforms[pos])
+                 for pos in positions]
+
+    parents, newweights = [], []
+    for pos, job in zip(positions, jobs):
+        p, w = job.result()
+        parents.append(pos[p])
+        newweights.append(w)
+
+    return np.concatenate(parents), np.concatenate(newweights)
+
+
 class OneColor(IResampler):
     """
     A single/no color algorithm based on Eric Darve and Ernest Ryu's:
@@ -105,34 +287,169 @@ class OneColor(IResampler):
         targetwalkers - a target weight that the new generation of walkers
                         should be set to
         histfile      - the file to which output weights are recorded
+        rng           - the numpy.random.RandomState used for merging
+        nworkers      - the number of parallel workers (None for serial)
+        pooltype      - 'process' or 'thread'
 
     Methods:
-        resample - create a new generation of walkers by merging an splitting
-                   weights from a processed generation
+        resample           - create a new generation of walkers by merging
+                             and splitting weights from a processed generation
+        resample_reference - the original walker-by-walker implementation of
+                             resample
+        shutdown           - stop the worker pool used in parallel mode
     """
 
-    def __init__(self, targetwalkers):
+    # Below this many walkers the pool overhead is not worth it
+    _MIN_PARALLEL_WALKERS = 10000
+
+    def __init__(self, targetwalkers, seed=None, nworkers=None, pooltype='process'):
         """
         Initialize a new instance of OneColor.
 
         Parameters:
             targetwalkers - a list of target weights to converge to (numeric)
+            seed          - a seed for the random number generator, for
+                            reproducible resampling
+            nworkers      - resample shards of cells in parallel with this
+                            many workers; the result is identical to the
+                            serial one for the same seed
+            pooltype      - 'process' or 'thread', the kind of
+                            concurrent.futures pool to use
 
         Returns:
             None
         """
 
+        if pooltype not in ('process', 'thread'):
+            raise ValueError('Unknown pool type %r' % pooltype)
+
         self.targetwalkers = targetwalkers
+        self.rng           = np.random.RandomState(seed)
+        self.nworkers      = nworkers
+        self.pooltype      = pooltype
+        self._pool         = None
 #####
         self.histfile = os.path.join(OUTPUT_DIR, 'walker-history.csv')
         makedirs_parent(self.histfile)
         with open(self.histfile, 'a') as fd:
             fd.write('%origID, parentID, currentID \n')
 
+    def __getstate__(self):
+        """
+        See Python docs on the pickle module for more info on __getstate__
+        The worker pool is not pickled and is restarted when needed.
+        """
+
+        odict = self.__dict__.copy()
+        odict['_pool'] = None
+        return odict
+
+    def __setstate__(self, odict):
+        """
+        See Python docs on the pickle module for more info on __setstate__
+        """
+
+        odict.setdefault('nworkers', None)
+        odict.setdefault('pooltype', 'process')
+        odict.setdefault('_pool', None)
+        self.__dict__.update(odict)
+
+    @property
+    def pool(self):
+        """
+        The worker pool, started on first use.
+        """
+
+        if self._pool is None:
+            if self.pooltype == 'process':
+                self._pool = futures.ProcessPoolExecutor(max_workers=self.nworkers)
+            else:
+                self._pool = futures.ThreadPoolExecutor(max_workers=self.nworkers)
+        return self._pool
+
+    def shutdown(self):
+        """
+        Stop the worker pool, if any.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _split_merge(self, cellids, weights, uniforms):
+        """
+        Run split_merge serially or on the worker pool.
+        """
+
+        if self.nworkers is None or self.nworkers < 2 or \
+                len(weights) < self._MIN_PARALLEL_WALKERS:
+            return split_merge(cellids, weights, self.targetwalkers, uniforms)
+
+        return split_merge_sharded(cellids, weights, self.targetwalkers,
+                                   uniforms, self.pool, self.nworkers)
+
     def resample(self, system):
         """
         Adjust weights of a processed group of walkers to meet the target group
-        assuming there exists only one metastable state (macro-state).
+        assuming there exists only one metastable state (macro-state). All
+        cells are resampled at once (see split_merge).
+
+        Parameters:
+            system - an awe.aweclasses.System instance
+
+        Returns:
+            A new awe.aweclasses.System instance with adjusted weights
+        """
+
+        cellids  = system.column('assignments')
+        weights  = system.column('weights')
+        uniforms = self.rng.random_sample(len(weights))
+
+        # Only walkers in the cells of the system are resampled
+        keep = np.flatnonzero(np.isin(cellids, [c.id for c in system.cells]))
+        print(time.asctime(), 'Resampling', len(keep), 'walkers')
+
+        parents, newweights = self._split_merge(cellids[keep], weights[keep],
+                                                uniforms[keep])
+        parents   = keep[parents]
+
+        restarted = system.restart(parents, newweights)
+        newsystem = system.clone()
+        newsystem += restarted
+
+        history = np.column_stack((restarted.column('initids'),
+                                   system.column('ids')[parents],
+                                   restarted.column('ids')))
+        self.save_history(history)
+
+        return newsystem
+
+    def save_history(self, history):
+        """
+        Append the lineage of the restarted walkers to walker-history.csv.
+
+        Parameters:
+            history - an (n, 3) array of original, parent and new walker ids
+
+        Returns:
+            None
+        """
+
+        with open(self.histfile, 'a') as histfile_fd:
+            np.savetxt(histfile_fd, history, fmt='%d', delimiter=',')
+
+    def resample_reference(self, system):
+        """
+        Adjust weights of a processed group of walkers to meet the target group
+        assuming there exists only one metastable state (macro-state), visiting
+        the walkers of each cell one at a time. This is the original
+        implementation of resample, kept to validate it against.
 
         Parameters:
             system - an awe.aweclasses.System instance
@@ -267,7 +584,7 @@ class OneColor(IResampler):
                     # Randomly choose a walker to continue evaluating. This
                     # effectively removes one of them from the list (i.e. one
                     # was absorbed).
-                    p = np.random.random()
+                    p = self.rng.random_sample()
                     if p < Wy / Wxy:
                         x = y
                     
@@ -303,23 +620,30 @@ class MultiColor(OneColor):
 
     Methods:
         resample         - resample across multiple states
+        save_cellweights - output the weight of each color in each cell
         save_transitions - output the state transition matrix
+        shutdown         - stop the worker pool used in parallel mode (see
+                           OneColor)
     """
 
-    def __init__(self, nwalkers, partition):
+    def __init__(self, nwalkers, partition, seed=None, nworkers=None, pooltype='process'):
         """
         Initialize a new instance of MultiColor.
 
         Parameters:
             nwalkers  - the target number of walkers
             partition - an aweclasses.SinkStates instance
+            seed      - a seed for the random number generator
+            nworkers  - the number of parallel workers (see OneColor)
+            pooltype  - 'process' or 'thread' (see OneColor)
 
         Returns: 
             None
         """
 
         # Set up the output filepath and target weights
-        OneColor.__init__(self, nwalkers)
+        OneColor.__init__(self, nwalkers, seed=seed, nworkers=nworkers,
+                          pooltype=pooltype)
 
         # Partitioning of the states (e.g. conformation space cells)
         self.partition   = partition
@@ -352,8 +676,8 @@ class MultiColor(OneColor):
     def resample(self, system):
         """
         Resample over multiple cells by calling the OneColor algorithm on each
-        in succession. Note: look into parallelizing running the OneColor algo
-        on each cell.
+        color in succession. The cells of each color are resampled in
+        parallel when the resampler was created with nworkers.
 
         Parameters:
             system - a processed instance of aweclasses.System to be resampled
@@ -369,34 +693,34 @@ class MultiColor(OneColor):
         ncolors = self.partition.ncolors
         trans = np.zeros((ncolors,ncolors))
 
-        # Process each walker in the system
-        for w in system.walkers:
-            # Determine the previous and current states of the walker
-            cell     = system.cell(w.assignment)
-            oldcolor = w.color
-            newcolor = cell.core
-
-            # sanity check: all walkers must have a color, but not all cells have a core.
-            # Make sure that all walkers are in a state
-            assert w.color is not None
-            assert w.color >= 0
-
-            # Update the walker to reflect its current state
-            # Most of this seems redundant from above.
-            if not cell.core == aweclasses.DEFAULT_CORE and not w.color == cell.core:
-                oldcolor = w.color   # This line seems redundant
-                newcolor = cell.core # This line seems redundant
-                print('Updating color:', w, oldcolor, '->', newcolor)
-                w.color = newcolor # Here we actually update the walker
-            else:
-                # This is redundant. If the two are already equal the
-                # assignment changes nothing, and this branch is only accessed
-                # when the two are equal.
-                oldcolor = newcolor = w.color
+        # Look up the core of the cell each walker is in
+        assignments = system.column('assignments')
+        oldcolors   = system.column('colors')
+        weights     = system.column('weights')
+
+        cells   = sorted(system.cells, key=lambda c: c.id)
+        cellids = np.array([c.id   for c in cells], dtype=np.int64)
+        cores   = np.array([c.core for c in cells], dtype=np.int64)
+        where   = np.minimum(np.searchsorted(cellids, assignments), max(len(cells) - 1, 0))
+        if len(assignments) > 0 and not (cellids[where] == assignments).all():
+            raise KeyError('Walkers assigned to cells not in the system')
+        cores   = cores[where]
+
+        # sanity check: all walkers must have a color, but not all cells have a core.
+        # Make sure that all walkers are in a state
+        assert (oldcolors >= 0).all()
+
+        # Update the walkers whose cell has a core of another color to
+        # reflect their current state
+        newcolors = np.where(cores == aweclasses.DEFAULT_CORE, oldcolors, cores)
+        changed   = np.flatnonzero(newcolors != oldcolors)
+        if len(changed) > 0:
+            print(time.asctime(), 'Updating color of', len(changed), 'walkers')
+            system.set_colors(changed, newcolors[changed])
+
+        # Add the transitions to the transition matrix.
+        np.add.at(trans, (oldcolors, newcolors), weights)
 
-            # Add the transition to the transition matrix.
-            trans[oldcolor, newcolor] += w.weight
-        
         # Add all transitions to the instance transition matrix
         self.transitions = np.append(self.transitions,trans,axis=0)
 
@@ -407,26 +731,14 @@ class MultiColor(OneColor):
         for color in system.colors:
             # Get all walkers of the color
             thiscolor  = system.filter_by_color(color)
-            print(time.asctime(), 'Resampling color', color, len(thiscolor.walkers), 'walkers')
+            print(time.asctime(), 'Resampling color', color, len(thiscolor), 'walkers')
             
             # Perform resampling and add to the new system
             resampled  = OneColor.resample(self, thiscolor)
             newsystem += resampled
 
         # Output information about the new system for restart and analysis use
-        of = open(self.cellweights_path,'a')
-        for cell in newsystem.cells:
-            # Get the corresponding cell from the old system
-            thiscell = system.filter_by_cell(cell)
-
-            for color in thiscell.colors:
-                # Get the corresponding color from the cell in the old system
-                thiscolor = thiscell.filter_by_color(color)
-
-                # Output information about the cell and color
-                of.write(str(self.iteration)+','+str(cell.id)+','+str(color)+ \
-                    ','+str(sum(thiscolor.weights))+'\n')
-        of.close()
+        self.save_cellweights(system, newsystem)
 
         # This iteration is finished, so increment
         self.iteration += 1
@@ -436,6 +748,42 @@ class MultiColor(OneColor):
 
         return newsystem
 
+    def save_cellweights(self, system, newsystem):
+        """
+        Output the total weight of each color in each cell of the system
+        before resampling. The weights are summed per (cell, color) pair in
+        one pass over the walker table instead of filtering the System for
+        every cell and color.
+
+        Parameters:
+            system    - the aweclasses.System instance before resampling
+            newsystem - the resampled aweclasses.System instance
+
+        Returns:
+            None
+        """
+
+        cellids = system.column('assignments')
+        colors  = system.column('colors')
+        weights = system.column('weights')
+
+        # Group the walkers by (cell, color) and sum the weights of each group
+        totals = defaultdict(list)
+        if len(weights) > 0:
+            pairs, groups = np.unique(np.vstack((cellids, colors)), axis=1,
+                                      return_inverse=True)
+            sums = np.bincount(groups.ravel(), weights=weights)
+            for (cid, color), total in zip(pairs.T.tolist(), sums.tolist()):
+                totals[cid].append((color, total))
+
+        of = open(self.cellweights_path,'a')
+        for cell in newsystem.cells:
+            for color, total in totals.get(cell.id, ()):
+                # Output information about the cell and color
+                of.write(str(self.iteration)+','+str(cell.id)+','+str(color)+ \
+                    ','+str(total)+'\n')
+        of.close()
+
     def save_transitions(self, path):
         """
         Output the state transition matrix to a file.
@@ -630,6 +978,7 @@ class ISaver(IResampler):
         resample - resample a system by the resampler
         save     - save data to datfile
         heading  - the heading for the datfile
+        shutdown - shut down the resampler
     """
 
     @typecheck(IResampler, datfile=str)
@@ -704,6 +1053,20 @@ class ISaver(IResampler):
 
         return newsystem
 
+    def shutdown(self):
+        """
+        Shut down the resampler, e.g. stop the workers of a parallel
+        OneColor or MultiColor.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        self.resampler.shutdown()
+
 class SaveWeights(ISaver):
     """
     A utility for saving walker weights to a file.
@@ -717,6 +1080,7 @@ class SaveWeights(ISaver):
         resample - resample a system by the resampler
         save     - save data to datfile
         heading  - the heading for the datfile
+        shutdown - shut down the resampler
     """
 
     def __init__(self, resampler, datfile=None):
@@ -13,8 +13,12 @@ from .util import typecheck
 import numpy as np
 
 import time as systime
+import copy
 import gzip
+import math
 import os
+import random
+import threading
 
 
 class Timer(object):
@@ -434,59 +438,193 @@ class ExtendableArray(object):
         return repr(self._vals[:self._count])
             
 
+class QuantileSketch(object):
+    """
+    A KLL sketch of a stream of numbers: approximate quantiles in bounded
+    memory. Values are kept in levels where a value at level h stands for
+    2**h values of the stream. When a level is full it is sorted and every
+    other value, starting at random, moves up a level. The capacity of the
+    levels shrinks by 2/3 from the top level down, so about 3k values are
+    kept and the rank error of a quantile is about 1.7/k.
+
+    Fields:
+        k       - the capacity of the top level, which sets the accuracy
+        count   - the number of values in the stream
+        _levels - the values kept at each level
+        _size   - the number of values kept
+        _limit  - the number of values kept that triggers a compaction
+        _random - the random number generator choosing what to compact
+
+    Methods:
+        update   - add values
+        merge    - add the values of another sketch
+        quantile - the approximate quantiles of the stream
+    """
+
+    def __init__(self, k=200, seed=None):
+        self.k       = k
+        self.count   = 0
+        self._levels = [[]]
+        self._size   = 0
+        self._limit  = self._capacity(0)
+        self._random = random.Random(seed)
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        odict['_levels'] = [np.array(level, dtype=float) for level in self._levels]
+        return odict
+
+    def __setstate__(self, odict):
+        self.__dict__.update(odict)
+        self._levels = [level.tolist() for level in self._levels]
+
+    def __len__(self):
+        return self.count
+
+    def _capacity(self, h):
+        depth = len(self._levels) - h - 1
+        return max(2, int(math.ceil(self.k * (2. / 3) ** depth)))
+
+    def update(self, *values):
+        """
+        Add values to the sketch.
+
+        Parameters:
+            values - the values to add
+
+        Returns:
+            None
+        """
+
+        level = self._levels[0]
+        for v in values:
+            level.append(v)
+            self._size += 1
+            self.count += 1
+            if self._size >= self._limit:
+                self._compress()
+                level = self._levels[0]
+
+    def merge(self, other):
+        """
+        Add the values of another sketch. The other sketch is unchanged.
+
+        Parameters:
+            other - a QuantileSketch
+
+        Returns:
+            None
+        """
+
+        while len(self._levels) < len(other._levels):
+            self._levels.append([])
+        for mine, theirs in zip(self._levels, other._levels):
+            mine.extend(theirs)
+        self.count += other.count
+        self._size  = sum(len(level) for level in self._levels)
+        self._limit = sum(self._capacity(h) for h in range(len(self._levels)))
+        while self._size >= self._limit:
+            self._compress()
+
+    def _compress(self):
+        """
+        Compact the lowest full level into the one above.
+        """
+
+        for h, level in enumerate(self._levels):
+            if len(level) >= self._capacity(h):
+                break
+
+        if h + 1 == len(self._levels):
+            self._levels.append([])
+
+        level.sort()
+        # An odd value out stays at this level
+        keep = [level.pop()] if len(level) % 2 else []
+        promoted = level[self._random.randint(0, 1)::2]
+        self._levels[h + 1].extend(promoted)
+        self._levels[h] = keep
+
+        self._size -= len(level) - len(promoted)
+        self._limit = sum(self._capacity(i) for i in range(len(self._levels)))
+
+    def quantile(self, q):
+        """
+        The approximate quantiles of the stream.
+
+        Parameters:
+            q - a quantile or a sequence of quantiles, between 0 and 1
+
+        Returns:
+            The value at each quantile (a float or a numpy.array), NaN if
+            the sketch is empty
+        """
+
+        qs = np.atleast_1d(np.asarray(q, dtype=float))
+        if self.count == 0:
+            result = np.full(len(qs), np.nan)
+        else:
+            values  = np.concatenate([np.asarray(level, dtype=float) for level in self._levels])
+            weights = np.concatenate([np.full(len(level), 2. ** h)
+                                      for h, level in enumerate(self._levels)])
+            order   = np.argsort(values, kind='stable')
+            values  = values[order]
+            ranks   = np.cumsum(weights[order])
+            which   = np.searchsorted(ranks, qs * ranks[-1], side='left')
+            result  = values[np.minimum(which, len(values) - 1)]
+        return result if np.ndim(q) else float(result[0])
+
+
 class Statistics(object):
     """
-    Keeps track of running statistics as workers work using an ExtendableArray.
+    Keeps track of running statistics of a stream of values in bounded
+    memory: count, mean and variance exactly (Welford), quantiles
+    approximately (see QuantileSketch).
 
     Fields:
-        _num    - The number of of values in the ExtendableArray
-        _mean   - The mean of values in the ExtendableArray
-        _m2     - The second statistical moment
-        _values - The ExtendableArray containing values on which to run stats
+        _num    - The number of values
+        _mean   - The mean of the values
+        _m2     - The sum of squared deviations from the mean
+        _min    - The smallest value
+        _max    - The largest value
+        _sketch - The QuantileSketch of the values
 
     Properties:
-        num     - The number of elements in the ExtendableArray
-        mean    - The mean of values in the ExtendableArray
-        var     - The variance of values in the ExtendableArray
-        std     - The standard deviation of values in the ExtendableArray
+        num     - The number of values
+        mean    - The mean of the values
+        var     - The variance of the values
+        std     - The standard deviation of the values
+        min     - The smallest value
+        max     - The largest value
 
     Methods:
-        values  - Getter for the ExtendableArray
-        update  - Append values to the ExtendableArray and update the stats 
-
+        update   - Add values and update the stats
+        merge    - Add the values of another Statistics
+        quantile - The approximate quantiles of the values
+        summary  - The stats as a dictionary
     """
 
-    def __init__(self):
+    def __init__(self, k=200):
 
         self._num    = 0
         self._mean   = 0.
         self._m2     = 0.
+        self._min    = np.inf
+        self._max    = -np.inf
 
-        self._values = ExtendableArray() # keep track of the actual values for plots
+        self._sketch = QuantileSketch(k=k)
 
     # Properties for useful statistics. The first two were probably unneccessary.
     num  = property(lambda self: self._num)
     mean = property(lambda self: self._mean)
-    var  = property(lambda self: self._m2 / float(self._num))
+    var  = property(lambda self: self._m2 / float(self._num) if self._num else np.nan)
     std  = property(lambda self: math.sqrt(self.var))
-
-    @property
-    def values(self):
-        """
-        Access the values added to the ExtendableArray.
-
-        Parameters:
-            None
-
-        Returns:
-            numpy.array slice containing all values added to the statistics class
-        """
-
-        return self._values.get()
+    min  = property(lambda self: self._min)
+    max  = property(lambda self: self._max)
 
     def update(self, *values):
         """
-        Add a value to the ExtendableArray and update all statistics.
+        Add values and update all statistics.
         
         Parameters:
             values - a list of values to add
@@ -495,14 +633,63 @@ class Statistics(object):
             None
         """
 
-        self._values.append(*values)
+        self._sketch.update(*values)
 
         for t in values:
             self._num += 1
             delta      = t - self._mean
             self._mean = self._mean + delta / float(self._num)
             self._m2   = self._m2 + delta * (t - self._mean)
+            self._min  = min(self._min, t)
+            self._max  = max(self._max, t)
+
+    def merge(self, other):
+        """
+        Add the values of another Statistics. The other is unchanged.
+
+        Parameters:
+            other - a Statistics instance
+
+        Returns:
+            None
+        """
+
+        if other._num == 0:
+            return
+
+        num        = self._num + other._num
+        delta      = other._mean - self._mean
+        self._m2   = self._m2 + other._m2 + delta * delta * self._num * other._num / float(num)
+        self._mean = self._mean + delta * other._num / float(num)
+        self._num  = num
+        self._min  = min(self._min, other._min)
+        self._max  = max(self._max, other._max)
+        self._sketch.merge(other._sketch)
+
+    def quantile(self, q):
+        """
+        The approximate quantiles of the values. See QuantileSketch.quantile.
+        """
+
+        return self._sketch.quantile(q)
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        The statistics as a dictionary.
 
+        Parameters:
+            quantiles - the quantiles to include
+
+        Returns:
+            A dictionary with the keys num, mean, std, min, max and pQ for
+            each quantile Q as a percentage, e.g. p50
+        """
+
+        summary = dict(num=self.num, mean=self.mean, std=self.std,
+                       min=self.min, max=self.max)
+        for q, v in zip(quantiles, self.quantile(quantiles)):
+            summary['p%g' % (100 * q)] = float(v)
+        return summary
 
     def __str__(self):
         return 'N = %s mean = %s std = %s' % (self.num, self.mean, self.std)
@@ -512,12 +699,13 @@ class Statistics(object):
 class WQStats(object):
     """
     Keeps track of statistics about running time and the amount of data
-    transferred.
+    transferred, for the current iteration and for the whole run, in
+    bounded memory (see Statistics).
 
     Fields:
         logger                  - the logging utility to use
-        _task_times             - the list of running times for returned tasks
-        _wq_times               - the list of running times for parts of WQ
+        iteration               - the Statistics of each metric over the
+                                  tasks of the current iteration
         computation_time        - keeps track of statistics surrounding the
                                   computational time for a task
         total_bytes_transferred - keeps track of statistics surrounding the
@@ -526,8 +714,20 @@ class WQStats(object):
                                   amount of time spent transferring data
         task_life_time          - keeps track of statistics surrounding the
                                   amount of time tasks take to execute
+
+    Methods:
+        task           - log information about a returned task
+        summarize      - add a returned task to the statistics
+        log_iteration  - log the statistics of the iteration
+        new_iteration  - start the statistics of a new iteration
+        state          - the statistics, to checkpoint
+        restore        - restore the statistics from a checkpoint
+        save           - save the statistics to a file
     """
 
+    METRICS = ('computation_time', 'total_bytes_transferred', 'total_transfer_time',
+               'task_life_time')
+
     def __init__(self, logger=None):
 
         """
@@ -542,18 +742,15 @@ class WQStats(object):
 
         self.logger = logger or StatsLogger()
 
-        self._task_times             = ExtendableArray()  # keep track of the times values are added
-        self._wq_times               = ExtendableArray()
-
         ### task stats
         self.computation_time        = Statistics()
         self.total_bytes_transferred = Statistics()
         self.total_transfer_time     = Statistics()
         self.task_life_time          = Statistics()       # WQ Task.finish_time - Task.submit_time
 
+        self.iteration = dict((name, Statistics()) for name in self.METRICS)
 
 
-    @typecheck(workqueue.WQ.Task)
     def task(self, task):
         """
         Add information about a returned task to the logger.
@@ -569,21 +766,25 @@ class WQStats(object):
 
         component = 'TASK'
 
-        self.logger.update(t, component, 'host'                  , task.host)
-        self.logger.update(t, component, 'tag'                   , task.tag)
-        self.logger.update(t, component, 'result'                , task.result)
-        self.logger.update(t, component, 'return_status'         , task.return_status)
-        self.logger.update(t, component, 'total_bytes_transfered', task.total_bytes_transferred)
+        # The task and host go along with each value in metrics logs
+        def update(name, value):
+            self.logger.update(t, component, name, value, task=task.tag, host=task.host)
+
+        update('host'                  , task.host)
+        update('tag'                   , task.tag)
+        update('result'                , task.result)
+        update('return_status'         , task.return_status)
+        update('total_bytes_transfered', task.total_bytes_transferred)
 
         # try/except: support different versions of cctools
         try:
             ### autobuild
             comp_time = task.cmd_execution_time
             comp_name = 'cmd_execution_time'
-            self.logger.update (t, component, 'time_send_files'  ,
-                                (task.send_input_finish - task.send_input_start     ) / 10.**6)
-            self.logger.update (t, component, 'time_receive_files' ,
-                                (task.receive_output_finish - task.receive_output_start ) / 10.**6)
+            update('time_send_files'   ,
+                   (task.send_input_finish - task.send_input_start     ) / 10.**6)
+            update('time_receive_files',
+                   (task.receive_output_finish - task.receive_output_start ) / 10.**6)
 
 
 
@@ -593,81 +794,126 @@ class WQStats(object):
             comp_name  = 'computation_time'
 
         ### convert all times to seconds from microseconds
-        self.logger.update (t, component, comp_name            ,
-                            comp_time                                                 / 10.**6)
-        self.logger.update (t, component, 'total_transfer_time',
-                            task.total_transfer_time                                  / 10.**6)
+        update(comp_name            ,
+               comp_time                                                 / 10.**6)
+        update('total_transfer_time',
+               task.total_transfer_time                                  / 10.**6)
+
+        update('turnaround_time'    ,
+               (task.finish_time           - task.submit_time          ) / 10.**6)
+
+    def summarize(self, task):
+        """
+        Add a returned task to the statistics of the iteration and of the
+        run.
+
+        Parameters:
+            task - a completed Work Queue task
+
+        Returns:
+            None
+        """
+
+        # try/except: support different versions of cctools
+        try:
+            comp_time = task.cmd_execution_time
+        except AttributeError:
+            comp_time = task.computation_time
+
+        ### convert all times to seconds from microseconds
+        values = dict(computation_time        = comp_time / 10.**6,
+                      total_bytes_transferred = task.total_bytes_transferred,
+                      total_transfer_time     = task.total_transfer_time / 10.**6,
+                      task_life_time          = (task.finish_time - task.submit_time) / 10.**6)
 
-        self.logger.update (t, component, 'turnaround_time'    ,
-                            (task.finish_time           - task.submit_time          ) / 10.**6)
+        for name, value in values.items():
+            getattr(self, name).update(value)
+            self.iteration[name].update(value)
 
+    def log_iteration(self, t=None):
+        """
+        Log the count, mean, standard deviation, extremes and quantiles of
+        each metric over the tasks of the iteration, as the WQ component.
 
+        Parameters:
+            t - the time of the records, defaults to now
 
-    def save(self, wqstats, taskstats):
+        Returns:
+            None
         """
-        @param wqstats: path to save the wq stats to
-        @param taskstats: path to save the task stats to
+
+        t = systime.time() if t is None else t
+        for name in self.METRICS:
+            stats = self.iteration[name]
+            if stats.num == 0:
+                continue
+            for key, value in sorted(stats.summary().items()):
+                self.logger.update(t, 'WQ', '%s_%s' % (name, key), value)
+
+    def new_iteration(self):
         """
+        Start the statistics of a new iteration. The statistics of the run
+        are kept.
 
-        with open(wqstats, 'w') as fd:
-            self._save_wq_stats(fd)
+        Parameters:
+            None
 
-        with open(taskstats, 'w') as fd:
-            self._save_task_stats(fd)
+        Returns:
+            None
+        """
 
+        self.iteration = dict((name, Statistics()) for name in self.METRICS)
 
-    def _save_attrs(self, fd, name, times, attrs):
+    def state(self):
         """
-        Save attributes to a specified log file. Used to save task and WQ
-        attributes for debug, logging, and tuning purposes.
+        The statistics of the iteration and of the run, to checkpoint. The
+        state is a copy and does not change with the statistics.
 
         Parameters:
-            fd    - a File object representing a log file open in write mode
-            name  - the name of the object whose attributes will be saved
-            times - times associated with the object to be saved (e.g., running
-                    time, computational time, lifetime)
-            attrs - an iterable containing object attributes to record
+            None
+
+        Returns:
+            A dictionary, see restore
         """
-        
-        print('Saving', name, 'data to', fd.name)
-        data = dict()
-        data['time'] = times
-        print('\t', 'time')
-        for a in attrs:
-            print('\t', a)
-            data[a] = getattr(self, a).values
-        np.savez(fd, **data)
 
-    def _save_task_stats(self, fd):
+        return copy.deepcopy(dict(iteration  = self.iteration,
+                                  cumulative = dict((name, getattr(self, name))
+                                                    for name in self.METRICS)))
+
+    def restore(self, state):
         """
-        Call to _save_attrs for saving statistics associated with a WQ task.
+        Restore the statistics from a checkpoint.
 
         Parameters:
-            fd - a File object representing a log file open in write mode
+            state - a dictionary returned by state
 
         Returns:
             None
         """
-        
-        attrs = 'computation_time total_bytes_transferred total_transfer_time task_life_time'.split()
-        self._save_attrs(fd, 'task', self._task_times.get(), attrs)
 
-    def _save_wq_stats(self, fd):
+        self.iteration = dict(state['iteration'])
+        for name, stats in state['cumulative'].items():
+            setattr(self, name, stats)
+
+    def save(self, path):
         """
-        Call to _save_attrs for saving statistics associated with the WQ object.
+        Save the summaries of the statistics of the iteration and of the run.
 
         Parameters:
-            fd - a File object representing a log file open in write mode
+            path - the path of the .npz file to write
 
         Returns:
             None
         """
-        
-        attrs =  'workers_ready workers_busy tasks_running tasks_waiting tasks_complete'.split()
-        attrs += 'total_tasks_dispatched total_tasks_complete total_workers_joined'.split()
-        attrs += 'total_workers_removed total_bytes_sent total_bytes_received'.split()
-        attrs += 'total_send_time total_receive_time'.split()
-        self._save_attrs(fd, 'wq', self._wq_times.get(), attrs)
+
+        data = dict()
+        for prefix, stats in (('iteration', self.iteration),
+                              ('cumulative', dict((name, getattr(self, name))
+                                                  for name in self.METRICS))):
+            for name in self.METRICS:
+                for key, value in stats[name].summary().items():
+                    data['%s_%s_%s' % (prefix, name, key)] = value
+        np.savez(path, **data)
 
 
 
@@ -678,6 +924,7 @@ class Timings(object):
     Fields:
         timer - the stopwatch
         times - holds the ending time of each stopwatch run
+        elapsed - holds the elapsed time of each stopwatch run
         stats - contains elapsed times and performs statistical operations
 
     Methods:
@@ -699,12 +946,13 @@ class Timings(object):
 
         self.timer = Timer()
         self.times = ExtendableArray()
+        self.elapsed = ExtendableArray()
         self.stats = Statistics()
 
     @property
     def data(self):
         """
-        Returns the system and elapsed times from the times and stats fields.
+        Returns the system and elapsed times from the times and elapsed fields.
 
         Parameters:
             None
@@ -714,7 +962,7 @@ class Timings(object):
             containing the elapsed times recorded at each system time
         """
 
-        return self.times.get(), self.stats.values
+        return self.times.get(), self.elapsed.get()
 
     def start(self):
         """
@@ -742,6 +990,7 @@ class Timings(object):
 
         self.timer.stop()
         self.times.append(systime.time())
+        self.elapsed.append(self.timer.elapsed())
         self.stats.update(self.timer.elapsed())
 
 
@@ -755,6 +1004,9 @@ class AWEStats(object):
         resample  - the elapsed time of the resampling process between iters
         barrier   - ???
         logger    - the logger used to output AWE statistics
+        log_it    - whether the elapsed times are written to the logger
+        last      - the last elapsed time of each stopwatch, by name; kept
+                    whether or not they are logged
 
     Methods:
         _timeit       - start or stop a stopwatch
@@ -765,13 +1017,14 @@ class AWEStats(object):
         open          - open the logging utility's logfile
     """
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, log_it=True):
 
         """
         Initialize a new instance of AWEStats.
 
         Parameters:
             logger - the class to use as a logging utility
+            log_it - if False, only keep the last elapsed times
         """
 
         self.iteration = Timer()
@@ -779,6 +1032,8 @@ class AWEStats(object):
         self.barrier   = Timer()
 
         self.logger    = logger or StatsLogger()
+        self.log_it    = log_it
+        self.last      = dict()
 
     @typecheck(str, Timings)
     def _timeit(self, state, timings, name):
@@ -791,7 +1046,9 @@ class AWEStats(object):
         elif state.lower() == 'stop':
             timings.stop()
             t = systime.time()
-            self.logger.update(t, 'AWE', name, timings.elapsed())
+            self.last[name] = timings.elapsed()
+            if self.log_it:
+                self.logger.update(t, 'AWE', name, self.last[name])
             timings.reset()
         else:
             raise ValueError('Unknown state %s: valid: {start|stop}' % state)
@@ -866,27 +1123,48 @@ class StatsLogger (object):
     """
     Logging utility to manage log file File objects and write to log files.
 
+    Records are kept in memory and written to the gzip file in batches of
+    buffersize records. In background mode a writer thread does the
+    writing and the compression, so that logging never waits for them: it
+    writes when buffersize records are queued or every flushinterval
+    seconds, whichever comes first.
+
     Fields:
-        _fd         - the File object pointing to the log file
-        _path       - the filepath of the logfile
-        _buffersize - the size of the write buffer
+        _fd            - the File object pointing to the log file
+        _path          - the filepath of the logfile
+        _buffersize    - the number of records written at once
+        _background    - whether a writer thread writes the records
+        _flushinterval - the longest time a record waits for the writer
+        _records       - the records not written yet
+        _pending       - the number of records taken by the writer and not
+                         written yet
+        _cond          - the condition guarding _records and _pending
+        _filelock      - the lock guarding _fd
+        _thread        - the writer thread, if any
+        _stop          - whether the writer thread should exit
+        _flushes       - the number of flushes waiting for the writer
 
     Methods:
         path   - get the path to the log file
         update - write an object representation to the logfile
         output - write an arbitrary string to the logfile
+        flush  - write every queued record and flush the logfile
         close  - close the File object
         open   - open the File object
     """
 
-    def __init__(self, path='debug/stats.log.gz', buffersize=9):
+    def __init__(self, path='debug/stats.log.gz', buffersize=9, background=False,
+                 flushinterval=1.0):
         """
         Initialize a new StatsLogger that points to the logfile.
 
         Parameters:
-            path       - the filepath to the logfile, may be absolute or
-                         relative
-            buffersize - the size of the write buffer
+            path          - the filepath to the logfile, may be absolute or
+                            relative
+            buffersize    - the number of records to write at once
+            background    - if True, write the records on a separate thread
+            flushinterval - in background mode, the longest time in seconds
+                            a record waits before it is written
         """
 
         prefix = os.path.dirname(os.path.abspath(os.path.expanduser(path)))
@@ -895,15 +1173,54 @@ class StatsLogger (object):
 
         self._fd = None
         self._path = path
-        self._buffersize = buffersize
+        self._buffersize = max(1, buffersize)
+        self._background = background
+        self._flushinterval = flushinterval
+        self._init_queue()
 
         self.open()
 
+    def _init_queue(self):
+        self._records  = []
+        self._pending  = 0
+        self._cond     = threading.Condition()
+        self._filelock = threading.Lock()
+        self._thread   = None
+        self._stop     = False
+        self._flushes  = 0
+
+    def __getstate__(self):
+        """
+        See Python docs on the pickle module for more info on __getstate__
+        The file, the locks and the writer thread are not pickled; queued
+        records are written first.
+        """
+
+        self.flush()
+        odict = self.__dict__.copy()
+        for name in ('_fd', '_records', '_pending', '_cond', '_filelock', '_thread', '_stop', '_flushes'):
+            odict.pop(name, None)
+        return odict
+
+    def __setstate__(self, odict):
+        """
+        See Python docs on the pickle module for more info on __setstate__
+        StatsLoggers pickled before records were buffered have an _fd.
+        """
+
+        odict.pop('_fd', None)
+        self.__dict__.update(odict)
+        self.__dict__.setdefault('_background', False)
+        self.__dict__.setdefault('_flushinterval', 1.0)
+        self._buffersize = max(1, self._buffersize)
+        self._fd = None
+        self._init_queue()
+
     @property
     def path(self): return self._path
 
     @typecheck(float, str, str)
-    def update(self, t, component, name, val):
+    def update(self, t, component, name, val, task=None, host=None):
         """
         Write a representation of an object (type, name of the AWE run, and
         object attributes) to the log file along with a timestamp.
@@ -913,31 +1230,139 @@ class StatsLogger (object):
             component - the type of the object to be written
             name      - the name of the object
             val       - the object values to be written
+            task      - the tag of the task the value is about, if any; not
+                        written to text logs
+            host      - the host the value is about, if any; not written to
+                        text logs
 
         Returns:
             None
         """
 
-        s = '%f %s %s %s\n' % (t, component, name, val)
-        self._fd.write(bytes(s, 'utf-8'))
+        self._queue('%f %s %s %s\n' % (t, component, name, val))
 
-    def output(self, val):
+    def output(self, val, task=None, host=None):
         """
         Write an arbitrary value to the log file.
 
         Parameters:
-            val - the value to be written to the log file, must have a string
-                  representation
+            val  - the value to be written to the log file, must have a string
+                   representation
+            task - the tag of the task whose output the value is, if any; the
+                   value is then written between START and END lines
+                   naming the task
+            host - the host the task ran on, if any; not written to text
+                   logs
+
+        Returns:
+            None
+        """
+
+        if task is None:
+            self._queue(val)
+        else:
+            self._queue("<====== WQ: START task %s output ======>\n" % task)
+            self._queue(val)
+            self._queue("<====== WQ: END task %s output ======>\n"   % task)
+
+    def _queue(self, record):
+        """
+        Queue a record, and write the queued records if there are enough of
+        them and there is no writer thread.
+        """
+
+        with self._cond:
+            self._records.append(record)
+            full = len(self._records) >= self._buffersize
+            if full and self._thread is not None:
+                self._cond.notify_all()
+
+        if full and self._thread is None:
+            self._write_queued()
+
+    def _write_queued(self):
+        """
+        Write the queued records to the log file in one batch. Records are
+        kept while the log file is closed.
+        """
+
+        if self._fd is None:
+            return
+
+        with self._cond:
+            records, self._records = self._records, []
+            self._pending += len(records)
+
+        try:
+            if records:
+                with self._filelock:
+                    if self._fd is not None:
+                        self._write_records(records)
+        finally:
+            with self._cond:
+                self._pending -= len(records)
+                self._cond.notify_all()
+
+    def _write_records(self, records):
+        """
+        Write a batch of records to the open log file.
+        """
+
+        self._fd.write(bytes(''.join(records), 'utf-8'))
+
+    def _open_file(self):
+        return gzip.GzipFile(self._path, 'ab')
+
+    def _writer(self):
+        """
+        The body of the writer thread.
+        """
+
+        try:
+            while True:
+                with self._cond:
+                    if not (self._stop or self._flushes) and len(self._records) < self._buffersize:
+                        self._cond.wait(self._flushinterval)
+                    stop = self._stop
+
+                self._write_queued()
+                if stop:
+                    return
+        finally:
+            # Later records are written by the threads that log them
+            with self._cond:
+                self._thread = None
+                self._cond.notify_all()
+
+    def flush(self):
+        """
+        Write every queued record and flush the log file. Safe to call from
+        any thread.
+
+        Parameters:
+            None
 
         Returns:
             None
         """
 
-        self._fd.write(bytes(val, 'utf-8'))
+        with self._cond:
+            self._flushes += 1
+            self._cond.notify_all()
+            while (self._records or self._pending) and self._thread is not None:
+                self._cond.wait()
+            self._flushes -= 1
+
+        self._write_queued()
+
+        with self._filelock:
+            if self._fd is not None:
+                self._fd.flush()
 
     def close(self):
         """
-        Close the File object associated with the log file.
+        Write every queued record and close the File object associated with
+        the log file.
 
         Parameters:
             None
@@ -946,13 +1371,25 @@ class StatsLogger (object):
             None
         """
 
-        if self._fd is not None:
-            self._fd.close()
-            self._fd = None
+        thread = self._thread
+        if thread is not None:
+            with self._cond:
+                self._stop = True
+                self._cond.notify_all()
+            thread.join()
+            self._stop = False
+
+        self._write_queued()
+
+        with self._filelock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
 
     def open(self):
         """
-        Open the File object associated with the log file.
+        Open the File object associated with the log file, and start the
+        writer thread in background mode.
 
         Parameters:
             None
@@ -961,5 +1398,11 @@ class StatsLogger (object):
             None
         """
 
-        if self._fd is None:
-            self._fd = gzip.GzipFile(self._path, 'ab')
+        with self._filelock:
+            if self._fd is None:
+                self._fd = self._open_file()
+
+        if self._background and self._thread is None:
+            self._thread = threading.Thread(target=self._writer)
+            self._thread.daemon = True
+            self._thread.start()
@@ -8,12 +8,21 @@ See the file COPYING for details.
 
 
 import awe
+from . import executor
+from . import profiler
 
-import work_queue as WQ
+try:
+    import work_queue as WQ
+except ImportError:
+    # Only the local executor is available without cctools
+    WQ = None
 
 import os, tarfile, tempfile, time, shutil, traceback, random, re
-from collections import defaultdict
-from functools import reduce
+import asyncio
+from concurrent import futures
+from collections import defaultdict, deque
+
+import numpy as np
 
 ### A process can only support a single WorkQueue instance
 _AWE_WORK_QUEUE = None
@@ -29,17 +38,17 @@ _AWE_WORK_QUEUE = None
 PICKLE_BASE = 'awe-instance-data/pickle/'
 
 WORKER_POSITIONS_NAME = 'structure.pdb' # The PDB used to generate a trajectory
+WORKER_PAYLOAD_NAME   = 'walker.bin'    # The binary walker coordinates (see payload)
+WORKER_TOPOLOGY_NAME  = 'topology.pdb'  # The topology, cached on each worker
 WORKER_WALKER_NAME    = 'walker.pkl'    # The walker object for the task
 WORKER_WEIGHTS_NAME   = 'weight.dat'    # The weight for each walker
 WORKER_COLOR_NAME     = 'color.dat'     # The color (state?) of the walker
 WORKER_CELL_NAME      = 'cell.dat'      # The list of exemplar configurations
-WORKER_RESULTS_NAME   = 'results.tar'   # The file to return to the master
 
 RESULT_POSITIONS = 'structure2.pdb' # The PDB of the final trajectory frame
 RESULT_WEIGHTS   = 'weight.dat'     # The weight of the resulting configuration
 RESULT_COLOR     = 'color.dat'      # The color (state) of the walker
 RESULT_CELL      = 'cell2.dat'      # The updated cells information
-RESULT_NAME      = 'results.tar'    # The file to return to the master
 
 
 class WorkQueueException       (Exception): pass
@@ -134,26 +143,33 @@ class Config(object):
         port            - the port on which the WorkQueue master listens
         schedule        - the task scheduling algorithm to use
         exclusive       - whether or not the WorkQueue instance is singleton
+        executor        - 'workqueue' to run tasks on cctools Work Queue
+                          workers, 'local' to run them in local processes,
+                          or an executor.Executor instance to use as is
+        localworkers    - the number of processes for the local executor
         catalog         -
         debug           - which information to include in logs
         shutdown        -
         fastabort       -
         restarts        - the number of times to restart a failed task
-        maxreps         -
+        maxreps         - the maximum number of duplicates of a task
+        replicabudget   - the number of duplicates allowed in an iteration,
+                          as a fraction of its tasks (see ReplicationPolicy)
         waittime        -
         wq_logfile      - the log file for WorkQueue debug information
         wqstats_logfile - the log file for WorkQueue statistical information
         monitor         -
         summaryfile     - the log file for WorkQueue run basic information
         capacity        -
-        _executable     - the script or executable that the task should run
+        _executable     - the script or executable that the task should run,
+                          or a Python callable for the local executor
         _cache          -
 
     Methods:
         execute - add the main program to run to the task cached file list
         cache   - add files to the task cached file list
-        _mk_wq  - create a WorkQueue instance or get a reference to the
-                  singleton
+        _mk_wq  - create the task executor; for cctools Work Queue, create
+                  a WorkQueue instance or get a reference to the singleton
     """
 
     def __init__(self):
@@ -169,15 +185,18 @@ class Config(object):
         """
 
         self.name            = ''
-        self.port            = WQ.WORK_QUEUE_DEFAULT_PORT
-        self.schedule        = WQ.WORK_QUEUE_SCHEDULE_TIME
+        self.port            = WQ.WORK_QUEUE_DEFAULT_PORT  if WQ else 9123
+        self.schedule        = WQ.WORK_QUEUE_SCHEDULE_TIME if WQ else None
         self.exclusive       = True
+        self.executor        = 'workqueue'
+        self.localworkers    = None
         self.catalog         = False
         self.debug           = ''
         self.shutdown        = False
         self.fastabort       = 3
         self.restarts        = 95 # until restarts are handled on a per-iteration basis
         self.maxreps         = 9
+        self.replicabudget   = 1.0
         self.waittime        = 10 # in seconds
         self.wq_logfile      = 'debug/wq.log'
         self.wqstats_logfile = 'debug/wq-stats.log'
@@ -199,12 +218,17 @@ class Config(object):
         to the cache.
 
         Parameters:
-            path - filepath of the program to execute
+            path - filepath of the program to execute, or a Python callable
+                   taking the task directory (local executor only)
 
         Returns:
             None
         """
 
+        if callable(path):
+            self._executable = path
+            return
+
         f = WQFile(path)
         self._executable = f
         self._cache.add(f)
@@ -244,9 +268,18 @@ class Config(object):
             None
 
         Returns:
-            The cctools WorkQueue singleton object
+            An executor.Executor instance
         """
 
+        if isinstance(self.executor, executor.Executor):
+            return self.executor
+        elif self.executor == 'local':
+            return executor.LocalExecutor(workers=self.localworkers)
+        elif self.executor != 'workqueue':
+            raise ValueError('Unknown executor %r' % self.executor)
+        elif WQ is None:
+            raise ImportError('The cctools work_queue module is required for the workqueue executor')
+
         global _AWE_WORK_QUEUE
         if _AWE_WORK_QUEUE is not None:
             ### warn
@@ -296,7 +329,7 @@ class Config(object):
                 wq.activate_fast_abort(self.fastabort)
 
             # Ensure that the singleton is set to the new instance
-            _AWE_WORK_QUEUE = wq
+            _AWE_WORK_QUEUE = executor.WorkQueueExecutor(wq)
 
         # Ensure that the singleton is logging to the correct files
         awe.util.makedirs_parent(self.wqstats_logfile)
@@ -308,25 +341,29 @@ class Config(object):
 
 class TagSet(object):
     """
-    Manages tags for identifying submitted tasks. Tags are stored in sets
-    indexed in a dictionary by the total number of duplicates existing for
-    that particular tag (e.g. if tag in self._tags[3], there exist three
-    duplicates of that tag).
+    Manages tags for identifying submitted tasks. Each tag is mapped to the
+    number of duplicates existing for it, and tags are grouped in buckets by
+    that count (e.g. if tag is in the bucket for 3, there exist three
+    duplicates of that tag). Each bucket is a list with a tag -> position
+    index, so that tags can be added, removed and drawn at random in
+    constant time.
 
     Fields:
-        _tags    - the dictionary of sets of tags
-        _maxreps - the maximum number of times a tag may be duplicated
+        _counts    - the number of duplicates of each tag
+        _buckets   - the list of tags with each number of duplicates
+        _positions - the position of each tag in its bucket
+        _len       - the total number of tags
+        _maxreps   - the maximum number of times a tag may be duplicated
 
     Methods:
         can_duplicate   - determines whether any task can be duplicated
         clear           - clear the tag set dictionary
-        clean           - remove a tag set from the dictionary if it contains
-                          no tags
-        _find_tag_group - find the set containing a specific tag in the
-                          dictionary
+        clean           - remove empty buckets (they are removed eagerly)
+        _find_tag_group - find the number of duplicates of a specific tag
         add             - add a tag (or duplicate) to the dictionary
         select          - get a random tag from the tag set with the least
                           duplicates
+        duplicable      - iterate over the tags that may be duplicated
         discard         - remove a tag from the dictionary
     """
 
@@ -341,9 +378,27 @@ class TagSet(object):
             None
         """
 
-        # Return an empty set if a key does not exist (see Python docs)
-        self._tags = defaultdict(set)
-        self._maxreps = maxreps
+        self._counts    = dict()   # tag   -> number of duplicates
+        self._buckets   = dict()   # count -> list of tags
+        self._positions = dict()   # tag   -> position in its bucket
+        self._len       = 0
+        self._maxreps   = maxreps
+
+    def __setstate__(self, odict):
+        """
+        See Python docs on the pickle module for more info on __setstate__
+        TagSets pickled before the buckets were indexed store a dictionary
+        of sets of tags in _tags.
+        """
+
+        if '_tags' in odict:
+            tags = odict.pop('_tags')
+            self.__init__(maxreps=odict['_maxreps'])
+            for count, group in tags.items():
+                for tag in group:
+                    self._insert(tag, count)
+        else:
+            self.__dict__.update(odict)
 
     def can_duplicate(self):
         """
@@ -356,9 +411,7 @@ class TagSet(object):
             A Boolean value representing whether any tag can be duplicated
         """
 
-        #valid = filter(lambda k: k < self._maxreps, self._tags.iterkeys())
-        valid = [k for k in iter(self._tags.keys()) if k < self._maxreps]
-        return len(valid) > 0
+        return any(k < self._maxreps for k in self._buckets)
 
     def clear(self):
         """
@@ -371,11 +424,15 @@ class TagSet(object):
             None
         """
 
-        self._tags.clear()
+        self._counts.clear()
+        self._buckets.clear()
+        self._positions.clear()
+        self._len = 0
 
     def clean(self):
         """
-        Remove any empty tag sets from the dictionary.
+        Remove any empty tag sets from the dictionary. Empty buckets are
+        already removed as soon as they become empty, so this does nothing.
 
         Parameters:
             None
@@ -384,26 +441,49 @@ class TagSet(object):
             None
         """
 
-        for k in list(self._tags.keys()):
-            if len(self._tags[k]) < 1:
-                del self._tags[k]
+        pass
 
     def _find_tag_group(self, tag):
         """
-        Find the set that the supplied tag resides in.
+        Find the number of duplicates of the supplied tag.
 
         Parameters:
             tag - the tag to search the dictionary for
 
         Returns:
-            The set containing the tag or None if the tag is not in the
-            dictionary
+            The number of duplicates of the tag or None if the tag is not in
+            the dictionary
+        """
+
+        return self._counts.get(tag)
+
+    def _insert(self, tag, count):
+        """
+        Put a tag that is not in any bucket into the bucket for *count*.
+        """
+
+        bucket = self._buckets.setdefault(count, [])
+        self._positions[tag] = len(bucket)
+        self._counts[tag]    = count
+        bucket.append(tag)
+        self._len += 1
+
+    def _remove(self, tag, count):
+        """
+        Take a tag out of the bucket for *count* by swapping the last tag of
+        the bucket into its place, deleting the bucket if it becomes empty.
         """
 
-        for group, tags in self._tags.items():
-            if tag in tags:
-                return group
-        return None
+        bucket = self._buckets[count]
+        pos    = self._positions.pop(tag)
+        last   = bucket.pop()
+        if last != tag:
+            bucket[pos]           = last
+            self._positions[last] = pos
+        if not bucket:
+            del self._buckets[count]
+        del self._counts[tag]
+        self._len -= 1
 
     def add(self, tag, startcount=0):
         """
@@ -422,22 +502,11 @@ class TagSet(object):
 
         ### add the tag to the appropriate group, removing it from previous one
         if key is None:
-            # Note: this would only be dangerous if using a list
-            # Dictionary keys need not be positive (or numeric), however given
-            # the definition of the contents of the TagSet, this method leaves
-            # the option available to have negative duplicates of a tag, etc.,
-            # even though that does not make sense and would not inherently
-            # cause problems.
-            self._tags[startcount].add(tag)
+            self._insert(tag, startcount)
         else:
             # Add a duplicate of the tag and remove it from its original set
-            self._tags[key+1].add(tag)
-            self._tags[key  ].discard(tag)
-
-        ### delete the group if it became empty
-        if key is not None and len(self._tags[key]) == 0:
-            # Clean up any sets left empty
-            del self._tags[key]
+            self._remove(tag, key)
+            self._insert(tag, key + 1)
 
 
     def select(self):
@@ -453,19 +522,29 @@ class TagSet(object):
             dictionary is empty.
         """
 
-        if len(self) > 0:
-            count  = 1
+        if self._len > 0:
+            # There are at most maxreps + 1 buckets, so this is cheap.
+            minkey = min(self._buckets)
+            return random.choice(self._buckets[minkey])
+
+        else:
+            return None
 
-            # Keys are ordinal (likely integers), so min(keys) is the tag set
-            # representing tags with the least number of duplicates.
-            minkey = min(self._tags.keys())
+    def duplicable(self):
+        """
+        Iterate over the tags that may still be duplicated.
 
-            assert len(self._tags[minkey]) > 0, str(minkey) + ', ' + str(self._tags[minkey])
+        Parameters:
+            None
 
-            return random.sample(self._tags[minkey], count)[0]
+        Returns:
+            An iterator of (tag, number of duplicates)
+        """
 
-        else:
-            return None
+        for count, bucket in self._buckets.items():
+            if count < self._maxreps:
+                for tag in bucket:
+                    yield tag, count
 
     def discard(self, tag, key=None):
         """
@@ -481,12 +560,11 @@ class TagSet(object):
             None
         """
 
-        key = key or self._find_tag_group(tag)
-        if key is not None:
-            # This is safe in the event that the tag is not at the
-            # user-supplied key. Discard will do nothing if the element to get
-            # rid of is not in the set.
-            self._tags[key].discard(tag)
+        count = self._find_tag_group(tag)
+        key   = key or count
+        if count is not None and key == count:
+            # Nothing is done if the tag is not at the user-supplied key.
+            self._remove(tag, count)
 
     def __len__(self):
         """
@@ -499,27 +577,474 @@ class TagSet(object):
             The total number of tags in the dictionary
         """
 
-        return reduce(lambda s, k: s + len(self._tags[k]), iter(self._tags.keys()), 0 )
+        return self._len
 
     def __str__(self):
-        d = dict([(k,len(s)) for k,s in self._tags.items()])
+        d = dict([(k,len(s)) for k,s in self._buckets.items()])
         return '<TagSet(maxreps=%s): %s>' % (self._maxreps, d)
 
 
 
+class TaskRecord(object):
+    """
+    What the master knows about a task, found from its tag in the
+    TaskRegistry. Duplicates and restarts of a task share its record.
+
+    Fields:
+        walkerid  - the id of the walker the task runs
+        iteration - the iteration in which the task was created
+        cellid    - the cell of the walker when the task was created
+        weight    - the weight of the walker when the task was created
+        submitted - the time of the first submission (time.time())
+        finished  - the time the first result was accepted, or None
+        replicas  - the number of times the task was submitted, including
+                    duplicates and restarts
+        restarts  - the number of times the task was restarted
+        estimate  - the time the result would have been accepted without
+                    duplicates: finished if the first submission won,
+                    estimated by the ReplicationPolicy otherwise
+
+    Methods:
+        elapsed - the time from the first submission to the result
+    """
+
+    __slots__ = ('walkerid', 'iteration', 'cellid', 'weight',
+                 'submitted', 'finished', 'replicas', 'restarts', 'estimate')
+
+    def __init__(self, walkerid, iteration, cellid, weight):
+        self.walkerid  = walkerid
+        self.iteration = iteration
+        self.cellid    = cellid
+        self.weight    = weight
+        self.submitted = None
+        self.finished  = None
+        self.replicas  = 0
+        self.restarts  = 0
+        self.estimate  = None
+
+    def elapsed(self, now=None):
+        """
+        The time from the first submission of the task to its result.
+
+        Parameters:
+            now - the time to use if the task has not finished, defaults to
+                  the current time
+
+        Returns:
+            The elapsed time in seconds, or None if it was never submitted
+        """
+
+        if self.submitted is None:
+            return None
+        end = self.finished
+        if end is None:
+            end = time.time() if now is None else now
+        return end - self.submitted
+
+    def __str__(self):
+        return '<TaskRecord: walker %s, iteration %s, replicas %d, restarts %d>' % \
+            (self.walkerid, self.iteration, self.replicas, self.restarts)
+
+
+class TaskRegistry(object):
+    """
+    Maps short opaque task tags to TaskRecords. Tags are the hexadecimal
+    serial number of the task, so that a tag never needs to be parsed and
+    every lookup is a dictionary access. The records are kept until the
+    registry is cleared at the end of an iteration, so that late results of
+    duplicates still find theirs.
+
+    Fields:
+        _records - the record of each tag
+        _serial  - the serial number of the last task created
+
+    Methods:
+        new       - create a record and get its tag
+        get       - get the record of a tag, or None
+        submitted - record a submission of a task
+        restarted - record a restart of a task
+        finished  - record the result of a task
+        timings   - the elapsed time of each finished task
+        clear     - forget all tasks
+    """
+
+    def __init__(self):
+        self._records = dict()
+        self._serial  = 0
+
+    def new(self, walkerid, iteration, cellid, weight):
+        """
+        Create the record of a new task.
+
+        Parameters:
+            walkerid  - the id of the walker the task runs
+            iteration - the current iteration
+            cellid    - the cell of the walker
+            weight    - the weight of the walker
+
+        Returns:
+            The tag of the task
+        """
+
+        self._serial += 1
+        tag = '%x' % self._serial
+        self._records[tag] = TaskRecord(walkerid, iteration, cellid, weight)
+        return tag
+
+    def get(self, tag):
+        return self._records.get(tag)
+
+    def __getitem__(self, tag):
+        return self._records[tag]
+
+    def __contains__(self, tag):
+        return tag in self._records
+
+    def __iter__(self):
+        return iter(self._records.items())
+
+    def __len__(self):
+        return len(self._records)
+
+    def submitted(self, tag):
+        """
+        Record that a task, or a duplicate or restart of it, was submitted.
+        Tags that were not created by the registry are ignored.
+
+        Parameters:
+            tag - the tag of the task
+
+        Returns:
+            The record of the task, or None
+        """
+
+        record = self._records.get(tag)
+        if record is not None:
+            if record.submitted is None:
+                record.submitted = time.time()
+            record.replicas += 1
+        return record
+
+    def restarted(self, tag):
+        """
+        Record a restart of a task.
+
+        Parameters:
+            tag - the tag of the task
+
+        Returns:
+            The number of times the task has been restarted, including this
+            one
+        """
+
+        record = self._records[tag]
+        record.restarts += 1
+        return record.restarts
+
+    def finished(self, tag):
+        """
+        Record that the result of a task was accepted. Later results of its
+        duplicates do not change the time.
+
+        Parameters:
+            tag - the tag of the task
+
+        Returns:
+            The record of the task
+        """
+
+        record = self._records[tag]
+        if record.finished is None:
+            record.finished = time.time()
+        return record
+
+    def timings(self):
+        """
+        The time from the first submission to the result of each finished
+        task.
+
+        Parameters:
+            None
+
+        Returns:
+            A dictionary of tag -> seconds
+        """
+
+        return dict((tag, r.finished - r.submitted) for tag, r in self._records.items()
+                    if r.finished is not None and r.submitted is not None)
+
+    def clear(self):
+        """
+        Forget all tasks. Serial numbers keep increasing, so tags are never
+        reused within a run.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        self._records.clear()
+
+    def __str__(self):
+        return '<TaskRegistry: %d tasks>' % len(self._records)
+
+
+class ReplicationPolicy(object):
+    """
+    Decides which tasks to duplicate on idle workers, from the distribution
+    of the recent turnaround times (first submission to result).
+
+    A task that has been out for e seconds is expected to need
+    E[T - e | T > e] more seconds, the mean of the observed turnaround times
+    T above e, less e. A task that has been out longer than any observed
+    turnaround is expected to need as long again. A task is only duplicated
+    if that exceeds the median turnaround, the time a fresh replica is
+    expected to need, and the tasks expected to finish latest are
+    duplicated first. Until enough turnaround times are known, the tasks
+    that have been out longest are duplicated first.
+
+    Fields:
+        budget     - the number of duplicates allowed in an iteration, as a
+                     fraction of the tasks of the iteration
+        window     - the number of recent turnaround times kept
+        minsamples - the number of turnaround times needed to use them
+        duplicates - the number of duplicates submitted this iteration
+        wins       - the number of results of this iteration that came
+                     from a duplicate
+        count      - the number of turnaround times observed in the run
+        total      - the sum of the turnaround times observed in the run
+        _times     - the recent turnaround times
+        _sorted    - the turnaround times sorted, or None if out of date
+        _tailmeans - the mean of _sorted[i:] for each i
+        _replicas  - the duplicate tasks submitted this iteration
+
+    Methods:
+        observe    - add a turnaround time
+        remaining  - the expected remaining time of tasks out for some time
+        select     - choose the tasks to duplicate
+        interval   - how often to look for tasks to duplicate
+        quantiles  - quantiles of the recent turnaround times
+        duplicate  - record a duplicate
+        is_replica - whether a task is a duplicate
+        estimate   - the time the result of a task would have been accepted
+                     without its duplicates
+        clear      - forget the duplicates of the iteration
+    """
+
+    def __init__(self, budget=1.0, window=1000, minsamples=10):
+        self.budget     = budget
+        self.window     = window
+        self.minsamples = minsamples
+        self.duplicates = 0
+        self.wins       = 0
+        self.count      = 0
+        self.total      = 0.0
+        self._times     = deque(maxlen=window)
+        self._sorted    = None
+        self._tailmeans = None
+        self._replicas  = set()
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        odict['_replicas'] = set()
+        return odict
+
+    def observe(self, turnaround):
+        """
+        Add the turnaround time of a task to the distribution.
+
+        Parameters:
+            turnaround - the time from the first submission of a task to its
+                         result, in seconds
+
+        Returns:
+            None
+        """
+
+        self._times.append(turnaround)
+        self._sorted = None
+        self.count  += 1
+        self.total  += turnaround
+
+    def _distribution(self):
+        if self._sorted is None:
+            self._sorted    = np.sort(np.fromiter(self._times, dtype=float, count=len(self._times)))
+            tailsums        = np.cumsum(self._sorted[::-1])[::-1]
+            self._tailmeans = tailsums / np.arange(len(self._sorted), 0, -1)
+        return self._sorted, self._tailmeans
+
+    def remaining(self, elapsed):
+        """
+        The expected remaining time of tasks that have been out for some
+        time.
+
+        Parameters:
+            elapsed - the time each task has been out (numpy.array)
+
+        Returns:
+            The expected remaining time of each task (numpy.array), or None
+            if too few turnaround times are known
+        """
+
+        if len(self._times) < self.minsamples:
+            return None
+
+        times, tailmeans = self._distribution()
+        above = np.searchsorted(times, elapsed, side='right')
+        past  = above == len(times)
+        rem   = np.where(past, elapsed, tailmeans[np.minimum(above, len(times) - 1)] - elapsed)
+        return rem
+
+    def select(self, candidates, ntasks, n, now=None):
+        """
+        Choose the tasks to duplicate.
+
+        Parameters:
+            candidates - a list of (tag, TaskRecord, number of duplicates) of
+                         the tasks that may be duplicated
+            ntasks     - the number of tasks of the iteration
+            n          - the number of idle workers
+            now        - the current time, defaults to time.time()
+
+        Returns:
+            A list of at most n tags, the first the most urgent
+        """
+
+        n = min(n, int(self.budget * ntasks) - self.duplicates)
+        if n <= 0 or not candidates:
+            return []
+
+        now     = time.time() if now is None else now
+        elapsed = np.array([now - r.submitted for _, r, _ in candidates])
+        copies  = np.array([c + 1 for _, _, c in candidates], dtype=float)
+        rem     = self.remaining(elapsed)
+
+        if rem is None:
+            order = np.argsort(-elapsed / copies, kind='stable')
+        else:
+            # Each copy shares in the expected gain of another one
+            gain  = (rem - self.interval()) / copies
+            order = np.argsort(-gain, kind='stable')
+            order = order[gain[order] > 0]
+
+        return [candidates[i][0] for i in order[:n]]
+
+    def interval(self):
+        """
+        How often to look for tasks to duplicate while workers are idle: the
+        median turnaround time, as tasks are not expected to straggle
+        sooner.
+
+        Parameters:
+            None
+
+        Returns:
+            The interval in seconds, or None if too few turnaround times are
+            known
+        """
+
+        if len(self._times) < self.minsamples:
+            return None
+        times, _ = self._distribution()
+        return float(np.median(times))
+
+    def quantiles(self, qs):
+        """
+        Quantiles of the recent turnaround times.
+
+        Parameters:
+            qs - the quantiles, between 0 and 1
+
+        Returns:
+            A numpy.array of the quantiles, or None if no turnaround time is
+            known
+        """
+
+        if not self._times:
+            return None
+        times, _ = self._distribution()
+        return np.quantile(times, qs)
+
+    def __len__(self):
+        return len(self._times)
+
+    def duplicate(self, task):
+        """
+        Record that a duplicate task was submitted.
+
+        Parameters:
+            task - the duplicate task
+
+        Returns:
+            None
+        """
+
+        self._replicas.add(task)
+        self.duplicates += 1
+
+    def is_replica(self, task):
+        return task in self._replicas
+
+    def estimate(self, record, task):
+        """
+        Estimate when the result of a task would have been accepted without
+        its duplicates. Must be called before the turnaround time of the
+        task is observed.
+
+        Parameters:
+            record - the TaskRecord of the task, with finished set
+            task   - the task whose result was accepted
+
+        Returns:
+            The estimated time
+        """
+
+        if not self.is_replica(task):
+            return record.finished
+        self.wins += 1
+        elapsed = record.finished - record.submitted
+        rem = self.remaining(np.array([elapsed]))
+        return record.finished + (0. if rem is None else float(rem[0]))
+
+    def clear(self):
+        """
+        Forget the duplicates of the iteration. The turnaround times are
+        kept.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+
+        self._replicas.clear()
+        self.duplicates = 0
+        self.wins       = 0
+
+
 class WorkQueue(object):
     """
     An interface to the cctools work_queue module.
 
     Fields:
         cfg              - configuration settings container
-        wq               - cctools work_queue.WorkQueue object
+        wq               - the executor.Executor running the tasks
         _tagset          - the TagSet object containing task tags
         stats            - statistical unit from stats module
         tmpdir           - temp directory where task information is stored
-        restarts         - a dictionary of tasks that have been restarted
+        tasks            - the TaskRegistry of the tasks of the iteration,
+                           with their restarts and timings
+        replication      - the ReplicationPolicy choosing tasks to duplicate
+        queued           - the number of tasks in the queue when it was
+                           last looked at, before the current wait; safe
+                           to read while the queue is being waited on
         statslogger      - logging unit for global AWE-WQ statistics
         taskoutputlogger - logging unit for individual task output and stats
+        profiler         - the profiler.Profiler timing waits and counting
+                           tasks, disabled by default
 
     Methods:
         update_task_stats   -
@@ -537,9 +1062,16 @@ class WorkQueue(object):
         tasks_in_queue      -
         active_workers      -
         can_duplicate_tasks -
+        stragglers          - choose the tasks to duplicate
+        duplicate           - submit a duplicate task
+        replication_report  - the duplicates of the iteration and the time
+                              they saved
         recv                -
+        receive             -
     """
 
+    profiler = profiler.DISABLED
+
     # @awe.typecheck(Config)
     def __init__(self, cfg, statslogger=None, taskoutputlogger=None, verbose=False, log_it=False):
         """
@@ -571,15 +1103,17 @@ class WorkQueue(object):
         # Create the temporary file where the task cache is stored
         self.tmpdir = str(bytes(tempfile.mkdtemp(prefix='awe-tmp.'), 'ASCII'), 'ASCII')
         #print("Temporary directory is %s" % self.tmpdir)
-        # Create a dictionary to keep track of the number of times a
-        # particular task has been restarted
-        self.restarts = dict()
+        # Keep track of what each task runs, and of its duplicates,
+        # restarts and timing
+        self.tasks = TaskRegistry()
+        self.replication = ReplicationPolicy(budget=self.cfg.replicabudget)
 
         # Start logging statistics about and output from the tasks
-        self.statslogger      = statslogger      or awe.stats.StatsLogger(buffersize=42)
-        self.taskoutputlogger = taskoutputlogger or awe.stats.StatsLogger(path='debug/task_output.log.gz', buffersize=42)
+        self.statslogger      = statslogger      or awe.stats.StatsLogger(buffersize=42, background=True)
+        self.taskoutputlogger = taskoutputlogger or awe.stats.StatsLogger(path='debug/task_output.log.gz', buffersize=42, background=True)
         self._log = log_it
         self.verbose = verbose
+        self.queued  = 0
 
     @property
     def empty(self):
@@ -624,11 +1158,11 @@ class WorkQueue(object):
         shutil.rmtree(self.tmpdir)
 
 
-    @awe.typecheck(WQ.Task)
     def update_task_stats(self, task):
         """
-        Add information about a task to the WorkQueue object logging utility.
-        See stats.WQStats for more information on the default logger.
+        Add information about a task to the WorkQueue object logging utility
+        and to the timing statistics. See stats.WQStats for more information
+        on the default logger.
 
         Parameters:
             task - a WorkQueue task
@@ -636,6 +1170,7 @@ class WorkQueue(object):
         Returns:
             None
         """
+        self.stats.summarize(task)
         if self._log:
             self.stats.task(task)
 
@@ -652,11 +1187,14 @@ class WorkQueue(object):
             A new cctools WorkQueue.Task instance
         """
 
-        cmd = self.cfg.executable.remotepath
-        task = WQ.Task('./' + cmd)
+        if callable(self.cfg.executable):
+            task = self.wq.new_task(self.cfg.executable)
+        else:
+            cmd = self.cfg.executable.remotepath
+            task = self.wq.new_task('./' + cmd)
+            ### executable
+            self.cfg.executable.add_to_task(task)
         task.specify_cores(self.cfg.task_config["cores"])
-        ### executable
-        self.cfg.executable.add_to_task(task)
 
         ### cached files
         for wqf in self.cfg.getcache:
@@ -664,7 +1202,6 @@ class WorkQueue(object):
 
         return task
 
-    @awe.typecheck(WQ.Task)
     def submit(self, task):
         """
         Submit a task to a worker. This adds it to the TagSet to keep track of
@@ -678,9 +1215,10 @@ class WorkQueue(object):
         """
 
         self._tagset.add(task.tag)
+        self.tasks.submitted(task.tag)
+        self.profiler.count('tasks_submitted')
         return self.wq.submit(task)
 
-    @awe.typecheck(WQ.Task)
     def restart(self, task):
         """
         Restart a task if something has gone wrong and record the number of
@@ -693,19 +1231,15 @@ class WorkQueue(object):
             A Boolean value representing whether or not the task was restarted
         """
 
-        # Add to the dictionary of restarted tasks if first restart
-        if task.tag not in self.restarts:
-            self.restarts[task.tag] = 0
-
         # Record the restart and notify the user, then restart if the task has
         # not exceeded the maximum number of restarts
-        if self.restarts[task.tag] < self.cfg.restarts:
+        if self.tasks[task.tag].restarts < self.cfg.restarts:
             print(time.asctime(), 'task failed with', task.return_status, \
                 'result is', task.result, \
                 'restarting', task.tag, \
-                '#%d' % (self.restarts[task.tag] + 1))
+                '#%d' % self.tasks.restarted(task.tag))
+            self.profiler.count('restarts')
             self.submit(task)
-            self.restarts[task.tag] += 1
             return True
 
         # Otherwise, do not restart the task
@@ -818,9 +1352,10 @@ class WorkQueue(object):
         """
 
         self.clear_tags()
-
-        # force clearing to allow GC, otherwise linear memory growth
-        self.wq._task_table.clear()
+        self.tasks.clear()
+        self.replication.clear()
+        self.stats.new_iteration()
+        self.wq.clear()
 
     def tasks_in_queue(self):
         """
@@ -864,71 +1399,330 @@ class WorkQueue(object):
         return  self.tasks_in_queue() < self.active_workers() \
             and self._tagset.can_duplicate()
 
+    def stragglers(self):
+        """
+        Choose the tasks to duplicate on the idle workers, the ones expected
+        to finish latest first, within the replica budget of the iteration.
+        See ReplicationPolicy.
+
+        Parameters:
+            None
+
+        Returns:
+            A list of tags
+        """
+
+        idle = self.active_workers() - self.tasks_in_queue()
+        if idle <= 0:
+            return []
+
+        candidates = []
+        for tag, count in self._tagset.duplicable():
+            record = self.tasks.get(tag)
+            if record is not None and record.submitted is not None and record.finished is None:
+                candidates.append((tag, record, count))
+
+        return self.replication.select(candidates, len(self.tasks), idle)
+
+    def duplicate(self, task):
+        """
+        Submit a duplicate of a running task. The first result of any of the
+        copies is accepted and the others are cancelled.
+
+        Parameters:
+            task - a task with the tag of the task to duplicate
+
+        Returns:
+            The id of the task
+        """
+
+        self.replication.duplicate(task)
+        self.profiler.count('duplicates')
+        return self.submit(task)
+
+    def replication_report(self):
+        """
+        Summarize the duplicates of the iteration: how many were submitted,
+        how many returned first, and how much earlier the last result came
+        than it would have without them (estimated, see
+        ReplicationPolicy.estimate).
+
+        Parameters:
+            None
+
+        Returns:
+            A dictionary with duplicates, wins and savings (in seconds)
+        """
+
+        last = estimated = None
+        for tag, record in self.tasks:
+            if record.finished is None:
+                continue
+            last      = max(last, record.finished) if last is not None else record.finished
+            estimated = max(estimated, record.estimate) if estimated is not None else record.estimate
+
+        savings = 0. if last is None else max(0., estimated - last)
+        return dict(duplicates = self.replication.duplicates,
+                    wins       = self.replication.wins,
+                    savings    = savings)
+
+
+    def _check(self, task, mark_invalid):
+        """
+        Record a returned task and deal with its failure: restart it, mark
+        its walker invalid, or raise if it cannot be restarted.
+
+        Parameters:
+            task         - a returned cctools work_queue.Task object
+            mark_invalid - function marking the walker of a task invalid
+
+        Returns:
+            True if the task succeeded and its result should be read
+        """
+
+        # Record the task output whether it succeeded or failed
+        self.update_task_stats(task)
+        if self._log:
+            self.taskoutputlogger.output(task.output, task=task.tag, host=task.host)
+
+        if task.result == 0:
+            print("Task returned with result %s and value %s" % (task.result, task.return_status) )
+
+            # Deal with tasks in which an error occurred
+            if task.return_status == 0:
+                return True
+            elif not self.restart(task):
+                raise WorkQueueWorkerException(self.taskoutput(task) + '\n\nTask %s failed with %d' % (task.tag, task.return_status))
+            return False
+
+        # Check the task output for a bad model
+        if task.output.find('Exception: Particle coordinate is NaN'):
+            if self.verbose:
+                print(''.join([task.tag, ': Particle coordinate is NaN']))
+            mark_invalid(task)
+            return False
+
+        # Kill the task if it cannot be restarted.
+        if not self.restart(task):
+            raise WorkQueueException('Task exceeded maximum number of resubmissions for %s\n\n%s' % \
+                (task.tag, self.taskoutput(task)))
+        return False
+
+    def _duplicate(self, task, reading=()):
+        """
+        Check whether a returned task is a duplicate of a task whose result
+        is already read or being read. Such a duplicate is only recorded in
+        the statistics and dropped: it is neither restarted nor marked
+        invalid, even if it failed.
+
+        Parameters:
+            task    - a returned cctools work_queue.Task object
+            reading - the tags of the tasks whose results are being read
+
+        Returns:
+            True if the task is a duplicate and should be dropped
+        """
+
+        record = self.tasks.get(task.tag)
+        if task.tag not in reading and (record is None or record.finished is None):
+            return False
+
+        self.update_task_stats(task)
+        return True
+
+    def _restart_unreadable(self, task, ex):
+        """
+        Restart a task that returned but whose result could not be read.
+        Sometimes a task fails, but still returns.
+
+        Parameters:
+            task - the task
+            ex   - the exception raised reading its result
+
+        Returns:
+            None
+        """
+
+        if not self.restart(task):
+            tb = ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
+            raise WorkQueueException(self.taskoutput(task) + '\n\nMaster failed: could not load resultfile:\n %s: %s\n\n%s' % \
+                (ex.__class__.__name__, ex, tb))
+
+    def _finish(self, task):
+        """
+        Cancel the duplicates of a task whose result is being read and stop
+        duplicating it.
+
+        Parameters:
+            task - the task
+
+        Returns:
+            None
+        """
+
+        self.cancel_tag(task.tag)
+        self.discard_tag(task.tag)
+
+    def _accepted(self, task):
+        """
+        Record that the result of a task was accepted. Called by receive on
+        the event loop thread while another thread waits on Work Queue, so
+        it only updates the bookkeeping of the master (the task registry,
+        statistics and logs) and never uses self.wq.
+
+        Parameters:
+            task - the task
+
+        Returns:
+            None
+        """
+
+        self.profiler.count('results')
+        record = self.tasks.finished(task.tag)
+        record.estimate = self.replication.estimate(record, task)
+        self.replication.observe(record.elapsed())
+        if self._log:
+            t = awe.stats.time.time()
+            self.statslogger.update(t, 'TASK', 'elapsed_time', record.elapsed(),
+                                    task=task.tag, host=task.host)
+            self.statslogger.update(t, 'TASK', 'replicas', record.replicas,
+                                    task=task.tag, host=task.host)
+
+    def _wait_ready(self, timeout):
+        """
+        Wait for a task to return, then take every other task that has
+        already returned.
+
+        Parameters:
+            timeout - the maximum number of seconds to wait for the first task
+
+        Returns:
+            A list of returned tasks, empty if none returned in time
+        """
+
+        ready = []
+        with self.profiler.span('wait'):
+            task  = self.wait(timeout=timeout)
+            while task:
+                ready.append(task)
+                task = self.wait(timeout=0)
+        return ready
 
     def recv(self, marshall, mark_invalid):
         """
         Deal with tasks as they return. Handle successes, errors, and restarts.
-        Runs forever.
+        Runs until a task returns successfully.
 
         Parameters:
-            marshall - function describing how to send tasks to workers
+            marshall     - function reading the result of a task
+            mark_invalid - function marking the walker of a task invalid
 
         Returns:
-            None
+            The value returned by marshall for the task
         """
 
-        # print time.asctime(), 'waiting for task'
         while True:
-            #print(self.tmpdir)
             # Set the cctools WorkQueue object to idle until a task arrives
-            task = self.wait(timeout=self.cfg.waittime)
-
-            if task:
-                #print("Success!")
-                # Record the task output whether it succeeded or failed
-                self.update_task_stats(task)
-                # print time.asctime(), 'Received result. %d tasks remaining in iteration.' % self.tasks_in_queue()
-                if self._log:
-                    self.taskoutputlogger.output("<====== WQ: START task %s output ======>\n" % task.tag)
-                    self.taskoutputlogger.output(task.output)
-                    self.taskoutputlogger.output("<====== WQ: END task %s output ======>\n"   % task.tag)
-                #print(task.output)
-                #m = input("press enter")
-            if task and task.result == 0:
-                print("Task returned with result %s and value %s" % (task.result, task.return_status) )
-
-                # Deal with tasks in which an error occurred
-                if not task.return_status == 0 and not self.restart(task):
-                    raise WorkQueueWorkerException(self.taskoutput(task) + '\n\nTask %s failed with %d' % (task.tag, task.return_status))
-
-
-                try:
-                    result = marshall(task)
-                except Exception as ex:
-                    print("In the exception")
-                    ### sometimes a task fails, but still returns.
-                    ##+ attempt to restart these
-                    if not self.restart(task):
-                        raise WorkQueueException(self.taskoutput(task) + '\n\nMaster failed: could not load resultfile:\n %s: %s\n\n%s' % \
-                            (ex.__class__.__name__, ex, traceback.format_exc()))
-                    else:
+            self.queued = self.tasks_in_queue()
+            with self.profiler.span('wait'):
+                task = self.wait(timeout=self.cfg.waittime)
+            if not task or self._duplicate(task) or not self._check(task, mark_invalid):
+                continue
+
+            try:
+                result = marshall(task)
+            except Exception as ex:
+                self._restart_unreadable(task, ex)
+                continue
+
+            # Kill the task if it cannot be restarted
+            self._finish(task)
+            self._accepted(task)
+            return result
+
+    async def receive(self, decode, accept, mark_invalid, idle=None, pool=None):
+        """
+        Receive every task in the queue, as an asyncio coroutine. Each wait
+        for tasks runs on a thread of its own and takes every task that has
+        returned. The results of successful tasks are decoded on the pool
+        while the next tasks are waited for, and accepted on the event loop
+        thread as they are decoded.
+
+        Only one function uses Work Queue at a time: submitting, cancelling
+        and restarting tasks and idle happen between the waits.
+
+        Parameters:
+            decode       - function reading the result of a task, called on
+                           the pool; must not use Work Queue or change the
+                           state of the master
+            accept       - function called with each task and its decoded
+                           result on the event loop thread, possibly while
+                           another thread waits on Work Queue: it must not
+                           use Work Queue (see queued)
+            mark_invalid - function marking the walker of a task invalid
+            idle         - function called after each wait while tasks
+                           are queued, e.g. to duplicate tasks, or None
+            pool         - the concurrent.futures.Executor to decode on, or
+                           None for the default executor of the loop
+
+        Returns:
+            None
+        """
+
+        loop     = asyncio.get_running_loop()
+        waiter   = futures.ThreadPoolExecutor(max_workers=1)
+        decoding = dict()   # future -> task
+        failed   = []       # (task, exception) of unreadable results
+
+        def accept_decoded():
+            for future in [f for f in decoding if f.done()]:
+                task = decoding.pop(future)
+                if future.exception() is not None:
+                    failed.append((task, future.exception()))
+                else:
+                    accept(task, future.result())
+                    self._accepted(task)
+
+        try:
+            while not self.empty or decoding or failed:
+                ready = []
+                if not self.empty:
+                    # Look for stragglers sooner while workers are idle
+                    timeout  = self.cfg.waittime
+                    interval = self.replication.interval()
+                    if idle is not None and interval is not None and self.can_duplicate_tasks():
+                        timeout = min(timeout, interval)
+
+                    # Work Queue must not be used while it is waited on,
+                    # accept reads this count instead
+                    self.queued = self.tasks_in_queue()
+                    waiting = loop.run_in_executor(waiter, self._wait_ready, timeout)
+                    while not waiting.done():
+                        await asyncio.wait([waiting] + list(decoding),
+                                           return_when=asyncio.FIRST_COMPLETED)
+                        accept_decoded()
+                    ready = waiting.result()
+                elif decoding:
+                    await asyncio.wait(list(decoding), return_when=asyncio.FIRST_COMPLETED)
+                    accept_decoded()
+
+                # Work Queue is free until the next wait
+                for task, ex in failed:
+                    self._restart_unreadable(task, ex)
+                del failed[:]
+
+                reading = set(t.tag for t in decoding.values())
+                for task in ready:
+                    if self._duplicate(task, reading) or not self._check(task, mark_invalid):
                         continue
 
-                # Kill the task if it cannot be restarted
-                self.cancel_tag(task.tag)
-                self.discard_tag(task.tag)
-                return result
-
-            elif task and not task.result == 0:
-                # Check the task output for a bad model
-                if task.output.find('Exception: Particle coordinate is NaN'):
-                    if self.verbose:
-                        print(''.join([task.tag, ': Particle coordinate is NaN']))
-                    mark_invalid(task)
-                    continue
-                # Kill the task if it cannot be restarted.
-                if not self.restart(task):
-                    raise WorkQueueException('Task exceeded maximum number of resubmissions for %s\n\n%s' % \
-                        (task.tag, self.taskoutput(task)))
-
-            else: continue
+                    self._finish(task)
+                    reading.add(task.tag)
+                    decoding[loop.run_in_executor(pool, decode, task)] = task
+
+                # Tasks may straggle without any other task returning
+                if idle is not None and not self.empty:
+                    idle()
+        finally:
+            waiter.shutdown(wait=True)
+
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+End-to-end benchmark of the AWE master. A synthetic System (cells, walkers
+per cell, atoms per walker) is run through AWE.run with a mock executor
+whose tasks complete instantly, moving each walker to a random cell. The
+time spent in each phase of the master and the peak RSS are recorded for
+every iteration and written as JSON so that runs can be compared across
+commits.
+
+  python benchmarks/master.py [--cells 100] [--walkers 10] [--atoms 1000]
+                              [--iterations 5] [--output master.json]
+
+Phases (exclusive of each other, except that backend and unmarshal run
+on other threads during recv):
+  submit     - creating and submitting tasks, excluding marshal
+  marshal    - AWE.marshal_to_task
+  backend    - the mock executor producing results (the "workers")
+  recv       - the receive loop, wall time
+  unmarshal  - AWE.unpack_task and AWE.marshal_from_task, summed over
+               the threads
+  resample   - the resampler, excluding csv
+  csv        - writing the walker history, weights and transition matrix
+  checkpoint - writing the trax checkpoint
+"""
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'trax'))
+
+import awe
+from awe import executor, payload, stats, workqueue
+
+import numpy as np
+
+from collections import defaultdict, deque
+import contextlib
+import json
+import optparse
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+
+PHASES = ('submit', 'marshal', 'backend', 'recv', 'unmarshal',
+          'resample', 'csv', 'checkpoint')
+
+# Phases whose time is included in the time of another phase
+NESTED = {'submit'   : ('marshal',),
+          'resample' : ('csv',)}
+
+
+class Phases(object):
+    """
+    Accumulates the time spent in each phase of an iteration using
+    stats.Timer stopwatches.
+
+    Methods:
+        time     - context manager timing one call of a phase
+        snapshot - get and reset the exclusive time of each phase
+    """
+
+    def __init__(self):
+        self._totals = defaultdict(float)
+        self._lock   = threading.Lock()
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        timer = stats.Timer()
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.stop()
+            with self._lock:
+                self._totals[phase] += timer.elapsed(current=False)
+
+    def snapshot(self):
+        totals = dict((p, self._totals.get(p, 0.)) for p in PHASES)
+        for outer, inner in NESTED.items():
+            totals[outer] -= sum(totals[p] for p in inner)
+        self._totals.clear()
+        return totals
+
+# Module level so that the timed classes below stay picklable for the
+# checkpoints
+TIMINGS = Phases()
+
+
+def maxrss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def git_revision():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class SyntheticTopology(object):
+    """
+    Stands in for a structures.PDB topology with *natoms* atoms.
+    """
+
+    def __init__(self, natoms):
+        self.natoms = natoms
+
+    def copy(self):
+        return self
+
+    def __str__(self):
+        lines = ['ATOM  %5d  CA  ALA A%4d    %8.3f%8.3f%8.3f  1.00  0.00           C\n' % \
+                     (i % 100000, i % 10000, 0., 0., 0.) for i in range(self.natoms)]
+        return ''.join(lines) + 'END\n'
+
+
+def noop(sandbox):
+    pass
+
+
+class MockExecutor(executor.Executor):
+    """
+    An executor whose tasks finish as soon as they are waited for. Each
+    result keeps the coordinates sent with the task and moves the walker to
+    a random cell with probability *transition*, otherwise keeps it in the
+    cell recorded for the task in *tasks*, the workqueue.TaskRegistry of the
+    master (see BenchmarkAWE).
+    """
+
+    def __init__(self, ncells, transition=0.1, seed=None):
+        self.ncells     = ncells
+        self.transition = transition
+        self.rng        = np.random.RandomState(seed)
+        self._queue     = deque()
+        self._nextid    = 1
+        self.tasks      = None
+
+    @property
+    def stats(self):
+        # No idle workers, so the master never duplicates tasks
+        return executor.ExecutorStats(tasks_waiting=len(self._queue))
+
+    def new_task(self, command):
+        return executor.LocalTask(command)
+
+    def submit(self, task):
+        task._reset()
+        task.id       = self._nextid
+        self._nextid += 1
+        self._queue.append(task)
+        return task.id
+
+    def wait(self, timeout=None):
+        if not self._queue:
+            return None
+
+        with TIMINGS.time('backend'):
+            task = self._queue.popleft()
+            data = [src for kind, src, remote, _ in task._inputs
+                    if kind == 'buffer' and remote.startswith(workqueue.WORKER_PAYLOAD_NAME)][0]
+            _, coords = payload.unpack_walker(data)
+
+            cellid = self.tasks[task.tag].cellid
+            if self.rng.random_sample() < self.transition:
+                cellid = int(self.rng.randint(self.ncells))
+
+            task.output        = payload.format_result(cellid, coords)
+            task.result        = executor.RESULT_SUCCESS
+            task.return_status = 0
+        return task
+
+    def cancel_by_tasktag(self, tag):
+        for task in self._queue:
+            if task.tag == tag:
+                self._queue.remove(task)
+                return task
+        return None
+
+    def empty(self):
+        return len(self._queue) == 0
+
+
+class TimedMultiColor(awe.resample.MultiColor):
+
+    def save_history(self, history):
+        with TIMINGS.time('csv'):
+            awe.resample.MultiColor.save_history(self, history)
+
+    def save_cellweights(self, system, newsystem):
+        with TIMINGS.time('csv'):
+            awe.resample.MultiColor.save_cellweights(self, system, newsystem)
+
+    def save_transitions(self, path):
+        with TIMINGS.time('csv'):
+            awe.resample.MultiColor.save_transitions(self, path)
+
+
+class TimedSaveWeights(awe.resample.SaveWeights):
+
+    def save(self, system, mode='a'):
+        with TIMINGS.time('csv'):
+            awe.resample.SaveWeights.save(self, system, mode=mode)
+
+
+class BenchmarkAWE(awe.AWE):
+    """
+    AWE recording the time of each phase and the peak RSS of every
+    iteration in *records*.
+    """
+
+    def __init__(self, *args, **kws):
+        awe.AWE.__init__(self, *args, **kws)
+        if isinstance(self.wq.wq, MockExecutor):
+            self.wq.wq.tasks = self.wq.tasks
+
+    def run(self):
+        self.records = []
+        awe.AWE.run(self)
+
+    def _begin_iteration(self):
+        self._itertimer = stats.Timer()
+        self._itertimer.start()
+        walkers = len(self.system)
+        awe.AWE._begin_iteration(self)
+        self._iterwalkers = walkers
+
+    def _submit(self):
+        with TIMINGS.time('submit'):
+            awe.AWE._submit(self)
+
+    def marshal_to_task(self, walker, task):
+        with TIMINGS.time('marshal'):
+            awe.AWE.marshal_to_task(self, walker, task)
+
+    def _recv(self):
+        with TIMINGS.time('recv'):
+            awe.AWE._recv(self)
+
+    def unpack_task(self, result):
+        with TIMINGS.time('unmarshal'):
+            return awe.AWE.unpack_task(self, result)
+
+    def marshal_from_task(self, result, unpacked=None):
+        with TIMINGS.time('unmarshal'):
+            return awe.AWE.marshal_from_task(self, result, unpacked)
+
+    def _write_checkpoint(self, chk, started=None):
+        with TIMINGS.time('checkpoint'):
+            awe.AWE._write_checkpoint(self, chk, started)
+
+    def _resample(self):
+        with TIMINGS.time('resample'):
+            awe.AWE._resample(self)
+
+        self._wait_checkpoint()
+        self._itertimer.stop()
+        self.records.append(dict(iteration = self.iteration,
+                                 walkers   = self._iterwalkers,
+                                 wall      = self._itertimer.elapsed(current=False),
+                                 phases    = TIMINGS.snapshot(),
+                                 maxrss_kb = maxrss_kb()))
+
+
+def build_system(opts, rng):
+    """
+    Create a synthetic System with two sink states, the first and last cell.
+    """
+
+    partition = awe.SinkStates()
+    partition.add(0, 0)
+    partition.add(1, opts.cells - 1)
+
+    system = awe.System(topology=SyntheticTopology(opts.atoms))
+    weight = 1. / (opts.cells * opts.walkers)
+    for c in range(opts.cells):
+        core = 0 if c == 0 else 1 if c == opts.cells - 1 else awe.aweclasses.DEFAULT_CORE
+        cell = awe.Cell(c, core=core)
+        system.add_cell(cell)
+
+        color = partition.color(cell)
+        if color < 0: color = int(rng.randint(2))
+        for _ in range(opts.walkers):
+            coords = (10 * rng.random_sample((opts.atoms, 3))).astype(np.float32)
+            system.add_walker(awe.Walker(start=coords, assignment=c, color=color,
+                                         weight=weight, cellid=c))
+
+    return system, partition
+
+def run(opts):
+    rng = np.random.RandomState(opts.seed)
+
+    cfg          = workqueue.Config()
+    cfg.executor = MockExecutor(opts.cells, transition=opts.transition, seed=opts.seed)
+    cfg.waittime = 0
+    cfg.execute(noop)
+
+    system, partition = build_system(opts, rng)
+
+    resampler = TimedMultiColor(opts.walkers, partition, seed=opts.seed)
+    resampler = TimedSaveWeights(resampler)
+
+    traxlogger = awe.checkpoint.incremental(compact=opts.compact) if opts.incremental else None
+
+    master = BenchmarkAWE(wqconfig       = cfg,
+                          system         = system,
+                          iterations     = opts.iterations,
+                          resample       = resampler,
+                          traxlogger     = traxlogger,
+                          checkpointfreq = opts.checkpointfreq,
+                          pipeline       = opts.pipeline)
+    master.run()
+    return master.records
+
+def main():
+    p = optparse.OptionParser()
+    p.add_option('--cells', type=int, default=100, help='Number of cells [%default]')
+    p.add_option('--walkers', type=int, default=10, help='Walkers per cell [%default]')
+    p.add_option('--atoms', type=int, default=1000, help='Atoms per walker [%default]')
+    p.add_option('--iterations', type=int, default=5, help='Number of iterations [%default]')
+    p.add_option('--transition', type=float, default=0.1, help='Probability that a walker changes cell [%default]')
+    p.add_option('--checkpointfreq', type=int, default=1, help='Checkpoint every this many iterations [%default]')
+    p.add_option('--pipeline', action='store_true', help='Checkpoint in the background [%default]')
+    p.add_option('--incremental', action='store_true', help='Write incremental checkpoints [%default]')
+    p.add_option('--compact', type=int, default=10, help='Snapshot every this many incremental checkpoints [%default]')
+    p.add_option('--seed', type=int, default=42, help='Random seed [%default]')
+    p.add_option('-o', '--output', default='master.json', help='Write the results as JSON to this file [%default]')
+    p.add_option('--keep', action='store_true', help='Keep the working directory with the AWE output [%default]')
+    p.add_option('-v', '--verbose', action='store_true', help='Show the output of AWE [%default]')
+    opts, _ = p.parse_args()
+
+    output  = os.path.abspath(opts.output)
+    cwd     = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='awe-bench.')
+
+    # AWE writes its logs and checkpoints relative to the working directory
+    os.chdir(workdir)
+    awe.resample.OUTPUT_DIR = workdir
+    try:
+        if opts.verbose:
+            records = run(opts)
+        else:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                records = run(opts)
+    finally:
+        os.chdir(cwd)
+        if opts.keep: print('AWE output kept in', workdir)
+        else:         shutil.rmtree(workdir, ignore_errors=True)
+
+    totals = dict((p, sum(r['phases'][p] for r in records)) for p in PHASES)
+    result = dict(benchmark = 'master',
+                  revision  = git_revision(),
+                  time      = time.time(),
+                  config    = dict(cells      = opts.cells,
+                                   walkers    = opts.walkers,
+                                   atoms      = opts.atoms,
+                                   iterations = opts.iterations,
+                                   transition = opts.transition,
+                                   checkpointfreq = opts.checkpointfreq,
+                                   pipeline   = bool(opts.pipeline),
+                                   incremental = bool(opts.incremental),
+                                   compact    = opts.compact,
+                                   seed       = opts.seed),
+                  iterations = records,
+                  totals     = totals,
+                  maxrss_kb  = max(r['maxrss_kb'] for r in records) if records else maxrss_kb())
+
+    with open(output, 'w') as fd:
+        json.dump(result, fd, indent=2)
+
+    print('%4s %8s %9s ' % ('iter', 'walkers', 'wall(s)') + \
+              ' '.join('%10s' % p for p in PHASES) + ' %10s' % 'rss(MB)')
+    for r in records:
+        print('%4d %8d %9.3f ' % (r['iteration'], r['walkers'], r['wall']) + \
+                  ' '.join('%10.4f' % r['phases'][p] for p in PHASES) + \
+                  ' %10.1f' % (r['maxrss_kb'] / 1024.))
+    print('Results written to', output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+
+Micro-benchmark of awe.workqueue.TagSet: the cost per add, duplicate,
+select, discard and len with a large number of outstanding tags.
+
+  python benchmarks/tagset.py [--tags 100000] [--ops 100000]
+"""
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'trax'))
+
+from awe.workqueue import TagSet
+
+import optparse
+import random
+import time
+
+
+def timeit(name, fn, args):
+    start = time.time()
+    for a in args:
+        fn(a)
+    elapsed = time.time() - start
+    print('%-12s %10d ops %10.3f us/op' % (name, len(args), 1e6 * elapsed / max(1, len(args))))
+
+def main():
+    p = optparse.OptionParser()
+    p.add_option('--tags', type=int, default=100000, help='Number of outstanding tags [%default]')
+    p.add_option('--ops', type=int, default=100000, help='Number of operations to time [%default]')
+    p.add_option('--maxreps', type=int, default=19, help='Maximum number of duplicates [%default]')
+    opts, _ = p.parse_args()
+
+    random.seed(42)
+    tags = ['tag-%d' % i for i in range(opts.tags)]
+    ts   = TagSet(maxreps=opts.maxreps)
+
+    print('TagSet with %d outstanding tags' % opts.tags)
+    timeit('add', ts.add, tags)
+
+    dups = [random.choice(tags) for _ in range(opts.ops)]
+    timeit('duplicate', ts.add, dups)
+
+    timeit('select', lambda _: ts.select(), range(opts.ops))
+    timeit('can_dup', lambda _: ts.can_duplicate(), range(opts.ops))
+    timeit('len', lambda _: len(ts), range(opts.ops))
+
+    # Discard half of the tags and add them back to keep the size constant
+    gone = random.sample(tags, min(opts.ops, len(tags)) // 2)
+    timeit('discard', ts.discard, gone)
+    timeit('add', ts.add, gone)
+
+    print(ts)
+
+if __name__ == '__main__':
+    main()
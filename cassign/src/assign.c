@@ -108,7 +108,8 @@ int main (int argc, char *argv[]) {
     *cell_ndx_file = argv[2], //"AtomIndices.dat",
     *xtc_file      = argv[3], //"traj.xtc",
     *xtc_ndx_file  = argv[4], //"AtomIndices.dat",
-    *out_file      = argv[5]; //"cell2.dat";
+    *out_file      = argv[5], //"cell2.dat";
+    *index_file    = argc > 6 ? argv[6] : NULL; //"cells.idx", optional
 
   printf("~> Cells file: %s\n", cells_file);
   printf("~> Xtc file: %s\n", xtc_file);
@@ -165,27 +166,40 @@ int main (int argc, char *argv[]) {
   printf("\n");
   
 
-  printf("~> Computing rmsds...\n");
-  
-  // Set up variables for RMSD calculations
-  int assignment = 0;
-  double
-    minrmsd = DBL_MAX,
-    maxrmsd = -1;
+  printf("~> Computing rmsds with %d threads...\n", assign_engine_set_threads());
+
+  // Center the cells and compute their inner products once
+  assign_engine *engine;
+  if (assign_engine_init(newcells, &engine) != exitOK) {
+    exit(EXIT_FAILURE);
+  }
+
+  // Without a usable index every cell is compared
+  if (index_file != NULL) {
+    const exit_t status = assign_engine_load_index(engine, index_file);
+    printf("~> Cell index %s: %s\n", index_file,
+           status == exitOK ? "loaded" : exit_message[status]);
+  }
+
+  double minrmsd;
+  const int assignment = assign_engine_assign(engine, newframe->coords, &minrmsd);
+
+  // Report the rmsds in the order the cells were scanned
+  double maxrmsd = -1, running = DBL_MAX;
   int asns = 0;
-  
-  for (int c=0; c<cell_data->ncells; c++) {
-    // INITIALIZING NEW VARS EACH TIME IS WASTEFUL (POSSIBLY)
-    const gsl_matrix cell = celldata_get_cell(newcells, c);
-    const gsl_matrix *coords = newframe->coords;
-    const double rmsd = compute_rmsd(&cell, coords);
+
+  for (int c=0; c<engine->ncells; c++) {
+    const double rmsd = engine->rmsds[c];
+
+    // The cell was pruned by the index
+    if (isnan(rmsd)) {
+      continue;
+    }
+
     printf("~~> rmsd to cell %3d: %8.5f\n", c, rmsd);
-    
-    // ARE THE MIN AND MAX NECESSARY?
-    // GET RID OF MAX--IT'S UNUSED
-    if (rmsd < minrmsd) {
-      minrmsd = rmsd;
-      assignment = c;
+
+    if (rmsd < running) {
+      running = rmsd;
       asns++;
     }
 
@@ -194,6 +208,10 @@ int main (int argc, char *argv[]) {
     }
   }
 
+  printf("~> Compared %lu of %lu cells\n", engine->ncompared, engine->ncells);
+
+  assign_engine_free(engine);
+
   printf("~> Assignment: %d jumps: %d\n", assignment, asns);
   printf("~> minrmsd: %f maxrmsd: %f\n", minrmsd, maxrmsd);
 
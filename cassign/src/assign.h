@@ -13,6 +13,7 @@
 #include "xdr_util.h"
 #include "rmsd_calc.h"
 #include "gsl_util.h"
+#include "assign_engine.h"
 
 #include <gsl/gsl_vector.h>
 #include <gsl/gsl_vector.h>
@@ -0,0 +1,381 @@
+/**
+ * assign_engine.c
+ *
+ * An assignment engine that keeps the cells centered, with their inner
+ * products, and compares structures against them with the QCP RMSD. When
+ * compiled with OpenMP the cells are scanned by several threads.
+ */
+
+#include "assign_engine.h"
+
+
+/**
+ * Center n rows of x, y, z coordinates at the origin, in place.
+ *
+ * Parameters:
+ *     coords - the coordinates to center
+ *     n      - the number of rows
+ *
+ * Returns:
+ *     The inner product of the centered coordinates with themselves
+ */
+static double center_coords (double *coords, const size_t n) {
+  double mean[3] = {0, 0, 0};
+  for (size_t i=0; i<n; i++) {
+    for (int d=0; d<3; d++) {
+      mean[d] += coords[3*i+d];
+    }
+  }
+  for (int d=0; d<3; d++) {
+    mean[d] /= (double) n;
+  }
+
+  double trace = 0;
+  for (size_t i=0; i<n; i++) {
+    for (int d=0; d<3; d++) {
+      coords[3*i+d] -= mean[d];
+      trace += coords[3*i+d] * coords[3*i+d];
+    }
+  }
+
+  return trace;
+}
+
+
+/**
+ * Create an assignment engine from a set of cells.
+ *
+ * Parameters:
+ *     cells  - the cells to assign structures to, in three dimensions
+ *     engine - a pointer in which the new engine will be stored
+ *
+ * Returns:
+ *     An exit status representing the success or failure of the operation
+ */
+exit_t assign_engine_init (const celldata *cells, assign_engine **engine) {
+  if (cells->ndims != 3 || cells->ncoords == 0) {
+    fprintf(stderr, "Cannot assign to cells of %lu coordinates in %lu dimensions\n",
+            cells->ncoords, cells->ndims);
+    return exitSANITY;
+  }
+
+  const size_t
+    ncells  = cells->ncells,
+    ncoords = cells->ncoords;
+
+  assign_engine *e = (assign_engine*) malloc(sizeof(assign_engine));
+  e->ncells    = ncells;
+  e->ncoords   = ncoords;
+  e->cells     = (double*) malloc(ncells * ncoords * 3 * sizeof(double));
+  e->traces    = (double*) malloc(ncells * sizeof(double));
+  e->structure = (double*) malloc(ncoords * 3 * sizeof(double));
+  e->rmsds     = (double*) malloc(ncells * sizeof(double));
+  e->npivots    = 0;
+  e->pivots     = NULL;
+  e->pivotrmsds = NULL;
+  e->lower      = NULL;
+  e->ncompared  = 0;
+
+  // Pack each cell contiguously, then center it
+  for (size_t c=0; c<ncells; c++) {
+    const cell_t cell = celldata_get_cell(cells, c);
+    double *packed = e->cells + c * ncoords * 3;
+
+    for (size_t i=0; i<ncoords; i++) {
+      for (int d=0; d<3; d++) {
+        packed[3*i+d] = gsl_matrix_get(&cell, i, d);
+      }
+    }
+
+    e->traces[c] = center_coords(packed, ncoords);
+  }
+
+  *engine = e;
+  return exitOK;
+}
+
+
+/**
+ * Load a pivot index written by awe-index-cells.
+ *
+ * Parameters:
+ *     engine - the engine to use the index with
+ *     path   - the path to the index file
+ *
+ * Returns:
+ *     An exit status representing the success or failure of the operation
+ */
+exit_t assign_engine_load_index (assign_engine *engine, const char *path) {
+  FILE *file = fopen(path, "r");
+  if (file == NULL) {
+    return exitPATH_NOT_FOUND;
+  }
+
+  size_t ncells, ncoords, npivots;
+  if (fscanf(file, " ncells: %zu ncoords: %zu npivots: %zu pivots:",
+             &ncells, &ncoords, &npivots) != 3) {
+    printf("Bad header in cell index %s\n", path);
+    fclose(file);
+    return exitCELLS_HEADER;
+  }
+
+  if (ncells != engine->ncells || ncoords != engine->ncoords || npivots == 0) {
+    printf("Cell index %s is for %lu cells of %lu atoms, not %lu cells of %lu atoms\n",
+           path, ncells, ncoords, engine->ncells, engine->ncoords);
+    fclose(file);
+    return exitSANITY;
+  }
+
+  size_t *pivots = (size_t*) malloc(npivots * sizeof(size_t));
+  double *pivotrmsds = (double*) malloc(ncells * npivots * sizeof(double));
+  exit_t status = exitOK;
+
+  for (size_t k=0; k<npivots && status == exitOK; k++) {
+    if (fscanf(file, "%zu", &pivots[k]) != 1 || pivots[k] >= ncells) {
+      status = exitCELLS_HEADER;
+    }
+  }
+
+  for (size_t i=0; i<ncells * npivots && status == exitOK; i++) {
+    if (fscanf(file, "%lf", &pivotrmsds[i]) != 1) {
+      status = exitCELLS_DATA;
+    }
+  }
+
+  fclose(file);
+
+  if (status != exitOK) {
+    printf("Cell index %s is truncated or malformed\n", path);
+    free(pivots);
+    free(pivotrmsds);
+    return status;
+  }
+
+  free(engine->pivots);
+  free(engine->pivotrmsds);
+  free(engine->lower);
+  engine->npivots    = npivots;
+  engine->pivots     = pivots;
+  engine->pivotrmsds = pivotrmsds;
+  engine->lower      = (double*) malloc(ncells * sizeof(double));
+
+  return exitOK;
+}
+
+
+/**
+ * Keep the better of two candidate cells: the one with the smaller RMSD,
+ * or the lower cell if the RMSDs are equal, as a sequential scan does.
+ */
+static void keep_best (size_t *best, double *bestrmsd, const size_t c, const double r) {
+  if (r < *bestrmsd || (r == *bestrmsd && c < *best)) {
+    *bestrmsd = r;
+    *best = c;
+  }
+}
+
+
+/**
+ * Compute the RMSD of the structure in engine->structure to the cells not
+ * compared yet whose lower bound is at most a given bound, and update the
+ * best cell.
+ *
+ * Parameters:
+ *     engine     - the engine holding the cells and the structure
+ *     trace      - the inner product of the structure with itself
+ *     bound      - compare the cells with engine->lower at most this, or
+ *                  every cell if there is no index
+ *     assignment - the best cell so far, updated
+ *     minrmsd    - the RMSD to the best cell so far, updated
+ */
+static void scan_cells (assign_engine *engine, const double trace, const double bound,
+                        size_t *assignment, double *minrmsd) {
+  const double *cells     = engine->cells;
+  const double *traces    = engine->traces;
+  const double *structure = engine->structure;
+  const double *lower     = engine->lower;
+  double *rmsds           = engine->rmsds;
+  const size_t ncells     = engine->ncells;
+  const size_t ncoords    = engine->ncoords;
+  const int indexed       = engine->npivots > 0;
+  size_t ncompared        = 0;
+
+  // Each thread scans a contiguous block of cells for its own minimum
+  #pragma omp parallel reduction(+:ncompared)
+  {
+    size_t best = 0;
+    double bestrmsd = DBL_MAX;
+
+    #pragma omp for schedule(static)
+    for (size_t c=0; c<ncells; c++) {
+      if (indexed && (!isnan(rmsds[c]) || lower[c] > bound)) {
+        continue;
+      }
+
+      const double r = qcp_rmsd(cells + c * ncoords * 3, traces[c], structure, trace, ncoords);
+      rmsds[c] = r;
+      ncompared++;
+
+      if (r < bestrmsd) {
+        bestrmsd = r;
+        best = c;
+      }
+    }
+
+    #pragma omp critical
+    keep_best(assignment, minrmsd, best, bestrmsd);
+  }
+
+  engine->ncompared += ncompared;
+}
+
+
+/**
+ * Compare the structure in engine->structure to the pivots and bound its
+ * RMSD to every cell from below with the index.
+ *
+ * Parameters:
+ *     engine     - the engine holding the cells, the index and the structure
+ *     trace      - the inner product of the structure with itself
+ *     assignment - the best cell so far, updated
+ *     minrmsd    - the RMSD to the best cell so far, updated
+ */
+static void bound_cells (assign_engine *engine, const double trace,
+                         size_t *assignment, double *minrmsd) {
+  const size_t ncells  = engine->ncells;
+  const size_t ncoords = engine->ncoords;
+  const size_t npivots = engine->npivots;
+  double topivot[npivots];
+
+  for (size_t k=0; k<npivots; k++) {
+    const size_t p = engine->pivots[k];
+    topivot[k] = qcp_rmsd(engine->cells + p * ncoords * 3, engine->traces[p],
+                          engine->structure, trace, ncoords);
+  }
+
+  // The RMSD is at least the difference of the radii of gyration and of
+  // the distances to any pivot
+  const double radius = sqrt(trace / ncoords);
+
+  #pragma omp parallel for schedule(static)
+  for (size_t c=0; c<ncells; c++) {
+    const double *d = engine->pivotrmsds + c * npivots;
+    double lb = fabs(sqrt(engine->traces[c] / ncoords) - radius);
+
+    for (size_t k=0; k<npivots; k++) {
+      lb = fmax(lb, fabs(topivot[k] - d[k]));
+    }
+
+    engine->lower[c] = lb;
+    engine->rmsds[c] = NAN;
+  }
+
+  for (size_t k=0; k<npivots; k++) {
+    const size_t p = engine->pivots[k];
+    if (isnan(engine->rmsds[p])) {
+      engine->rmsds[p] = topivot[k];
+      engine->ncompared++;
+    }
+    keep_best(assignment, minrmsd, p, topivot[k]);
+  }
+}
+
+
+/**
+ * Assign a structure to the cell with the smallest RMSD.
+ *
+ * Parameters:
+ *     engine - the engine holding the cells
+ *     coords - an ncoords x 3 matrix of the structure coordinates
+ *     rmsd   - where the RMSD to the assigned cell is stored, or NULL
+ *
+ * Returns:
+ *     The index of the assigned cell
+ */
+size_t assign_engine_assign (assign_engine *engine, const gsl_matrix *coords, double *rmsd) {
+  assert (coords->size1 == engine->ncoords);
+  assert (coords->size2 == 3);
+
+  const size_t ncoords = engine->ncoords;
+
+  for (size_t i=0; i<ncoords; i++) {
+    for (int d=0; d<3; d++) {
+      engine->structure[3*i+d] = gsl_matrix_get(coords, i, d);
+    }
+  }
+  const double trace = center_coords(engine->structure, ncoords);
+
+  size_t assignment = 0;
+  double minrmsd = DBL_MAX;
+  engine->ncompared = 0;
+
+  if (engine->npivots > 0) {
+    bound_cells(engine, trace, &assignment, &minrmsd);
+
+    // Compare the cell with the smallest bound first to tighten the best
+    // RMSD, then every cell that may still be nearer
+    size_t first = 0;
+    for (size_t c=1; c<engine->ncells; c++) {
+      if (engine->lower[c] < engine->lower[first]) {
+        first = c;
+      }
+    }
+    scan_cells(engine, trace, engine->lower[first], &assignment, &minrmsd);
+    const double margin = ASSIGN_INDEX_MARGIN + ASSIGN_INDEX_RELATIVE_MARGIN * minrmsd;
+    scan_cells(engine, trace, minrmsd + margin, &assignment, &minrmsd);
+  }
+  else {
+    scan_cells(engine, trace, DBL_MAX, &assignment, &minrmsd);
+  }
+
+  if (rmsd != NULL) {
+    *rmsd = minrmsd;
+  }
+  return assignment;
+}
+
+
+/**
+ * Set the number of threads used to scan the cells from CORES, unless
+ * OMP_NUM_THREADS is set.
+ *
+ * Parameters:
+ *     None
+ *
+ * Returns:
+ *     The number of threads that will be used
+ */
+int assign_engine_set_threads (void) {
+#ifdef _OPENMP
+  const char *cores = getenv("CORES");
+
+  if (getenv("OMP_NUM_THREADS") == NULL && cores != NULL && atoi(cores) > 0) {
+    omp_set_num_threads(atoi(cores));
+  }
+
+  return omp_get_max_threads();
+#else
+  return 1;
+#endif
+}
+
+
+/**
+ * Free an assignment engine.
+ *
+ * Parameters:
+ *     engine - the engine to free
+ *
+ * Returns:
+ *     void
+ */
+void assign_engine_free (assign_engine *engine) {
+  free(engine->cells);
+  free(engine->traces);
+  free(engine->structure);
+  free(engine->rmsds);
+  free(engine->pivots);
+  free(engine->pivotrmsds);
+  free(engine->lower);
+  free(engine);
+}
@@ -0,0 +1,133 @@
+/**
+ * assign_engine.h
+ *
+ * An assignment engine that keeps the cells in the form needed to compare
+ * structures against all of them quickly. The cells are centered and their
+ * inner products computed once, the RMSDs are computed with the QCP method
+ * (see qcp_rmsd), and all scratch space is allocated with the engine.
+ *
+ * An optional pivot index (see scripts/awe-index-cells) holds the RMSD of
+ * every cell to a few pivot cells. By the triangle inequality these bound
+ * the RMSD of a structure to each cell from below, so that only the cells
+ * that may be nearer than the best cell found are compared in full.
+ */
+
+#ifndef _ASSIGN_ENGINE_H_
+#define _ASSIGN_ENGINE_H_
+
+#include "exit_codes.h"
+#include "celldata.h"
+#include "rmsd_calc.h"
+
+#include <gsl/gsl_matrix.h>
+
+#include <assert.h>
+#include <float.h>
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// The cells, prepared for assignment
+typedef struct {
+  size_t ncells, ncoords;
+  double *cells;      // ncells x ncoords x 3 coordinates, each cell centered
+  double *traces;     // the inner product of each cell with itself
+  double *structure;  // scratch: the centered structure being assigned
+  double *rmsds;      // scratch: the RMSD to each cell of the last structure,
+                      // NAN for the cells pruned by the index
+  size_t npivots;     // the number of pivots of the index, 0 without index
+  size_t *pivots;     // the cell of each pivot
+  double *pivotrmsds; // ncells x npivots RMSDs of the cells to the pivots
+  double *lower;      // scratch: the lower bound of the RMSD to each cell
+  size_t ncompared;   // the number of cells compared in full for the last structure
+} assign_engine;
+
+// Cells are only pruned when their lower bound exceeds the best RMSD by
+// more than ASSIGN_INDEX_MARGIN plus ASSIGN_INDEX_RELATIVE_MARGIN times the
+// best RMSD, so that rounding never prunes the nearest cell. QCP finds the
+// squared RMSD as a difference of two large terms, so near RMSDs carry an
+// absolute error of up to about 1e-5 that the bounds add up; the absolute
+// margin matches INDEX_MARGIN of the OpenMM worker.
+#define ASSIGN_INDEX_MARGIN          1e-4
+#define ASSIGN_INDEX_RELATIVE_MARGIN 1e-5
+
+
+/**
+ * Create an assignment engine from a set of cells. The coordinates are
+ * copied, so the cells may be freed afterwards.
+ *
+ * Parameters:
+ *     cells  - the cells to assign structures to, in three dimensions
+ *     engine - a pointer in which the new engine will be stored
+ *
+ * Returns:
+ *     An exit status representing the success or failure of the operation
+ */
+exit_t assign_engine_init (const celldata *cells, assign_engine **engine);
+
+
+/**
+ * Load a pivot index written by awe-index-cells. The index must have been
+ * built from the same cells and atoms as the engine.
+ *
+ * Parameters:
+ *     engine - the engine to use the index with
+ *     path   - the path to the index file
+ *
+ * Returns:
+ *     An exit status representing the success or failure of the operation.
+ *     The engine is unchanged unless it succeeds.
+ */
+exit_t assign_engine_load_index (assign_engine *engine, const char *path);
+
+
+/**
+ * Assign a structure to the cell with the smallest RMSD, the first one
+ * if several are equally near. The RMSD to each cell is left in
+ * engine->rmsds. With an index only some cells are compared, but the
+ * assignment is the same. With OpenMP the cells are divided among
+ * the threads (see assign_engine_set_threads); the result is the same as
+ * with a single thread.
+ *
+ * Parameters:
+ *     engine - the engine holding the cells
+ *     coords - an ncoords x 3 matrix of the structure coordinates
+ *     rmsd   - where the RMSD to the assigned cell is stored, or NULL
+ *
+ * Returns:
+ *     The index of the assigned cell
+ */
+size_t assign_engine_assign (assign_engine *engine, const gsl_matrix *coords, double *rmsd);
+
+
+/**
+ * Set the number of threads used to scan the cells from the CORES
+ * environment variable, which Work Queue sets to the cores allocated to
+ * the task, unless OMP_NUM_THREADS is set. Does nothing without OpenMP.
+ *
+ * Parameters:
+ *     None
+ *
+ * Returns:
+ *     The number of threads that will be used
+ */
+int assign_engine_set_threads (void);
+
+
+/**
+ * Free an assignment engine.
+ *
+ * Parameters:
+ *     engine - the engine to free
+ *
+ * Returns:
+ *     void
+ */
+void assign_engine_free (assign_engine *engine);
+
+
+#endif
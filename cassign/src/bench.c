@@ -0,0 +1,145 @@
+/**
+ * bench.c
+ *
+ * Benchmark of cell assignment: the per-cell Kabsch RMSD used by
+ * awe-assign before the assignment engine, against the assignment engine.
+ * Random cells are generated and a perturbed copy of one of them is
+ * assigned repeatedly. Reports assignments per second for both and checks
+ * that they agree. The engine uses the threads given by OMP_NUM_THREADS
+ * or CORES (see assign_engine_set_threads).
+ *
+ * Usage: assign-bench [ncells [natoms [repeats]]]
+ */
+
+#define _POSIX_C_SOURCE 200809L
+
+#include "assign_engine.h"
+#include "celldata.h"
+#include "rmsd_calc.h"
+
+#include <gsl/gsl_matrix.h>
+
+#include <float.h>
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+
+
+/**
+ * Get the time in seconds from a monotonic clock.
+ */
+static double now (void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + 1e-9 * ts.tv_nsec;
+}
+
+
+/**
+ * Get a uniform random number in [lo, hi).
+ */
+static double uniform (const double lo, const double hi) {
+  return lo + (hi - lo) * (rand() / (RAND_MAX + 1.0));
+}
+
+
+/**
+ * Assign a structure as awe-assign did before the assignment engine: one
+ * allocating Kabsch RMSD per cell.
+ */
+static int assign_kabsch (const celldata *cells, const gsl_matrix *coords, double *rmsds) {
+  int assignment = 0;
+  double minrmsd = DBL_MAX;
+
+  for (int c=0; c<cells->ncells; c++) {
+    const gsl_matrix cell = celldata_get_cell(cells, c);
+    rmsds[c] = compute_rmsd(&cell, coords);
+
+    if (rmsds[c] < minrmsd) {
+      minrmsd = rmsds[c];
+      assignment = c;
+    }
+  }
+
+  return assignment;
+}
+
+
+int main (int argc, char *argv[]) {
+  const size_t
+    ncells  = argc > 1 ? atol(argv[1]) : 1000,
+    natoms  = argc > 2 ? atol(argv[2]) : 22,
+    repeats = argc > 3 ? atol(argv[3]) : 20;
+
+  srand(42);
+
+  const int threads = assign_engine_set_threads();
+
+  // Random cells a few nanometers across
+  celldata *cells;
+  celldata_init(&cells, ncells, natoms, 3);
+  for (size_t c=0; c<ncells; c++) {
+    for (size_t i=0; i<natoms; i++) {
+      for (size_t d=0; d<3; d++) {
+        celldata_set_value(cells, c, i, d, uniform(0, 2));
+      }
+    }
+  }
+
+  // A translated and perturbed copy of one cell
+  const size_t target = ncells / 3;
+  gsl_matrix *coords = gsl_matrix_calloc(natoms, 3);
+  for (size_t i=0; i<natoms; i++) {
+    for (size_t d=0; d<3; d++) {
+      const double v = celldata_get_value(cells, target, i, d);
+      gsl_matrix_set(coords, i, d, v + 1.5 + uniform(-0.05, 0.05));
+    }
+  }
+
+  double *rmsds = (double*) malloc(ncells * sizeof(double));
+
+  // Per-cell Kabsch
+  double start = now();
+  int kabsch = 0;
+  for (size_t r=0; r<repeats; r++) {
+    kabsch = assign_kabsch(cells, coords, rmsds);
+  }
+  const double tkabsch = now() - start;
+
+  // Assignment engine, including its one time preparation
+  start = now();
+  assign_engine *engine;
+  if (assign_engine_init(cells, &engine) != exitOK) {
+    return EXIT_FAILURE;
+  }
+  const double tinit = now() - start;
+
+  start = now();
+  size_t qcp = 0;
+  for (size_t r=0; r<repeats; r++) {
+    qcp = assign_engine_assign(engine, coords, NULL);
+  }
+  const double tqcp = now() - start;
+
+  double maxdiff = 0;
+  for (size_t c=0; c<ncells; c++) {
+    maxdiff = fmax(maxdiff, fabs(rmsds[c] - engine->rmsds[c]));
+  }
+
+  printf("cells: %lu atoms: %lu repeats: %lu engine threads: %d\n",
+         ncells, natoms, repeats, threads);
+  printf("kabsch: %12.2f assignments/s (%10.1f cells/s)\n",
+         repeats / tkabsch, repeats * ncells / tkabsch);
+  printf("engine: %12.2f assignments/s (%10.1f cells/s), prepared in %.6f s\n",
+         repeats / tqcp, repeats * ncells / tqcp, tinit);
+  printf("speedup: %.1fx\n", tkabsch / tqcp);
+  printf("assignment: kabsch %d engine %lu (expected %lu), max rmsd difference %.3g\n",
+         kabsch, qcp, target, maxdiff);
+
+  assign_engine_free(engine);
+  gsl_matrix_free(coords);
+  free(rmsds);
+
+  return (size_t) kabsch == qcp ? EXIT_SUCCESS : EXIT_FAILURE;
+}
@@ -7,8 +7,22 @@
 #ifndef _CELLDATA_C_
 #define _CELLDATA_C_
 
+// mmap is not part of C99
+#define _POSIX_C_SOURCE 200809L
+
 #include "celldata.h"
 
+#include <fcntl.h>
+#include <stdint.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+// The first bytes of every .npy file
+static const char NPY_MAGIC[] = "\x93NUMPY";
+#define NPY_MAGIC_LEN 6
+
 
 /**
  * Allocate space for a celldata struct on the heap.
@@ -50,6 +64,8 @@ void celldata_init (celldata** data, const size_t ncells, const size_t ncoords,
   (*data)->ncells  = ncells;
   (*data)->ncoords = ncoords;
   (*data)->ndims   = ndims;
+  (*data)->map     = NULL;
+  (*data)->maplen  = 0;
 
   // Allocate space for the correct number of cells
   (*data)->cells   = (cell_t*) malloc(ncells*sizeof(cell_t));
@@ -191,6 +207,10 @@ void celldata_printf (const celldata* cells) {
  */
 exit_t celldata_load_file (const char* path, celldata** data) {
 
+  if (celldata_is_npy(path)) {
+    return celldata_load_npy(path, data);
+  }
+
   int BUFFER_SIZE = 100;
   char buffer [BUFFER_SIZE];
   int ncells, ncoords, ndims;
@@ -314,6 +334,182 @@ exit_t celldata_load_file (const char* path, celldata** data) {
 }
 
 
+/**
+ * Determine whether a file is in the NumPy .npy format.
+ *
+ * Parameters:
+ *     path - the path to the file
+ *
+ * Returns:
+ *     1 if the file starts with the .npy magic string, 0 otherwise
+ */
+int celldata_is_npy (const char* path) {
+  char magic[NPY_MAGIC_LEN];
+
+  FILE * file = fopen(path, "rb");
+  if (file == NULL) {
+    return 0;
+  }
+
+  const size_t n = fread(magic, 1, NPY_MAGIC_LEN, file);
+  fclose(file);
+
+  return n == NPY_MAGIC_LEN && memcmp(magic, NPY_MAGIC, NPY_MAGIC_LEN) == 0;
+}
+
+
+/**
+ * Populate a celldata structure from a .npy file holding a C-ordered
+ * (ncells, ncoords, ndims) array of little-endian floats, as written by
+ * awe-convert-cells. The file is mapped into memory; double precision
+ * cells are used in place, without copying, so that repeated runs on the
+ * same machine share the page cache instead of parsing the file.
+ *
+ * Parameters:
+ *     path - the path to the .npy file
+ *     data - the structure to populate
+ *
+ * Returns:
+ *     An exit status indicating the success of the operation.
+ */
+exit_t celldata_load_npy (const char* path, celldata** data) {
+
+  // Map the whole file. The mapping is private, so the file is never
+  // modified even though gsl needs writable matrices.
+  int fd = open(path, O_RDONLY);
+  if (fd < 0) {
+    perror("Error opening file");
+    return exitPATH_NOT_FOUND;
+  }
+
+  struct stat st;
+  if (fstat(fd, &st) != 0) {
+    perror("Error reading file size");
+    close(fd);
+    return exitFAILURE;
+  }
+
+  const size_t len = st.st_size;
+  unsigned char *map = mmap(NULL, len, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+  close(fd);
+
+  if (map == MAP_FAILED) {
+    perror("Error mapping file");
+    return exitFAILURE;
+  }
+
+  // The header is the magic string, a version, the length of the header
+  // dictionary (2 bytes in version 1, 4 bytes after) and the dictionary
+  // itself, e.g. {'descr': '<f8', 'fortran_order': False, 'shape': (100, 22, 3), }
+  size_t start, hlen;
+  if (len < 10 || memcmp(map, NPY_MAGIC, NPY_MAGIC_LEN) != 0) {
+    printf("Not a .npy file: %s\n", path);
+    munmap(map, len);
+    return exitCELLS_HEADER;
+  }
+
+  if (map[6] == 1) {
+    hlen  = map[8] | (map[9] << 8);
+    start = 10;
+  }
+  else {
+    hlen  = map[8] | (map[9] << 8) | (map[10] << 16) | ((size_t) map[11] << 24);
+    start = 12;
+  }
+
+  if (start + hlen > len || hlen > 65535) {
+    printf("Bad .npy header in %s\n", path);
+    munmap(map, len);
+    return exitCELLS_HEADER;
+  }
+
+  char header[hlen + 1];
+  memcpy(header, map + start, hlen);
+  header[hlen] = '\0';
+
+  char descr[8] = "";
+  size_t ncells = 0, ncoords = 0, ndims = 0;
+  const char *d = strstr(header, "'descr':");
+  const char *s = strstr(header, "'shape':");
+
+  if (d == NULL || sscanf(d, "'descr': '%7[^']'", descr) != 1 ||
+      s == NULL || sscanf(s, "'shape': (%zu, %zu, %zu)", &ncells, &ncoords, &ndims) != 3 ||
+      strstr(header, "'fortran_order': True") != NULL) {
+    printf("Cells must be a C-ordered 3 dimensional array: %s\n", header);
+    munmap(map, len);
+    return exitCELLS_HEADER;
+  }
+
+  // The data are read as little-endian
+  const uint16_t one = 1;
+  const int little = *(const unsigned char*) &one == 1;
+
+  const int f8 = strcmp(descr, "<f8") == 0 || (little && strcmp(descr, "=f8") == 0);
+  const int f4 = strcmp(descr, "<f4") == 0 || (little && strcmp(descr, "=f4") == 0);
+  const size_t itemsize = f8 ? 8 : 4;
+  const size_t offset   = start + hlen;
+  const size_t nvalues  = ncells * ncoords * ndims;
+
+  if (!little || !(f8 || f4)) {
+    printf("Unsupported cell data type '%s'\n", descr);
+    munmap(map, len);
+    return exitCELLS_DATA;
+  }
+
+  if (offset + nvalues * itemsize > len) {
+    printf("Cells file %s is truncated\n", path);
+    munmap(map, len);
+    return exitCELLS_DATA;
+  }
+
+  printf("ncells = %zu ncoords = %zu ndims = %zu (%s, mapped)\n",
+         ncells, ncoords, ndims, descr);
+
+  if (f8 && offset % sizeof(double) == 0) {
+    // Point the cell matrices into the mapping
+    double *values = (double*) (map + offset);
+
+    *data = celldata_alloc();
+    (*data)->ncells  = ncells;
+    (*data)->ncoords = ncoords;
+    (*data)->ndims   = ndims;
+    (*data)->cells   = (cell_t*) malloc(ncells*sizeof(cell_t));
+    (*data)->map     = map;
+    (*data)->maplen  = len;
+
+    for (size_t c=0; c<ncells; c++) {
+      (*data)->cells[c] = gsl_matrix_view_array(values + c*ncoords*ndims,
+                                                ncoords, ndims).matrix;
+    }
+  }
+
+  else {
+    // Convert to the double precision matrices gsl works with
+    celldata_init(data, ncells, ncoords, ndims);
+
+    for (size_t i=0; i<nvalues; i++) {
+      double v;
+      if (f8) {
+        memcpy(&v, map + offset + i*8, 8);
+      }
+      else {
+        float f;
+        memcpy(&f, map + offset + i*4, 4);
+        v = f;
+      }
+      celldata_set_value(*data, i / (ncoords*ndims), (i / ndims) % ncoords,
+                         i % ndims, v);
+    }
+
+    munmap(map, len);
+  }
+
+  printf ("...done\n");
+
+  return exitOK;
+}
+
+
 /**
  * Set the state of a cell in a celldata structure.
  *
@@ -18,10 +18,14 @@
 // An alias of gsl_matrix to distinguish code is dealing with cells
 typedef gsl_matrix cell_t;
 
-// A structure for dealing with all cells in a clustering model
+// A structure for dealing with all cells in a clustering model. When the
+// cells were loaded from a .npy file, map and maplen describe the memory
+// mapping the cell matrices point into.
 typedef struct {
   size_t ncells, ncoords, ndims;
   cell_t *cells;
+  void *map;
+  size_t maplen;
 } celldata;
 
 
@@ -154,6 +158,8 @@ void celldata_printf (const celldata* cells);
 
 /**
  * Populate a celldata structure from the contents of a structured file.
+ * Files in the NumPy .npy format (see celldata_load_npy) are recognized by
+ * their magic string; any other file is parsed as text.
  *
  * Parameters:
  *     path - the path to the file containing cell data
@@ -165,6 +171,35 @@ void celldata_printf (const celldata* cells);
 exit_t celldata_load_file (const char* path, celldata** data);
 
 
+/**
+ * Determine whether a file is in the NumPy .npy format.
+ *
+ * Parameters:
+ *     path - the path to the file
+ *
+ * Returns:
+ *     1 if the file starts with the .npy magic string, 0 otherwise
+ */
+int celldata_is_npy (const char* path);
+
+
+/**
+ * Populate a celldata structure from a .npy file holding a C-ordered
+ * (ncells, ncoords, ndims) array of little-endian floats, as written by
+ * awe-convert-cells. The file is mapped into memory; double precision
+ * cells are used in place, without copying, so that repeated runs on the
+ * same machine share the page cache instead of parsing the file.
+ *
+ * Parameters:
+ *     path - the path to the .npy file
+ *     data - the structure to populate
+ *
+ * Returns:
+ *     An exit status indicating the success of the operation.
+ */
+exit_t celldata_load_npy (const char* path, celldata** data);
+
+
 /**
  * Filter cell definitions by certain indices and create a new celldata struct
  * containing the results of filtering.
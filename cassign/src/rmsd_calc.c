@@ -350,3 +350,98 @@ exit_t kabsch_function (const gsl_matrix *A, const gsl_matrix *B, gsl_matrix **U
 
 
 }
+
+
+/**
+ * Compute the RMSD between two centered structures after optimal
+ * superposition with the quaternion characteristic polynomial (QCP)
+ * method. See rmsd_calc.h for the references.
+ *
+ * Parameters:
+ *     A  - the first structure as n rows of x, y, z coordinates, centered
+ *     GA - the inner product of A with itself (its sum of squares)
+ *     B  - the second structure, centered, with the same layout as A
+ *     GB - the inner product of B with itself
+ *     n  - the number of atoms in each structure
+ *
+ * Returns:
+ *     A double representing the RMSD between A and B
+ */
+double qcp_rmsd (const double *A, const double GA, const double *B, const double GB, const size_t n) {
+
+  // The inner product matrix M = A' * B
+  double
+    Sxx = 0, Sxy = 0, Sxz = 0,
+    Syx = 0, Syy = 0, Syz = 0,
+    Szx = 0, Szy = 0, Szz = 0;
+
+  for (size_t i=0; i<n; i++) {
+    const double
+      ax = A[3*i], ay = A[3*i+1], az = A[3*i+2],
+      bx = B[3*i], by = B[3*i+1], bz = B[3*i+2];
+
+    Sxx += ax * bx; Sxy += ax * by; Sxz += ax * bz;
+    Syx += ay * bx; Syy += ay * by; Syz += ay * bz;
+    Szx += az * bx; Szy += az * by; Szz += az * bz;
+  }
+
+  // Coefficients of the characteristic polynomial of the key matrix
+  //   P(x) = x^4 + C2 x^2 + C1 x + C0
+  const double
+    Sxx2 = Sxx * Sxx, Syy2 = Syy * Syy, Szz2 = Szz * Szz,
+    Sxy2 = Sxy * Sxy, Syz2 = Syz * Syz, Sxz2 = Sxz * Sxz,
+    Syx2 = Syx * Syx, Szy2 = Szy * Szy, Szx2 = Szx * Szx;
+
+  const double
+    SyzSzymSyySzz2       = 2.0 * (Syz * Szy - Syy * Szz),
+    Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2,
+    Sxy2Sxz2Syx2Szx2     = Sxy2 + Sxz2 - Syx2 - Szx2;
+
+  const double
+    SxzpSzx = Sxz + Szx, SyzpSzy = Syz + Szy, SxypSyx = Sxy + Syx,
+    SyzmSzy = Syz - Szy, SxzmSzx = Sxz - Szx, SxymSyx = Sxy - Syx,
+    SxxpSyy = Sxx + Syy, SxxmSyy = Sxx - Syy;
+
+  const double C2 = -2.0 * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2);
+
+  const double C1 = 8.0 * (Sxx * Syz * Szy + Syy * Szx * Sxz + Szz * Sxy * Syx
+                           - Sxx * Syy * Szz - Syz * Szx * Sxy - Szy * Syx * Sxz);
+
+  const double C0 =
+      Sxy2Sxz2Syx2Szx2 * Sxy2Sxz2Syx2Szx2
+    + (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2)
+    + (-SxzpSzx * SyzmSzy + SxymSyx * (SxxmSyy - Szz)) * (-SxzmSzx * SyzpSzy + SxymSyx * (SxxmSyy + Szz))
+    + (-SxzpSzx * SyzpSzy - SxypSyx * (SxxpSyy - Szz)) * (-SxzmSzx * SyzmSzy - SxypSyx * (SxxpSyy + Szz))
+    + ( SxypSyx * SyzpSzy + SxzpSzx * (SxxmSyy + Szz)) * (-SxymSyx * SyzmSzy + SxzpSzx * (SxxpSyy + Szz))
+    + ( SxypSyx * SyzmSzy + SxzmSzx * (SxxmSyy - Szz)) * (-SxymSyx * SyzpSzy + SxzmSzx * (SxxpSyy - Szz));
+
+  // Newton iteration for the largest root, starting from its upper bound
+  const double E0 = (GA + GB) / 2.0;
+  double lambda = E0;
+
+  // Both structures collapse to a point
+  if (E0 <= 0) {
+    return 0.0;
+  }
+
+  for (int i=0; i<50; i++) {
+    const double
+      old   = lambda,
+      x2    = lambda * lambda,
+      b     = (x2 + C2) * lambda,
+      a     = b + C1,
+      slope = 2.0 * x2 * lambda + b + a;
+
+    // A flat polynomial (e.g. collinear atoms) is already at its root
+    if (slope == 0) {
+      break;
+    }
+
+    lambda -= (a * lambda + C0) / slope;
+    if (fabs(lambda - old) < fabs(1e-11 * lambda)) {
+      break;
+    }
+  }
+
+  return sqrt (fabs (2.0 * (E0 - lambda) / (double) n));
+}
@@ -67,4 +67,30 @@ double kabsch_rmsd (const gsl_matrix *m1, const gsl_matrix *m2);
 exit_t kabsch_function (const gsl_matrix *P, const gsl_matrix *Q, gsl_matrix **U, gsl_matrix **r, double *rmsd);
 
 
+/**
+ * Compute the RMSD between two centered structures after optimal
+ * superposition with the quaternion characteristic polynomial (QCP)
+ * method. The RMSD is the same as the one computed by kabsch_rmsd but
+ * needs no SVD and allocates nothing: the largest eigenvalue of the key
+ * quaternion matrix is found by Newton iteration on its characteristic
+ * polynomial.
+ *
+ * Parameters:
+ *     A  - the first structure as n rows of x, y, z coordinates, centered
+ *          at the origin
+ *     GA - the inner product of A with itself (its sum of squares)
+ *     B  - the second structure, centered, with the same layout as A
+ *     GB - the inner product of B with itself
+ *     n  - the number of atoms in each structure
+ *
+ * Returns:
+ *     A double representing the RMSD between A and B
+ *
+ * References:
+ *   1) Theobald DL. Rapid calculation of RMSDs using a quaternion-based characteristic polynomial. Acta Cryst A 2005;61:478-480.
+ *   2) Liu P, Agrafiotis DK, Theobald DL. Fast determination of the optimal rotational matrix for macromolecular superpositions. J Comput Chem 2010;31:1561-1563.
+ */
+double qcp_rmsd (const double *A, const double GA, const double *B, const double GB, const size_t n);
+
+
 #endif
@@ -0,0 +1,85 @@
+# -*- mode: Python; indent-tabs-mode: nil -*-  #
+"""
+This file is part of AWE
+Copyright (C) 2012- University of Notre Dame
+This software is distributed under the GNU General Public License.
+See the file COPYING for details.
+"""
+
+import unittest
+from types import SimpleNamespace
+
+from awe import monitor, stats, workqueue
+
+
+class StubSystem(object):
+    """
+    A System with 10 walkers in 5 cells.
+    """
+
+    cells = list(range(5))
+
+    def __len__(self):
+        return 10
+
+
+def stub_awe():
+    """
+    An object with the attributes of an AWE instance a Monitor reads.
+    """
+
+    queue = SimpleNamespace(tasks_waiting=3, tasks_running=2,
+                            workers_busy=2, workers_ready=1)
+
+    replication = workqueue.ReplicationPolicy()
+    for turnaround in (1.0, 2.0, 3.0, 4.0):
+        replication.observe(turnaround)
+
+    # The phases are timed without logging them
+    awestats = stats.AWEStats(logger=SimpleNamespace(), log_it=False)
+    awestats.time_resample('start')
+    awestats.time_resample('stop')
+
+    return SimpleNamespace(iteration=7,
+                           system=StubSystem(),
+                           wq=SimpleNamespace(wq=SimpleNamespace(stats=queue),
+                                              replication=replication),
+                           stats=awestats)
+
+
+class MonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = monitor.Monitor('localhost:0')
+        self.monitor.start()
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def test_fetch(self):
+        self.monitor.update(stub_awe())
+
+        host, port = self.monitor.bound
+        self.assertNotEqual(port, 0)
+        text    = monitor.fetch('%s:%d' % (host, port))
+        samples = monitor.parse(text)
+
+        # _sum and _count belong to the summary family
+        self.assertEqual(text.count('# TYPE awe_task_turnaround_seconds'), 1)
+
+        self.assertEqual(samples[('awe_iteration', ())], 7)
+        self.assertEqual(samples[('awe_walkers', ())], 10)
+        self.assertEqual(samples[('awe_cells', ())], 5)
+        self.assertEqual(samples[('awe_tasks', (('state', 'waiting'),))], 3)
+        self.assertEqual(samples[('awe_workers', (('state', 'ready'),))], 1)
+        self.assertEqual(samples[('awe_task_turnaround_seconds_count', ())], 4)
+        self.assertEqual(samples[('awe_task_turnaround_seconds_sum', ())], 10.0)
+        self.assertEqual(samples[('awe_task_turnaround_seconds', (('quantile', '0.5'),))], 2.5)
+        self.assertIn(('awe_phase_seconds', (('phase', 'resample'),)), samples)
+
+    def test_empty(self):
+        self.assertEqual(monitor.parse(monitor.fetch(self.monitor.bound)), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
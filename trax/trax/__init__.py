@@ -1 +1,2 @@
 from .simple import SimpleTransactional
+from .incremental import IncrementalTransactional, Differ
@@ -5,6 +5,9 @@ LOG_FILE_MODE = 'wb'
 
 class AbstractTransactional(object):
 
+	# Whether checkpoints are written as deltas against an earlier snapshot
+	incremental = False
+
 	def __init__(self, checkpoint='transactional.cpt', log='transactional.log', checkpoint_mode=CHECKPOINT_FILE_MODE, log_mode=LOG_FILE_MODE):
 		assert type(checkpoint) is str, type(checkpoint)
 		assert type(log)        is str, type(log)
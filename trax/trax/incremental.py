@@ -0,0 +1,198 @@
+
+from . import base
+
+import os
+import pickle
+import struct
+import time
+
+
+# Every record is a kind byte and a payload length followed by the payload
+RECORD = struct.Struct('<cQ')
+
+GENERATION = b'G'
+SNAPSHOT   = b'S'
+DELTA      = b'D'
+LOG        = b'L'
+
+
+class Differ(object):
+	"""
+	Computes the deltas written by IncrementalTransactional. This default
+	implementation stores every checkpoint whole; subclasses that know the
+	structure of the checkpointed values can store only what changed.
+	"""
+
+	def reset(self, value):
+		"""
+		Called after a snapshot of *value* was written or recovered.
+		"""
+		pass
+
+	def logged(self, value):
+		"""
+		Called for every value logged after the last checkpoint.
+		"""
+		pass
+
+	def diff(self, value):
+		"""
+		:: a -> delta
+		The delta from the last checkpoint (and the values logged since) to *value*.
+		"""
+		return value
+
+	def patch(self, value, delta):
+		"""
+		:: a -> delta -> a
+		Apply a delta returned by diff to the recovered value.
+		"""
+		return delta
+
+
+class IncrementalTransactional(base.AbstractTransactional):
+	"""
+	A full snapshot of the first checkpoint followed by an append-only
+	journal of the deltas of later checkpoints and of the logged values.
+
+	The snapshot is written to the checkpoint path and the journal to the
+	log path, through a single handle kept open between calls. Every
+	*compact* deltas the snapshot is rewritten and the journal truncated.
+	Snapshot and journal carry a random generation number so that a journal
+	left over from an older snapshot is ignored.
+
+	Logged values are flushed to disk at most every *flushinterval*
+	seconds; checkpoints are always flushed and synced.
+	"""
+
+	incremental = True
+
+	def __init__(self, differ=None, compact=10, flushinterval=1.0,
+				pickleprotocol=pickle.HIGHEST_PROTOCOL, **kws):
+		assert type(compact) is int and compact >= 1, compact
+		self._differ         = differ or Differ()
+		self._compact        = compact
+		self._flushinterval  = flushinterval
+		self._pickleprotocol = pickleprotocol
+		self._generation     = None
+		self._ndeltas        = 0
+		self._lastflush      = 0
+		base.AbstractTransactional.__init__(self, **kws)
+		self._log_mode       = 'ab'
+
+	def _write_record(self, fd, kind, value):
+		data = pickle.dumps(value, protocol=self._pickleprotocol)
+		fd.write(RECORD.pack(kind, len(data)))
+		fd.write(data)
+
+	def _sync(self, fd):
+		fd.flush()
+		os.fsync(fd.fileno())
+		self._lastflush = time.time()
+
+	def _snapshot(self, value):
+		generation = int.from_bytes(os.urandom(8), 'little')
+
+		# Replace the snapshot atomically, then start a new journal
+		tmp = self.cpt_path + '.tmp'
+		with open(tmp, 'wb') as fd:
+			self._write_record(fd, GENERATION, generation)
+			self._write_record(fd, SNAPSHOT, value)
+			self._sync(fd)
+		os.replace(tmp, self.cpt_path)
+
+		self._log_close()
+		self._log_fd = open(self.log_path, 'wb')
+		self._write_record(self._log_fd, GENERATION, generation)
+		self._sync(self._log_fd)
+
+		self._generation = generation
+		self._ndeltas    = 0
+		self._differ.reset(value)
+
+	def checkpoint(self, value):
+		if self._generation is None or self._ndeltas >= self._compact:
+			self._snapshot(value)
+			return
+
+		self._log_open()
+		self._write_record(self._log_fd, DELTA, self._differ.diff(value))
+		self._sync(self._log_fd)
+		self._ndeltas += 1
+
+	def log(self, value):
+		if self._generation is None:
+			raise ValueError('Cannot log to %s before the first checkpoint' % self.log_path)
+
+		self._log_open()
+		self._write_record(self._log_fd, LOG, value)
+		self._differ.logged(value)
+
+		if time.time() - self._lastflush >= self._flushinterval:
+			self._log_fd.flush()
+			self._lastflush = time.time()
+
+	def _read_records(self, fd):
+		"""
+		Yield (kind, value, end offset) for every complete record. A record
+		cut short by a crash ends the iteration.
+		"""
+		while True:
+			header = fd.read(RECORD.size)
+			if len(header) < RECORD.size:
+				return
+			kind, size = RECORD.unpack(header)
+			data = fd.read(size)
+			if len(data) < size:
+				return
+			try:
+				value = pickle.loads(data)
+			except Exception:
+				return
+			yield kind, value, fd.tell()
+
+	def recover(self, value_handler):
+		"""
+		Rebuild the last checkpointed value, then apply the values logged
+		after it with value_handler :: a -> b -> IO ().
+		Appending continues after the last complete record.
+		"""
+		self.close()
+
+		with open(self.cpt_path, 'rb') as fd:
+			records = self._read_records(fd)
+			_, generation, _ = next(records)
+			_, value, _      = next(records)
+
+		self._generation = generation
+		self._ndeltas    = 0
+		self._differ.reset(value)
+
+		end = 0
+		if os.path.exists(self.log_path):
+			with open(self.log_path, 'rb') as fd:
+				for kind, item, offset in self._read_records(fd):
+					if kind == GENERATION:
+						if item != generation:
+							# The snapshot was rewritten after this journal
+							break
+					elif kind == DELTA:
+						value = self._differ.patch(value, item)
+						self._differ.reset(value)
+						self._ndeltas += 1
+					elif kind == LOG:
+						value_handler(value, item)
+						self._differ.logged(item)
+					end = offset
+
+		if end == 0:
+			# No journal for this snapshot, start a new one
+			self._log_fd = open(self.log_path, 'wb')
+			self._write_record(self._log_fd, GENERATION, generation)
+			self._sync(self._log_fd)
+		else:
+			# Drop any partial record and append after the rest
+			with open(self.log_path, 'r+b') as fd:
+				fd.truncate(end)
+
+		return value